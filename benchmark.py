@@ -0,0 +1,317 @@
+"""
+Scaling benchmark and regression check of the data-prep pipeline on
+synthetic fields (see synthetic.py).
+
+For each (number of sources, number of epochs) it writes a synthetic field,
+times every stage (ingestion, aggregation, the quality cuts, Stetson S,
+reduced chi^2, the period search and plotting, plus the old groupby.apply
+versions on a sample of sources), and checks the results against the
+injected truth: that the variables are found, the constants aren't, the
+periods come out right, the batch statistics agree with the original
+per-group functions, the per-season windows hold the rows a per-source
+loop puts in them, and cross-field deduplication keeps distinct stars apart.
+
+    python benchmark.py --sources 1000 10000 --epochs 100 -o bench.json
+
+Exits with status 1 if any check fails.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+import pandas as pd
+
+from stetson_2020 import (
+    source_means,
+    threeband_stetson_batch,
+    threeband_chisq_red_batch,
+    period_search_batch,
+    threeband_stetson_pandas,
+    j_chisq_red,
+    h_chisq_red,
+    k_chisq_red,
+    period_fap,
+)
+from wserv_io import read_wserv, load_photometry
+from quality_cuts import select_tiers
+from pipeline import field_config, process_field
+from synthetic import write_synthetic_field
+from render_atlas import render_atlas
+from plots import plot_many, three_plot
+from time_resolved import season_windows, windowed_statistics
+from crossmatch import arcsec, deduplicate
+
+# what the regression checks accept
+default_checks = {
+    # fraction of the injected variables passing the quality cuts that are selected
+    "min_recall": 0.9,
+    # fraction of the constants passing the quality cuts that are selected
+    "max_false_positive_rate": 0.02,
+    # fraction of the selected periodic variables whose K-band period is
+    # within period_tolerance (relative) of the injected one
+    "min_period_recovery": 0.8,
+    "period_tolerance": 0.02,
+    # batch statistics vs the per-group functions, both in float64
+    "rtol": 1e-5,
+}
+
+
+@contextmanager
+def timed(records, stage, **info):
+    """ Appends a {stage, seconds, **info} record for the duration of the block. """
+    start = time.perf_counter()
+    yield
+    records.append({"stage": stage, "seconds": time.perf_counter() - start, **info})
+
+
+def check_results(results, truth, photometry, sample, checks=default_checks):
+    """
+    The regression checks for one synthetic field.
+
+    Returns
+    -------
+    checks : list of dict
+        One per check: name, value, limit and whether it passed.
+
+    """
+
+    tiers = results["tiers"]
+    passing = tiers.index[tiers["q1"] | tiers["q2"]]
+    truth = truth.loc[truth.index.isin(passing)]
+    selected = set(results["q1and2_variables"])
+
+    is_variable = truth["kind"].isin(["periodic", "aperiodic"])
+    variables = truth.index[is_variable]
+    constants = truth.index[truth["kind"] == "constant"]
+
+    recall = np.mean([sid in selected for sid in variables]) if len(variables) else np.nan
+    false_positive_rate = np.mean([sid in selected for sid in constants]) if len(constants) else np.nan
+
+    periods = results["periods"]
+    k_periods = periods[periods["band"] == "K"].set_index("SOURCEID")["best_period"]
+    periodic = [sid for sid in truth.index[truth["kind"] == "periodic"] if sid in k_periods.index]
+    if periodic:
+        found = k_periods.loc[periodic].values
+        injected = truth.loc[periodic, "period"].values
+        period_recovery = np.mean(np.abs(found - injected) / injected < checks["period_tolerance"])
+    else:
+        period_recovery = np.nan
+
+    df = photometry.data
+    sample_rows = df[df["SOURCEID"].isin(sample)]
+    # the batch kernels work in float64, so the per-group functions have to
+    # too: on the cache's float32 columns pandas would sum in float32, and
+    # the comparison would measure float32 rounding rather than the kernels
+    sample_rows = sample_rows.astype({name: np.float64 for name in sample_rows.columns
+                                      if sample_rows[name].dtype == np.float32})
+    groups = sample_rows.groupby("SOURCEID")
+
+    stetson = results["stetson"]
+    in_q2 = [sid for sid in sample if sid in stetson.index]
+    legacy_stetson = groups.apply(threeband_stetson_pandas).loc[in_q2]
+    stetson_error = np.max(
+        np.abs(stetson.loc[in_q2].values - legacy_stetson.values)
+        / np.maximum(np.abs(legacy_stetson.values), 1)
+    ) if in_q2 else 0.0
+
+    chisq_red = results["chisq_red"]
+    chisq_error = 0.0
+    for band, function in (("J", j_chisq_red), ("H", h_chisq_red), ("K", k_chisq_red)):
+        eligible = results["chisq_eligible"][band]
+        in_band = [sid for sid in sample if sid in eligible.index and eligible[sid]]
+        if not in_band:
+            continue
+        legacy = groups.apply(function).loc[in_band].values
+        batch = chisq_red[band].loc[in_band].values
+        chisq_error = max(chisq_error, np.max(np.abs(batch - legacy) / np.maximum(np.abs(legacy), 1)))
+
+    # rows per (source, season): windowed_statistics vs a loop over the sample
+    windows = season_windows(photometry.column("MEANMJDOBS"))
+    windowed = windowed_statistics(photometry, windows, sample, min_rows=1)["n_rows"]
+    window_errors = 0
+    for sid, group in groups:
+        t = group["MEANMJDOBS"].values
+        for window, (start, end) in enumerate(zip(*windows)):
+            expected = int(np.sum((t >= start) & (t < end)))
+            found = int(windowed.get((sid, window), 0))
+            window_errors += expected != found
+
+    def check(name, value, limit, passed):
+        return {"check": name, "value": float(value), "limit": limit, "passed": bool(passed)}
+
+    return [
+        check("recall", recall, checks["min_recall"], not recall < checks["min_recall"]),
+        check("false_positive_rate", false_positive_rate, checks["max_false_positive_rate"],
+              not false_positive_rate > checks["max_false_positive_rate"]),
+        check("period_recovery", period_recovery, checks["min_period_recovery"],
+              not period_recovery < checks["min_period_recovery"]),
+        check("stetson_vs_pandas", stetson_error, checks["rtol"], stetson_error <= checks["rtol"]),
+        check("chisq_red_vs_pandas", chisq_error, checks["rtol"], chisq_error <= checks["rtol"]),
+        check("season_rows_vs_loop", window_errors, 0, window_errors == 0),
+    ]
+
+
+def check_deduplicate():
+    """
+    Cross-field deduplication on a source that could bridge two stars: two
+    sources of one field 1.5" apart and one of another field midway between
+    them, matched at 1". Both stars of the first field have to stay.
+    """
+
+    first = pd.DataFrame({"RA": [0.0, 1.5 * arcsec], "DEC": [0.0, 0.0]}, index=[1, 2])
+    second = pd.DataFrame({"RA": [0.75 * arcsec], "DEC": [0.0]}, index=[3])
+    sources = deduplicate({"W8": first, "W11": second}, radius_arcsec=1.0)
+
+    n_distinct = int(sources["primary"].sum())
+    kept = bool(sources.loc[("W8", 1), "primary"] and sources.loc[("W8", 2), "primary"])
+    return {"check": "deduplicate_bridging", "value": float(n_distinct), "limit": 2,
+            "passed": n_distinct == 2 and kept}
+
+
+def benchmark_field(n_sources, n_epochs, work_dir, n_workers=None, legacy_sample=50,
+                    n_plots=20, random_seed=0, checks=default_checks):
+    """
+    Writes one synthetic field to `work_dir`, times each stage on it and
+    runs the regression checks.
+
+    Returns
+    -------
+    records : list of dict
+        One timing record per stage.
+    checks : list of dict
+        From check_results.
+
+    """
+
+    info = {"n_sources": n_sources, "n_epochs": n_epochs}
+    filename = os.path.join(work_dir, f"WSERV0_{n_sources}x{n_epochs}.fits")
+    truth = write_synthetic_field(filename, n_sources=n_sources, n_epochs=n_epochs,
+                                  random_seed=random_seed)
+    info["n_rows"] = n_sources * n_epochs
+
+    records = []
+    with timed(records, "ingestion", **info):
+        df = read_wserv(filename)
+    with timed(records, "ingestion_cached", **info):
+        photometry = load_photometry(filename)
+    del df
+
+    with timed(records, "aggregation", **info):
+        source_means(photometry)
+
+    config = field_config({"filename": filename, "period_search": {"n_workers": n_workers}})
+
+    # the steps of process_field one at a time, then the whole thing
+    with timed(records, "tiers", **info):
+        tiers = select_tiers(photometry, **config["cuts"])
+    q2_sourceids = tiers.index[tiers["q2"]]
+    with timed(records, "stetson", n_stars=len(q2_sourceids), **info):
+        threeband_stetson_batch(photometry, q2_sourceids)
+    with timed(records, "chisq_red", **info):
+        threeband_chisq_red_batch(photometry, {band: tiers[f"q{band.lower()}"] for band in "JHK"})
+
+    with timed(records, "process_field", **info):
+        results = process_field(photometry, config)
+    variables = results["q1and2_variables"]
+    with timed(records, "period_fap", n_stars=len(variables), **info):
+        period_search_batch(photometry, variables, bands="JHK", n_workers=n_workers)
+
+    rng = np.random.default_rng(random_seed)
+    sample = np.sort(rng.choice(photometry.ids, min(legacy_sample, len(photometry.ids)), replace=False))
+    df = photometry.data
+    groups = df[df["SOURCEID"].isin(sample)].groupby("SOURCEID")
+    sample_info = {"n_stars": len(sample), **info}
+    with timed(records, "aggregation_pandas", **sample_info):
+        groups.aggregate(np.nanmean)
+    with timed(records, "stetson_pandas", **sample_info):
+        groups.apply(threeband_stetson_pandas)
+    with timed(records, "chisq_red_pandas", **sample_info):
+        for function in (j_chisq_red, h_chisq_red, k_chisq_red):
+            groups.apply(function)
+    with timed(records, "period_fap_pandas", **sample_info):
+        for band in "JHK":
+            groups.apply(period_fap, band)
+
+    to_plot = list(variables)[:n_plots]
+    plot_dir = os.path.join(work_dir, "plots")
+    with timed(records, "plotting", n_stars=len(to_plot), **info):
+        render_atlas(photometry, to_plot, output_dir=plot_dir, n_workers=n_workers, progress=False)
+    with timed(records, "plotting_pyplot", n_stars=len(to_plot), **info):
+        plot_many(photometry, to_plot, three_plot,
+                  filename=os.path.join(plot_dir, "pyplot_{sourceid}.png"))
+
+    field_checks = [
+        {**check, **info}
+        for check in check_results(results, truth, photometry, sample, checks)
+    ]
+
+    return records, field_checks
+
+
+def run_benchmarks(sources=(1000,), epochs=(100,), work_dir=None, **kwargs):
+    """
+    benchmark_field over every combination of `sources` and `epochs`.
+
+    Returns {"timings": [...], "checks": [...], "passed": bool}.
+    """
+
+    timings = []
+    checks = [check_deduplicate()]
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        for n_epochs in epochs:
+            for n_sources in sources:
+                records, field_checks = benchmark_field(n_sources, n_epochs, tmp, **kwargs)
+                timings += records
+                checks += field_checks
+
+    return {
+        "timings": timings,
+        "checks": checks,
+        "passed": all(check["passed"] for check in checks),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic fields.")
+    parser.add_argument("--sources", type=int, nargs="+", default=[1000, 4000])
+    parser.add_argument("--epochs", type=int, nargs="+", default=[100])
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes for the period search and plotting")
+    parser.add_argument("--legacy-sample", type=int, default=50,
+                        help="sources to time the groupby.apply versions on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None,
+                        help="where to write the synthetic fields (default: a temp dir)")
+    parser.add_argument("-o", "--output", default=None, help="write the report here as json")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.sources, args.epochs, work_dir=args.work_dir,
+                            n_workers=args.workers, legacy_sample=args.legacy_sample,
+                            random_seed=args.seed)
+
+    timings = pd.DataFrame(report["timings"])
+    print(timings.pivot_table(index="stage", columns=["n_sources", "n_epochs"],
+                              values="seconds", sort=False).to_string(float_format="%.3f"))
+    print()
+    print(pd.DataFrame(report["checks"]).to_string(index=False))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""
+Monte Carlo calibration of the variability thresholds (Stetson S > 2.5 and
+reduced chi^2 > 3 in the data-prep scripts) for a field's own cadence and
+error bars.
+
+Constant stars are simulated by taking real sources of the field as
+templates: each synthetic light curve keeps a template's rows, its missing
+measurements and its (Hodgkin-corrected) error bars, and draws Gaussian
+noise of exactly those errors about a constant magnitude. Both statistics
+ignore the mean magnitude and the times, so that is all a constant star
+needs. The synthetic curves go through the same segmented S_segments and
+chisq_red_segments as the real ones, in chunks of rows over a process pool,
+and the thresholds that give each target false-positive rate are the
+matching quantiles of the results.
+
+    python calibration.py fields.json --curves 10000000 --fpr 0.01 0.001 -o thresholds.csv
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from instrument import instrumented
+from pipeline import field_config, load_configs
+from quality_cuts import select_tiers
+from stetson_2020 import source_columns, segment_rows, S_segments, chisq_red_segments
+from wserv_io import load_photometry
+
+default_fprs = (0.01, 0.001, 0.0001)
+
+# the templates, set in each worker process (see _set_templates)
+_templates = None
+
+
+def _set_templates(templates):
+    global _templates
+    _templates = templates
+
+
+def _simulate_chunk(args):
+    """
+    Worker for simulate_constant_stars: `n` constant stars on templates
+    drawn at random. Returns their S and reduced chi^2 (NaN where the
+    template isn't eligible), as float32.
+    """
+
+    n, seed, bands = args
+    templates = _templates
+    rng = np.random.default_rng(seed)
+
+    choice = rng.integers(0, len(templates["counts"]), n)
+    counts = templates["counts"][choice]
+    rows = segment_rows(templates["starts"][choice], counts)
+    starts = np.cumsum(counts) - counts
+
+    mags = []
+    errs = []
+    for band in bands:
+        err = templates["errs"][band][rows].astype(np.float64)
+        y = rng.standard_normal(rows.size) * err
+        y[~templates["measured"][band][rows]] = np.nan
+        mags.append(y)
+        errs.append(err)
+
+    stats = {"stetson": np.where(templates["stetson"][choice],
+                                 S_segments(starts, counts, *[x for pair in zip(mags, errs) for x in pair]),
+                                 np.nan)}
+    chisq = chisq_red_segments(starts, counts, mags, errs)
+    for i, band in enumerate(bands):
+        stats[band] = np.where(templates["eligible"][band][choice], chisq[i], np.nan)
+
+    return {name: values.astype(np.float32) for name, values in stats.items()}
+
+
+@instrumented("simulate_constant_stars")
+def simulate_constant_stars(photometry, stetson_sources, eligible, n_curves=100_000,
+                            chunk_rows=2**22, n_workers=None, mp_context=None,
+                            random_seed=None):
+    """
+    Simulates `n_curves` constant stars on the cadence and error bars of
+    real sources (see the module docstring).
+
+    Parameters
+    ----------
+    photometry : IndexedPhotometry, LightCurveCollection or pd.DataFrame
+    stetson_sources : array_like
+        The sources S is computed for in the pipeline (Q2).
+    eligible : dict
+        band -> boolean Series indexed by SOURCEID: the sources the
+        reduced chi^2 is computed for in that band, as for
+        threeband_chisq_red_batch. Templates are drawn uniformly from all of
+        these sources and the Q2 ones.
+    n_curves : int, optional
+    chunk_rows : int, optional
+        Rows of synthetic photometry simulated at a time per worker.
+    n_workers : int, optional
+        Default os.cpu_count(); 1 runs in this process.
+    mp_context : optional
+        As in stetson_2020.period_search_batch ("fork" where available).
+    random_seed : int, optional
+
+    Returns
+    -------
+    simulated : pd.DataFrame
+        One row per synthetic star: stetson, and J, H, K reduced chi^2
+        (NaN where its template isn't eligible).
+
+    """
+
+    bands = "".join(eligible)
+    sourceids = np.union1d(
+        np.asarray(stetson_sources, dtype=np.int64),
+        np.concatenate([np.asarray(eligible[band].index[eligible[band].values.astype(bool)],
+                                   dtype=np.int64) for band in bands] + [np.array([], dtype=np.int64)]),
+    )
+    if not sourceids.size:
+        raise ValueError("No template sources to simulate constant stars on.")
+
+    names = [f"{band}APERMAG3" for band in bands] + [f"{band}APERMAG3ERR" for band in bands]
+    ids, starts, counts, columns = source_columns(photometry, names, sourceids)
+    templates = {
+        "starts": starts,
+        "counts": counts,
+        "errs": {band: np.ascontiguousarray(columns[f"{band}APERMAG3ERR"], dtype=np.float32)
+                 for band in bands},
+        "measured": {band: ~np.isnan(columns[f"{band}APERMAG3"]) & ~np.isnan(columns[f"{band}APERMAG3ERR"])
+                     for band in bands},
+        "stetson": np.isin(ids, np.asarray(stetson_sources)),
+        "eligible": {band: eligible[band].reindex(ids, fill_value=False).values.astype(bool)
+                     for band in bands},
+    }
+    instrument.note(n_sources=len(ids), n_rows=int(counts.sum()), n_curves=n_curves)
+
+    per_chunk = max(1, int(chunk_rows // max(counts.mean(), 1)))
+    sizes = [min(per_chunk, n_curves - i) for i in range(0, n_curves, per_chunk)]
+    seeds = np.random.SeedSequence(random_seed).spawn(len(sizes))
+    tasks = [(size, seed, bands) for size, seed in zip(sizes, seeds)]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_workers == 1 or len(tasks) <= 1:
+        _set_templates(templates)
+        try:
+            results = [_simulate_chunk(task) for task in tasks]
+        finally:
+            _set_templates(None)
+    else:
+        if mp_context is None and "fork" in multiprocessing.get_all_start_methods():
+            mp_context = "fork"
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context,
+                                 initializer=_set_templates, initargs=(templates,)) as pool:
+            results = list(pool.map(_simulate_chunk, tasks))
+
+    return pd.DataFrame({
+        name: np.concatenate([result[name] for result in results])
+        for name in ["stetson", *bands]
+    })
+
+
+def calibrated_thresholds(simulated, fprs=default_fprs):
+    """
+    The threshold on each statistic above which a fraction `fpr` of
+    constant stars fall, for each target false-positive rate.
+
+    Returns a DataFrame indexed by fpr, one column per statistic, with the
+    number of synthetic stars each column is based on in .attrs["n"].
+    """
+
+    fprs = np.atleast_1d(np.asarray(fprs, dtype=np.float64))
+    thresholds = pd.DataFrame(
+        {name: np.nanquantile(simulated[name].values.astype(np.float64), 1 - fprs)
+         if simulated[name].notna().any() else np.nan
+         for name in simulated.columns},
+        index=pd.Index(fprs, name="fpr"),
+    )
+    thresholds.attrs["n"] = {name: int(simulated[name].notna().sum()) for name in simulated.columns}
+    return thresholds
+
+
+def false_positive_rates(simulated, stetson_variable=2.5, chisq_variable=3):
+    """
+    The fraction of constant stars the fixed cuts select: by S (of those S
+    is computed for), by reduced chi^2 in each band (of those eligible in
+    it), and by reduced chi^2 in any band (of those eligible in any).
+    """
+
+    bands = [name for name in simulated.columns if name != "stetson"]
+    rates = {"stetson": float((simulated["stetson"] > stetson_variable).sum()
+                              / max(simulated["stetson"].notna().sum(), 1))}
+    for band in bands:
+        rates[band] = float((simulated[band] > chisq_variable).sum()
+                            / max(simulated[band].notna().sum(), 1))
+    any_eligible = simulated[bands].notna().any(axis=1)
+    rates["chisq_any"] = float((simulated[bands] > chisq_variable).any(axis=1).sum()
+                               / max(any_eligible.sum(), 1))
+    return pd.Series(rates)
+
+
+def calibrate_field(config, n_curves=100_000, fprs=default_fprs, **kwargs):
+    """
+    The calibration of one field (a pipeline config, or a fits filename):
+    templates are its Q2 sources for S and its band-eligible sources for
+    the reduced chi^2, after the field's quality cuts.
+
+    Returns (thresholds, rates): from calibrated_thresholds and, at the
+    config's stetson_variable and chisq_variable, false_positive_rates.
+    """
+
+    config = field_config(config)
+    photometry = load_photometry(config["filename"])
+    tiers = select_tiers(photometry, **config["cuts"])
+    eligible = {band: tiers[f"q{band.lower()}"] for band in "JHK"}
+
+    simulated = simulate_constant_stars(photometry, tiers.index[tiers["q2"]], eligible,
+                                        n_curves=n_curves, **kwargs)
+    rates = false_positive_rates(simulated, config["stetson_variable"], config["chisq_variable"])
+    return calibrated_thresholds(simulated, fprs), rates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calibrate the variability thresholds by simulation.")
+    parser.add_argument("config", help="json file of field configs (see pipeline.default_config)")
+    parser.add_argument("--fields", nargs="+", default=None, metavar="NAME")
+    parser.add_argument("--curves", type=int, default=100_000, help="synthetic constant stars per field")
+    parser.add_argument("--fpr", type=float, nargs="+", default=list(default_fprs),
+                        help="target false-positive rates")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("-o", "--output", default=None, help="write the thresholds here as csv")
+    args = parser.parse_args(argv)
+
+    configs = load_configs(args.config)
+    if args.fields is not None:
+        configs = [config for config in configs if config["name"] in args.fields]
+
+    thresholds = {}
+    for config in configs:
+        thresholds[config["name"]], rates = calibrate_field(
+            config, n_curves=args.curves, fprs=args.fpr, n_workers=args.workers,
+            random_seed=args.seed,
+        )
+        print(f"{config['name']}: false-positive rates of the current cuts", file=sys.stderr)
+        print(rates.to_string(float_format="%.2e"), file=sys.stderr)
+
+    table = pd.concat(thresholds, names=["field"])
+    print(table.to_string(float_format="%.3f"))
+    if args.output is not None:
+        table.to_csv(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,351 @@
+"""
+Brown dwarf candidates from the K vs H-K colour-magnitude diagram, matched
+against a grid of isochrones: the "WSERV8 Brown Dwarf CMD selection"
+notebook, for whole catalogs and any number of isochrones.
+
+Each source is de-reddened along the reddening vector onto the nearest
+isochrone of the grid (several ages, each at several distance moduli). All
+the isochrone points go into one KD-tree, and every source of every field
+is matched in one query, giving its de-reddened mass and age, its A_V, and
+whether it lies below the brown dwarf limit.
+
+The notebook's cut (below the reddening line through the brown dwarf limit
+in K and H-K) is the same test, made against the point of each isochrone at
+the hydrogen-burning mass rather than one hand-derived line. MIST tracks
+stop at 0.1 solar masses, above that mass, so their limit falls back to
+their lowest-mass point (flagged in IsochroneGrid.tracks), which is brighter
+than the notebook's; its hand-derived limit can be given instead
+(--bd-limit 0.273 13.8495 for IC 348).
+
+    python cmd_selection.py prepped/WSERV8_variable_means.pkl \\
+        --isochrones MIST_iso_6Myr.iso.cmd --distance-modulus 7.525 -o WSERV8_cmd.csv
+
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import instrument
+from instrument import instrumented
+from stetson_2020 import source_columns, segment_nanmedian
+
+# extinction per magnitude of A_V (Rieke & Lebofsky 1985)
+A_K = 0.112
+A_H = 0.175
+E_HK = A_H - A_K
+# dK / d(H-K) along the reddening vector
+reddening_slope = A_K / E_HK
+
+# the hydrogen-burning limit, in solar masses
+bd_mass_limit = 0.075
+
+# the columns the matching uses, as in the pipeline's per-source tables
+cmd_columns = ["KAPERMAG3", "KAPERMAG3ERR", "HMKPNT", "HMKPNTERR"]
+
+# the age columns MIST files come with (log10_... in the multi-age
+# downloads, linear in e.g. MIST_iso_6Myr.iso.cmd), in order of preference
+age_columns = ["log10_isochrone_age_yr", "isochrone_age_yr"]
+
+
+def reddening_free(hmk, k):
+    """
+    K less the reddening vector's slope times H-K: unchanged by extinction,
+    so de-reddening a source keeps it, and a source is fainter than the
+    reddening line through a point when its value is larger.
+    """
+    return np.asarray(k) - reddening_slope * np.asarray(hmk)
+
+
+def read_mist_cmd(filename, max_mass=3.0):
+    """
+    Reads a MIST .iso.cmd file (one or more isochrones) into a DataFrame,
+    keeping the stars below `max_mass`, as the notebook did for the 6 Myr
+    isochrone.
+    """
+
+    names = None
+    with open(filename) as f:
+        for line in f:
+            if line.startswith("#") and line.lstrip("#").split()[:1] == ["EEP"]:
+                names = line.lstrip("#").split()
+                break
+    if names is None:
+        raise ValueError(f"No '# EEP' column header in {filename}")
+
+    table = pd.read_csv(filename, comment="#", sep=r"\s+", header=None, names=names)
+    return table[table["star_mass"] < max_mass].reset_index(drop=True)
+
+
+def find_age_column(table, age_column=None):
+    """ `age_column`, or else the first of age_columns that `table` has. """
+
+    if age_column is not None:
+        return age_column
+    for name in age_columns:
+        if name in table.columns:
+            return name
+    raise KeyError(f"No age column ({' or '.join(age_columns)}) in the isochrone table")
+
+
+def log_age(table, age_column=None):
+    """ log10 of the ages (years) in a MIST table, whichever age column it has (see find_age_column). """
+
+    age_column = find_age_column(table, age_column)
+    ages = table[age_column].values.astype(np.float64)
+    return ages if age_column.startswith("log10") else np.log10(ages)
+
+
+def split_isochrones(table, age_column=None):
+    """ The separate isochrones of a MIST table, one per age. """
+    age_column = find_age_column(table, age_column)
+    return [group.sort_values("star_mass") for _, group in table.groupby(age_column)]
+
+
+def _densify(hmk, k, mass, step):
+    """ Points every `step` mag of CMD path length along one track, by linear interpolation. """
+
+    length = np.concatenate([[0], np.cumsum(np.hypot(np.diff(hmk), np.diff(k)))])
+    s = np.linspace(0, length[-1], max(2, int(np.ceil(length[-1] / step)) + 1))
+    return np.interp(s, length, hmk), np.interp(s, length, k), np.interp(s, length, mass)
+
+
+class IsochroneGrid:
+    """
+    A set of isochrones, each placed at several distance moduli, indexed by
+    one KD-tree in (H-K, K) space for nearest-isochrone matching.
+
+    The tree's coordinates are the reddening-free K (see reddening_free)
+    and `along_weight` times H-K: a match only moves a source a little
+    across the reddening vector, and the weight breaks ties along it in
+    favour of the least extinction.
+
+    Attributes
+    ----------
+    points : pd.DataFrame
+        The densified isochrone points: hmk, k, mass, log_age,
+        distance_modulus and track (which isochrone / distance).
+    tracks : pd.DataFrame
+        One row per track: log_age, distance_modulus, the reddening-free K
+        of its point at the brown dwarf limit (bd_limit), and whether that
+        point is the track's lowest-mass one because the track stops above
+        bd_mass (bd_limit_clipped).
+    tree : cKDTree
+
+    """
+
+    def __init__(self, isochrones, distance_moduli, h_column="UKIDSS_H", k_column="UKIDSS_K",
+                 age_column=None, bd_mass=bd_mass_limit, bd_limit=None, step=0.005,
+                 along_weight=0.05):
+        """
+        Parameters
+        ----------
+        isochrones : list of pd.DataFrame
+            With star_mass, the age column and absolute H and K magnitudes
+            (see read_mist_cmd and split_isochrones).
+        distance_moduli : sequence of float
+            Every isochrone is placed at each of these.
+        h_column, k_column : str, optional
+        age_column : str, optional
+            Default: whichever of age_columns the isochrones have; linear
+            ages are converted to log10.
+        bd_mass : float, optional
+            Solar masses. Isochrones that stop above it (MIST stops at 0.1)
+            use their lowest-mass point as the limit, and are flagged
+            bd_limit_clipped in `tracks`.
+        bd_limit : (float, float), optional
+            An apparent (H-K, K) brown dwarf limit to use for every track
+            instead, e.g. the notebook's (0.273, 13.8495); then bd_mass
+            isn't used.
+        step : float, optional
+            Spacing (mag) of the points along each isochrone.
+        along_weight : float, optional
+
+        """
+
+        self.along_weight = along_weight
+        points = []
+        tracks = []
+        for isochrone in isochrones:
+            isochrone = isochrone.sort_values("star_mass")
+            mass = isochrone["star_mass"].values.astype(np.float64)
+            h = isochrone[h_column].values.astype(np.float64)
+            k = isochrone[k_column].values.astype(np.float64)
+            age = float(log_age(isochrone, age_column)[0])
+            hmk, k_abs, mass = _densify(h - k, k, mass, step)
+
+            limit = np.clip(bd_mass, mass.min(), mass.max())
+            bd_hmk, bd_k = np.interp(limit, mass, hmk), np.interp(limit, mass, k_abs)
+
+            for mu in distance_moduli:
+                track = len(tracks)
+                if bd_limit is None:
+                    tracks.append({"log_age": age, "distance_modulus": float(mu),
+                                   "bd_limit": float(reddening_free(bd_hmk, bd_k + mu)),
+                                   "bd_limit_clipped": bool(limit != bd_mass)})
+                else:
+                    tracks.append({"log_age": age, "distance_modulus": float(mu),
+                                   "bd_limit": float(reddening_free(*bd_limit)),
+                                   "bd_limit_clipped": False})
+                points.append(pd.DataFrame({
+                    "hmk": hmk, "k": k_abs + mu, "mass": mass, "log_age": age,
+                    "distance_modulus": float(mu), "track": track,
+                }))
+
+        self.points = pd.concat(points, ignore_index=True)
+        self.tracks = pd.DataFrame(tracks)
+        self.tree = cKDTree(self._coordinates(self.points["hmk"].values, self.points["k"].values))
+
+    def _coordinates(self, hmk, k):
+        return np.column_stack([reddening_free(hmk, k), self.along_weight * np.asarray(hmk)])
+
+    @classmethod
+    def from_mist(cls, filenames, distance_moduli, max_mass=3.0, **kwargs):
+        """ A grid of every isochrone in the MIST .iso.cmd `filenames`. """
+        isochrones = [
+            iso for filename in filenames
+            for iso in split_isochrones(read_mist_cmd(filename, max_mass), kwargs.get("age_column"))
+        ]
+        return cls(isochrones, distance_moduli, **kwargs)
+
+
+@instrumented("cmd_classify")
+def classify(table, grid, k_neighbors=8, av_tolerance=0.5):
+    """
+    Matches every source to its de-reddened nearest isochrone point.
+
+    Of each source's `k_neighbors` nearest points, the nearest that needs
+    no less than -`av_tolerance` of A_V is taken (a source a little bluer
+    than the isochrone is photometric scatter, not negative extinction);
+    if none does, the nearest.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        Per-source KAPERMAG3 and HMKPNT (the pipeline's means, or the
+        medians from source_cmd_photometry), indexed by SOURCEID.
+    grid : IsochroneGrid
+    k_neighbors : int, optional
+    av_tolerance : float, optional
+
+    Returns
+    -------
+    matches : pd.DataFrame
+        Indexed like `table`: mass (solar masses), log_age,
+        distance_modulus, A_V, offset (mag of reddening-free K between the
+        source and its match) and bd_candidate (fainter than the reddening
+        line through the matched isochrone's brown dwarf limit). NaN (and
+        False) where K or H-K is missing.
+
+    """
+
+    hmk = table["HMKPNT"].values.astype(np.float64)
+    k = table["KAPERMAG3"].values.astype(np.float64)
+    good = np.isfinite(hmk) & np.isfinite(k)
+    instrument.note(n_sources=len(table), n_points=len(grid.points))
+
+    n_neighbors = min(k_neighbors, len(grid.points))
+    _, nearest = grid.tree.query(grid._coordinates(hmk[good], k[good]), k=n_neighbors)
+    nearest = nearest.reshape(good.sum(), n_neighbors)
+
+    av = (hmk[good, None] - grid.points["hmk"].values[nearest]) / E_HK
+    # the first neighbour with an acceptable A_V (or the nearest, if none)
+    choice = np.argmax(av >= -av_tolerance, axis=1)
+    match = nearest[np.arange(len(choice)), choice]
+
+    points = grid.points.iloc[match]
+    q = reddening_free(hmk[good], k[good])
+    bd_limit = grid.tracks["bd_limit"].values[points["track"].values]
+
+    matches = pd.DataFrame(index=table.index)
+    for name, values in (
+        ("mass", points["mass"].values),
+        ("log_age", points["log_age"].values),
+        ("distance_modulus", points["distance_modulus"].values),
+        ("A_V", av[np.arange(len(choice)), choice]),
+        ("offset", q - reddening_free(points["hmk"].values, points["k"].values)),
+    ):
+        column = np.full(len(table), np.nan)
+        column[good] = values
+        matches[name] = column
+    bd_candidate = np.zeros(len(table), dtype=bool)
+    bd_candidate[good] = q > bd_limit
+    matches["bd_candidate"] = bd_candidate
+
+    return matches
+
+
+def source_cmd_photometry(photometry, sourceids=None):
+    """
+    Per-source median K, H-K and their errors (as the notebook took them),
+    from photometry or a LightCurveCollection that keeps the colour columns.
+    """
+
+    ids, starts, counts, columns = source_columns(photometry, cmd_columns, sourceids)
+    return pd.DataFrame(
+        {name: segment_nanmedian(columns[name], starts, counts) for name in cmd_columns},
+        index=pd.Index(ids, name="SOURCEID"),
+    )
+
+
+def plot_cmd(ax, table, grid, matches=None, candidate_style="ro"):
+    """
+    The K vs H-K diagram: the grid's tracks, every source (one errorbar
+    call for the lot), and the brown dwarf candidates highlighted.
+    """
+
+    for track, points in grid.points.groupby("track"):
+        ax.plot(points["hmk"], points["k"], lw=1,
+                label=f"{10 ** (points['log_age'].iloc[0] - 6):.3g} Myr, "
+                      f"$\\mu={points['distance_modulus'].iloc[0]:g}$")
+
+    ax.errorbar(table["HMKPNT"], table["KAPERMAG3"], xerr=table.get("HMKPNTERR"),
+                yerr=table.get("KAPERMAG3ERR"), fmt="k,", elinewidth=0.3)
+    if matches is not None:
+        candidates = table[matches["bd_candidate"].values]
+        ax.plot(candidates["HMKPNT"], candidates["KAPERMAG3"], candidate_style,
+                ms=6, mec="w", label="brown dwarf candidates")
+
+    ax.set_xlabel("H-K")
+    ax.set_ylabel("K mag")
+    if not ax.yaxis_inverted():
+        ax.invert_yaxis()
+    return ax
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Match per-source tables to isochrones on the K vs H-K CMD.")
+    parser.add_argument("tables", nargs="+", help="pickled per-source tables (e.g. pipeline outputs)")
+    parser.add_argument("--isochrones", nargs="+", required=True, help="MIST .iso.cmd files")
+    parser.add_argument("--distance-modulus", type=float, nargs="+", required=True)
+    parser.add_argument("--max-mass", type=float, default=3.0)
+    parser.add_argument("--bd-limit", type=float, nargs=2, default=None, metavar=("HMK", "K"),
+                        help="apparent brown dwarf limit to use instead of each isochrone's "
+                             "point at 0.075 solar masses")
+    parser.add_argument("--age-column", default=None,
+                        help=f"the isochrones' age column (default: the first of {', '.join(age_columns)})")
+    parser.add_argument("-o", "--output", default=None, help="write the matches here as csv")
+    args = parser.parse_args(argv)
+
+    grid = IsochroneGrid.from_mist(args.isochrones, args.distance_modulus, max_mass=args.max_mass,
+                                   age_column=args.age_column, bd_limit=args.bd_limit)
+    clipped = grid.tracks["bd_limit_clipped"]
+    if clipped.any():
+        print(f"{clipped.sum()} of {len(clipped)} tracks stop above {bd_mass_limit} solar masses; "
+              "their brown dwarf limit is their lowest-mass point (see --bd-limit)", file=sys.stderr)
+
+    tables = {filename: pd.read_pickle(filename) for filename in args.tables}
+    table = pd.concat(tables, names=["table"])
+    matches = classify(table, grid)
+
+    print(matches.groupby(level="table")["bd_candidate"].sum().to_string(), file=sys.stderr)
+    if args.output is not None:
+        matches.to_csv(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
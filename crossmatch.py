@@ -0,0 +1,359 @@
+"""
+Positional cross-matching: between the variable_means tables of overlapping
+WSERV fields (so a source observed in two releases is counted once), and
+between those tables and external catalogs kept as local files.
+
+Positions go into a KD-tree as unit vectors on the sphere, where a radius
+on the sky is a fixed chord length, so matching has no trouble at the poles
+or at RA = 0 and every query is a tree lookup rather than a loop over the
+other catalog. A catalog's index is saved next to it and reused until the
+file changes.
+
+    python crossmatch.py prepped/WSERV8_variable_means.pkl prepped/WSERV11_variable_means.pkl \\
+        --radius 1 --catalog ic348_members.csv --catalog-unit deg -o matches.csv
+
+The WSERV tables have RA and DEC in radians; external catalogs are usually in
+degrees (unit="deg").
+
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import instrument
+from instrument import instrumented
+from wserv_io import _source_stamp
+
+arcsec = np.pi / (180 * 3600)
+
+index_version = 1
+
+
+def to_radians(values, unit="rad"):
+    values = np.asarray(values, dtype=np.float64)
+    if unit == "rad":
+        return values
+    if unit == "deg":
+        return np.radians(values)
+    raise ValueError(f"Unknown angle unit {unit!r}; use 'rad' or 'deg'")
+
+
+def unit_vectors(ra, dec):
+    """ (n, 3) unit vectors for RA, DEC in radians. """
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+def chord(radius):
+    """ The straight-line distance between unit vectors `radius` radians apart on the sky. """
+    return 2 * np.sin(np.asarray(radius) / 2)
+
+
+def separation(chord_length):
+    """ The angle (radians) on the sky between unit vectors `chord_length` apart. """
+    return 2 * np.arcsin(np.clip(np.asarray(chord_length) / 2, 0, 1))
+
+
+class SkyIndex:
+    """
+    A KD-tree over sky positions, for radius matching.
+
+    Attributes
+    ----------
+    ids : pd.Index
+        The label of each position (e.g. SOURCEID, or a catalog's index).
+    ra, dec : np.ndarray
+        Radians.
+    tree : cKDTree
+        Over the positions' unit vectors.
+
+    """
+
+    def __init__(self, ra, dec, ids=None, tree=None):
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.ids = pd.RangeIndex(len(self.ra)) if ids is None else pd.Index(ids)
+        if tree is None:
+            tree = cKDTree(unit_vectors(self.ra, self.dec))
+        self.tree = tree
+
+    @classmethod
+    def from_table(cls, table, ra="RA", dec="DEC", unit="rad"):
+        """ An index of a table's positions, labelled by its index. Rows without a position are left out. """
+
+        ra_values = to_radians(table[ra].values, unit)
+        dec_values = to_radians(table[dec].values, unit)
+        good = np.isfinite(ra_values) & np.isfinite(dec_values)
+        return cls(ra_values[good], dec_values[good], table.index[good])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, path, **stamp):
+        """ Pickles the index (tree included), with any `stamp` entries to check on load. """
+        pd.to_pickle({"version": index_version, "stamp": stamp, "ra": self.ra, "dec": self.dec,
+                      "ids": self.ids, "tree": self.tree}, path)
+
+    @classmethod
+    def load(cls, path, **stamp):
+        """ An index saved by save, or None if it is missing or its stamp differs from `stamp`. """
+
+        try:
+            saved = pd.read_pickle(path)
+        except (OSError, EOFError, ValueError):
+            return None
+        if saved.get("version") != index_version or saved.get("stamp") != stamp:
+            return None
+        return cls(saved["ra"], saved["dec"], saved["ids"], saved["tree"])
+
+    @instrumented("sky_nearest")
+    def nearest(self, ra, dec, radius):
+        """
+        The nearest indexed position to each of the given ones, within
+        `radius` radians.
+
+        Returns
+        -------
+        position : np.ndarray
+            Into this index (-1 where nothing is within the radius).
+        separation : np.ndarray
+            Radians (NaN where nothing is within the radius).
+
+        """
+
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        instrument.note(n_sources=len(ra), n_index=len(self))
+
+        position = np.full(len(ra), -1, dtype=np.int64)
+        sep = np.full(len(ra), np.nan)
+        good = np.isfinite(ra) & np.isfinite(dec)
+        if not len(self) or not good.any():
+            return position, sep
+
+        distance, found = self.tree.query(unit_vectors(ra[good], dec[good]), k=1,
+                                          distance_upper_bound=chord(radius))
+        hit = np.isfinite(distance)
+        position[np.flatnonzero(good)[hit]] = found[hit]
+        sep[np.flatnonzero(good)[hit]] = separation(distance[hit])
+        return position, sep
+
+    @instrumented("sky_pairs")
+    def pairs(self, other, radius):
+        """
+        Every pair of positions (one from this index, one from `other`)
+        within `radius` radians, as arrays of positions into each index and
+        their separations (radians).
+        """
+
+        instrument.note(n_sources=len(other), n_index=len(self))
+        if not len(self) or not len(other):
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, np.array([])
+
+        found = self.tree.sparse_distance_matrix(other.tree, chord(radius), output_type="ndarray")
+        order = np.lexsort((found["j"], found["i"]))
+        found = found[order]
+        return found["i"].astype(np.int64), found["j"].astype(np.int64), separation(found["v"])
+
+    def self_pairs(self, radius):
+        """ Every pair of distinct positions within `radius` radians of each other (i < j). """
+        found = self.tree.query_pairs(chord(radius), output_type="ndarray")
+        i, j = found[:, 0].astype(np.int64), found[:, 1].astype(np.int64)
+        ci, cj = unit_vectors(self.ra[i], self.dec[i]), unit_vectors(self.ra[j], self.dec[j])
+        return i, j, separation(np.linalg.norm(ci - cj, axis=1))
+
+
+def read_catalog(filename):
+    """ A local catalog file (.fits, .pkl or csv-like) as a DataFrame. """
+
+    if filename.endswith((".fits", ".fit", ".fits.gz")):
+        from astropy.table import Table
+
+        return Table.read(filename).to_pandas()
+    if filename.endswith(".pkl"):
+        return pd.read_pickle(filename)
+    return pd.read_csv(filename, sep=None, engine="python")
+
+
+def index_path(filename):
+    return str(filename) + ".skyindex.pkl"
+
+
+def catalog_index(filename, ra="RA", dec="DEC", unit="rad", path=None):
+    """
+    The SkyIndex of a local catalog file, from the index saved next to it
+    (index_path) unless the file or the columns used have changed since.
+
+    Returns the index and the catalog.
+    """
+
+    if path is None:
+        path = index_path(filename)
+    catalog = read_catalog(filename)
+    stamp = {**_source_stamp(filename), "ra": ra, "dec": dec, "unit": unit}
+
+    index = SkyIndex.load(path, **stamp)
+    if index is None:
+        index = SkyIndex.from_table(catalog, ra, dec, unit)
+        index.save(path, **stamp)
+    return index, catalog
+
+
+def crossmatch(table, catalog, radius_arcsec=1.0, ra="RA", dec="DEC", unit="rad",
+               catalog_ra="RA", catalog_dec="DEC", catalog_unit="rad", nearest=True):
+    """
+    Matches the sources of `table` to those of `catalog` within a radius.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        E.g. a variable_means table (RA, DEC in radians).
+    catalog : pd.DataFrame or SkyIndex
+        A catalog, or its index (see catalog_index).
+    radius_arcsec : float, optional
+    ra, dec, unit : optional
+        `table`'s position columns and their unit ("rad" or "deg").
+    catalog_ra, catalog_dec, catalog_unit : optional
+        The same for `catalog`, if it is a DataFrame.
+    nearest : bool, optional
+        Only each source's nearest match (default), rather than every
+        catalog source within the radius.
+
+    Returns
+    -------
+    matches : pd.DataFrame
+        One row per match: the `table` index label ("source"), the catalog
+        index label ("match") and the separation in arcsec, sorted by
+        source.
+
+    """
+
+    if not isinstance(catalog, SkyIndex):
+        catalog = SkyIndex.from_table(catalog, catalog_ra, catalog_dec, catalog_unit)
+    radius = radius_arcsec * arcsec
+
+    if nearest:
+        position, sep = catalog.nearest(to_radians(table[ra].values, unit),
+                                        to_radians(table[dec].values, unit), radius)
+        hit = position >= 0
+        return pd.DataFrame({
+            "source": table.index[hit],
+            "match": catalog.ids[position[hit]],
+            "separation": sep[hit] / arcsec,
+        })
+
+    sources = SkyIndex.from_table(table, ra, dec, unit)
+    i, j, sep = sources.pairs(catalog, radius)
+    return pd.DataFrame({"source": sources.ids[i], "match": catalog.ids[j], "separation": sep / arcsec})
+
+
+@instrumented("deduplicate")
+def deduplicate(tables, radius_arcsec=1.0, ra="RA", dec="DEC", unit="rad"):
+    """
+    Finds the sources that appear in more than one of several fields'
+    tables (overlapping WSERV releases), by position.
+
+    Matching is one-to-one: the fields are taken in order, and each source
+    of a field is matched to its nearest distinct source of the earlier
+    fields (the primaries so far) within `radius_arcsec`. A primary takes at
+    most one source of each field, the nearest; any others, like the
+    unmatched sources, are new primaries. So sources of the same field are
+    always distinct, however close, and a source can't join two others into
+    one group. Sources without a position are left out.
+
+    Parameters
+    ----------
+    tables : dict
+        Field name -> table (e.g. variable_means), in order of preference.
+
+    Returns
+    -------
+    sources : pd.DataFrame
+        Indexed by (field, SOURCEID): `group` (a number shared by a source's
+        duplicates), `n_fields` (how many fields the group is in) and
+        `primary` (True for the one row per group to keep, from the earliest
+        of its fields).
+
+    """
+
+    combined = pd.concat({name: table[[ra, dec]] for name, table in tables.items()})
+    combined.index = combined.index.set_names("field", level=0)
+    combined = combined.dropna()
+    field_rank = pd.Index(list(tables)).get_indexer(combined.index.get_level_values(0))
+    ra_all = to_radians(combined[ra].values, unit)
+    dec_all = to_radians(combined[dec].values, unit)
+    radius = radius_arcsec * arcsec
+
+    n = len(combined)
+    # the primary (a row of `combined`) each row is a duplicate of, or itself
+    group = np.arange(n)
+    primaries = np.array([], dtype=np.int64)
+    for rank in range(len(tables)):
+        rows = np.flatnonzero(field_rank == rank)
+        if primaries.size and rows.size:
+            index = SkyIndex(ra_all[primaries], dec_all[primaries])
+            position, sep = index.nearest(ra_all[rows], dec_all[rows], radius)
+            hit = np.flatnonzero(position >= 0)
+            # each primary takes only its nearest source of this field
+            hit = hit[np.lexsort((sep[hit], position[hit]))]
+            first = np.ones(hit.size, dtype=bool)
+            first[1:] = position[hit][1:] != position[hit][:-1]
+            matched = hit[first]
+            group[rows[matched]] = primaries[position[matched]]
+            new = np.ones(rows.size, dtype=bool)
+            new[matched] = False
+            rows = rows[new]
+        primaries = np.concatenate([primaries, rows])
+
+    primary = group == np.arange(n)
+    group = pd.factorize(group)[0]
+    fields_in_group = np.bincount(group)
+
+    instrument.note(n_sources=n, n_duplicates=int(n - primary.sum()))
+    return pd.DataFrame(
+        {"group": group, "n_fields": fields_in_group[group], "primary": primary},
+        index=combined.index,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cross-match per-source tables by position.")
+    parser.add_argument("tables", nargs="+", help="pickled per-source tables (e.g. pipeline outputs)")
+    parser.add_argument("--radius", type=float, default=1.0, help="match radius, arcsec")
+    parser.add_argument("--catalog", default=None, help="a local catalog (.fits, .pkl or csv) to match to")
+    parser.add_argument("--catalog-ra", default="RA")
+    parser.add_argument("--catalog-dec", default="DEC")
+    parser.add_argument("--catalog-unit", default="rad", choices=["rad", "deg"])
+    parser.add_argument("-o", "--output", default=None, help="write the results here as csv")
+    args = parser.parse_args(argv)
+
+    tables = {}
+    for filename in args.tables:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if name in tables:
+            raise ValueError(f"Two tables are both named {name!r}; rename one of them.")
+        tables[name] = pd.read_pickle(filename)
+    sources = deduplicate(tables, args.radius)
+    print(f"{len(sources)} sources, {int(sources['primary'].sum())} distinct", file=sys.stderr)
+
+    if args.catalog is not None:
+        index, _ = catalog_index(args.catalog, args.catalog_ra, args.catalog_dec, args.catalog_unit)
+        positions = pd.concat(tables)[["RA", "DEC"]]
+        matches = crossmatch(positions.loc[sources.index[sources["primary"]]], index, args.radius)
+        print(f"{len(matches)} matched to {args.catalog}", file=sys.stderr)
+        matches.index = pd.MultiIndex.from_tuples(matches.pop("source"), names=sources.index.names)
+        sources = sources.join(matches)
+
+    if args.output is not None:
+        sources.to_csv(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,317 @@
+"""
+Cached false-alarm-probability calibration tables for the shared-grid
+period search.
+
+Rather than calling ls.false_alarm_probability() for every star and band,
+we bootstrap the distribution of the periodogram's peak power once per
+field for each (band, number of points, baseline) bucket on the field's
+frequency grid, save it to disk, and look FAPs up from it afterwards.
+This makes bootstrap-quality FAPs about as cheap as the analytic ones.
+
+"""
+
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+
+from stetson_2020 import (
+    source_columns,
+    field_epochs,
+    field_frequency_grid,
+    shared_grid_basis,
+    shared_grid_power,
+)
+
+
+def frequency_hash(frequency):
+    """ A short fingerprint of a frequency grid, so tables can't be used with the wrong one. """
+    return hashlib.sha1(np.ascontiguousarray(frequency, dtype=np.float64).tobytes()).hexdigest()[:16]
+
+
+class FAPTables:
+    """
+    Bootstrap peak-power distributions for one frequency grid, bucketed by
+    band, number of points and baseline.
+
+    Attributes
+    ----------
+    grid_hash : str
+        frequency_hash() of the grid the tables were made for.
+    n_step : int
+        Bucket width in number of points.
+    baseline_step : float
+        Bucket width in baseline (days).
+    maxima : dict
+        (band, n_bucket, baseline_bucket) -> sorted array of bootstrap peak
+        powers.
+    parameters : dict
+        The other build_fap_tables settings the tables were made with
+        (bands, epoch_tol, n_bootstraps, n_templates, min_points), so
+        field_fap_tables can tell when they're stale.
+
+    """
+
+    # bumped when the saved layout changes, so old tables get rebuilt
+    version = 3
+
+    def __init__(self, grid_hash, n_step=10, baseline_step=50.0, maxima=None, parameters=None):
+        self.grid_hash = grid_hash
+        self.n_step = int(n_step)
+        self.baseline_step = float(baseline_step)
+        self.maxima = {} if maxima is None else maxima
+        self.parameters = {} if parameters is None else parameters
+
+    def bucket(self, band, n, baseline):
+        return (band.upper(), int(round(n / self.n_step)), int(round(baseline / self.baseline_step)))
+
+    def check_grid(self, frequency):
+        if frequency_hash(frequency) != self.grid_hash:
+            raise ValueError("These FAP tables were made for a different frequency grid.")
+
+    def fap(self, band, n, baseline, power):
+        """
+        Bootstrap false alarm probability of a peak `power` for a star with
+        `n` points in `band` over `baseline` days. Falls back to the nearest
+        bucket of the same band if there's no exact one: the nearest
+        baseline, and the nearest n at that baseline. Raises ValueError if
+        there are no tables for the band at all.
+        """
+
+        key = self.bucket(band, n, baseline)
+        maxima = self.maxima.get(key)
+
+        if maxima is None:
+            candidates = [other for other in self.maxima if other[0] == key[0]]
+            if not candidates:
+                raise ValueError(f"These FAP tables have nothing for the {key[0]} band.")
+            nearest = min(candidates, key=lambda c: (abs(c[2] - key[2]), abs(c[1] - key[1])))
+            maxima = self.maxima[nearest]
+
+        # same convention as astropy's bootstrap FAP
+        return 1 - np.searchsorted(maxima, power) / len(maxima)
+
+    def save(self, path):
+        keys = sorted(self.maxima)
+        # an open file, so that numpy doesn't tack ".npz" onto `path`
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                version=self.version,
+                grid_hash=np.array(self.grid_hash),
+                n_step=self.n_step,
+                baseline_step=self.baseline_step,
+                parameters=np.array(json.dumps(self.parameters, sort_keys=True)),
+                bands=np.array([key[0] for key in keys], dtype=str),
+                keys=np.array([key[1:] for key in keys], dtype=np.int64).reshape(-1, 2),
+                maxima=np.array([self.maxima[key] for key in keys]),
+            )
+
+    @classmethod
+    def load(cls, path):
+        """ Tables saved by save, or None if they were saved in an older layout. """
+        with np.load(path) as f:
+            if 'version' not in f.files or int(f['version']) != cls.version:
+                return None
+            maxima = {(band,) + tuple(key): values
+                      for band, key, values in zip(f['bands'].tolist(), f['keys'].tolist(), f['maxima'])}
+            return cls(str(f['grid_hash']), int(f['n_step']), float(f['baseline_step']), maxima,
+                       json.loads(str(f['parameters'])))
+
+
+def bootstrap_peak_powers(basis, epoch_index, y, dy, n_bootstraps=1000,
+                          chunksize=256, random_seed=None):
+    """
+    Peak Lomb-Scargle powers of bootstrap resamplings of one light curve
+    (magnitudes and errors resampled with replacement, times held fixed,
+    as in astropy's bootstrap FAP), evaluated on the shared grid as one
+    matrix product per chunk of resamplings.
+
+    Parameters
+    ----------
+    basis : dict
+        From stetson_2020.shared_grid_basis.
+    epoch_index : array_like
+        Epoch index of each (good) point.
+    y, dy : array_like
+        Magnitudes and errors of the good points.
+    n_bootstraps : int, optional
+    chunksize : int, optional
+        Number of resamplings per matrix product.
+    random_seed : int, optional
+
+    Returns
+    -------
+    maxima : np.ndarray
+        Sorted peak powers, one per resampling.
+
+    """
+
+    rng = np.random.default_rng(random_seed)
+    epoch_index = np.asarray(epoch_index)
+    y = np.asarray(y, dtype=np.float64)
+    dy = np.asarray(dy, dtype=np.float64)
+
+    n = y.size
+    n_epochs = basis['epochs'].size
+
+    maxima = []
+    for i in range(0, n_bootstraps, chunksize):
+        n_chunk = min(chunksize, n_bootstraps - i)
+        s = rng.integers(0, n, (n_chunk, n))
+
+        wt = 1 / dy[s] ** 2
+        ys = y[s]
+        cell = (np.arange(n_chunk)[:, None] * n_epochs + epoch_index[None, :]).ravel()
+        size = n_chunk * n_epochs
+
+        w = np.bincount(cell, weights=wt.ravel(), minlength=size).reshape(n_chunk, n_epochs)
+        wy = np.bincount(cell, weights=(wt * ys).ravel(), minlength=size).reshape(n_chunk, n_epochs)
+        wyy = np.bincount(cell, weights=(wt * ys * ys).ravel(), minlength=size).reshape(n_chunk, n_epochs)
+
+        power = shared_grid_power(basis, w, wy, wyy)
+        maxima.append(np.nanmax(power, axis=1))
+
+    return np.sort(np.concatenate(maxima))
+
+
+def bucket_members(tables, t, columns, starts, counts, bands="JHK", min_points=3):
+    """
+    The light curves in each of `tables`' (band, n, baseline) buckets, as
+    slices of the source_columns rows; those with fewer than `min_points`
+    good points are left out.
+    """
+
+    members = {}
+    for band in bands:
+        good_all = ~np.isnan(columns[band.upper()+'APERMAG3']) & ~np.isnan(columns[band.upper()+'APERMAG3ERR'])
+        for start, count in zip(starts, counts):
+            sl = slice(start, start + count)
+            good = good_all[sl]
+            n = good.sum()
+            if n < min_points:
+                continue
+            t_good = t[sl][good]
+            key = tables.bucket(band, n, t_good.max() - t_good.min())
+            members.setdefault(key, []).append(sl)
+    return members
+
+
+def build_fap_tables(df, bands="JHK", frequency=None, epoch_tol=0.01,
+                     n_step=10, baseline_step=50.0, n_bootstraps=1000,
+                     n_templates=8, min_points=3, random_seed=None):
+    """
+    Makes the FAP tables for one field: every (star, band) light curve is
+    put in a (band, n, baseline) bucket, and each bucket is calibrated by
+    pooling the bootstrap resamplings of up to `n_templates` of its light
+    curves, drawn at random, so that no one gappy or truly variable
+    template sets the FAPs of the whole bucket.
+
+    Parameters
+    ----------
+    df : pd.DataFrame or IndexedPhotometry
+        Photometry, one row per SOURCEID per epoch.
+    bands : str, optional
+    frequency : array_like, optional
+        The grid the period search will use. Default: field_frequency_grid.
+    epoch_tol : float, optional
+        Epoch merging tolerance in days; should match the period search.
+    n_step, baseline_step : optional
+        Bucket widths.
+    n_bootstraps : int, optional
+        Resamplings per bucket, shared between its templates.
+    n_templates : int, optional
+        Light curves bootstrapped per bucket (fewer if it has fewer).
+    min_points : int, optional
+        Light curves with fewer good points are skipped.
+    random_seed : int, optional
+
+    Returns
+    -------
+    tables : FAPTables
+
+    """
+
+    mag_names = [band.upper()+'APERMAG3' for band in bands]
+    err_names = [band.upper()+'APERMAG3ERR' for band in bands]
+    ids, starts, counts, columns = source_columns(df, ['MEANMJDOBS'] + mag_names + err_names)
+
+    t = columns['MEANMJDOBS'].astype(np.float64)
+    epochs, epoch_index = field_epochs(t, epoch_tol)
+    if frequency is None:
+        frequency = field_frequency_grid(t, epoch_tol=epoch_tol)
+    basis = shared_grid_basis(epochs, frequency)
+
+    parameters = {"bands": bands.upper(), "epoch_tol": epoch_tol, "n_bootstraps": n_bootstraps,
+                  "n_templates": n_templates, "min_points": min_points}
+    tables = FAPTables(frequency_hash(frequency), n_step, baseline_step, parameters=parameters)
+    rng = np.random.default_rng(random_seed)
+    members = bucket_members(tables, t, columns, starts, counts, bands, min_points)
+
+    for band in bands:
+        y_all = columns[band.upper()+'APERMAG3'].astype(np.float64)
+        dy_all = columns[band.upper()+'APERMAG3ERR'].astype(np.float64)
+        good_all = ~np.isnan(y_all) & ~np.isnan(dy_all)
+
+        for key, slices in members.items():
+            if key[0] != band.upper():
+                continue
+            chosen = rng.choice(len(slices), max(1, min(n_templates, len(slices), n_bootstraps)), replace=False)
+            sizes = np.full(len(chosen), n_bootstraps // len(chosen))
+            sizes[:n_bootstraps % len(chosen)] += 1
+
+            maxima = []
+            for i, size in zip(chosen, sizes):
+                sl = slices[i]
+                good = good_all[sl]
+                maxima.append(bootstrap_peak_powers(
+                    basis, epoch_index[sl][good], y_all[sl][good], dy_all[sl][good],
+                    n_bootstraps=int(size), random_seed=rng.integers(2**32),
+                ))
+            tables.maxima[key] = np.sort(np.concatenate(maxima))
+
+    return tables
+
+
+def field_fap_tables(df, path, **kwargs):
+    """
+    Loads a field's FAP tables from `path` if they exist, were made for
+    the same frequency grid with the same settings, and have a bucket for
+    every light curve of `df`; otherwise builds them with
+    build_fap_tables(df, **kwargs) and saves them there.
+    """
+
+    settings = {name: parameter.default
+                for name, parameter in inspect.signature(build_fap_tables).parameters.items()
+                if parameter.default is not inspect.Parameter.empty}
+    settings.update(kwargs)
+
+    frequency = settings['frequency']
+    if frequency is None:
+        t = df.column('MEANMJDOBS') if hasattr(df, 'offsets') else df['MEANMJDOBS'].values
+        frequency = field_frequency_grid(t, epoch_tol=settings['epoch_tol'])
+        kwargs['frequency'] = frequency
+
+    if os.path.exists(path):
+        tables = FAPTables.load(path)
+        parameters = {"bands": settings['bands'].upper(), "epoch_tol": settings['epoch_tol'],
+                      "n_bootstraps": settings['n_bootstraps'], "n_templates": settings['n_templates'],
+                      "min_points": settings['min_points']}
+        if (tables is not None and tables.grid_hash == frequency_hash(frequency)
+                and tables.n_step == int(settings['n_step'])
+                and tables.baseline_step == float(settings['baseline_step'])
+                and tables.parameters == parameters):
+            bands = settings['bands']
+            names = ['MEANMJDOBS'] + [band.upper()+suffix for band in bands
+                                      for suffix in ('APERMAG3', 'APERMAG3ERR')]
+            _, starts, counts, columns = source_columns(df, names)
+            t = columns['MEANMJDOBS'].astype(np.float64)
+            members = bucket_members(tables, t, columns, starts, counts, bands, settings['min_points'])
+            if set(members) <= set(tables.maxima):
+                return tables
+
+    tables = build_fap_tables(df, **kwargs)
+    tables.save(path)
+    return tables
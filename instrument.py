@@ -0,0 +1,238 @@
+"""
+Per-stage timing and memory instrumentation for the data-prep flow.
+
+The pipeline's steps (the fits read, the cuts, the aggregates, Stetson S,
+chi^2, the period search) are wrapped in stages. Nothing is recorded unless
+a recorder is active, and then each stage records its wall and CPU time
+(child processes included), its peak RSS, and row and source counts; the
+per-source Lomb-Scargle searches are timed one by one, so the report can
+give percentiles and name the slowest sources.
+
+    with instrument.recording() as recorder:
+        results = process_field(photometry, config)
+    recorder.write("WSERV11_report.json")
+
+When no recorder is active, a stage costs one global lookup.
+
+"""
+
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+_recorder = None
+
+
+def _rusage_mb(who):
+    """ Lifetime peak RSS (MB) of this process or of its (waited-for) children. """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / 1024 ** 2 if sys.platform == "darwin" else maxrss / 1024
+
+
+def _reset_peak_rss():
+    """ Resets the kernel's RSS high-water mark, where Linux allows it. """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """ The RSS high-water mark (MB) since it was last reset, or the lifetime peak. """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _rusage_mb(resource.RUSAGE_SELF) if resource is not None else None
+
+
+def _children_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class Recorder:
+    """
+    Collects stage records and per-source timings.
+
+    Attributes
+    ----------
+    stages : list of dict
+        One record per finished stage, in the order they finished.
+    timings : dict
+        kind (e.g. "periodogram") -> list of (SOURCEID, band, seconds,
+        n_points) tuples.
+    slowest : int
+        How many of the slowest sources the report lists.
+
+    """
+
+    def __init__(self, slowest=20):
+        self.stages = []
+        self.timings = {}
+        self.slowest = slowest
+        self._open = []
+        self._can_reset = _reset_peak_rss()
+
+    def start(self, name, info):
+        record = {"stage": name, "parent": self._open[-1]["stage"] if self._open else None, **info}
+        record["_start"] = (time.perf_counter(), time.process_time(), _children_cpu())
+        record["_children_peak"] = 0.0
+        if self._can_reset:
+            # the high-water mark so far belongs to the enclosing stage:
+            # keep it before the reset hides it
+            if self._open:
+                peak = _peak_rss_mb()
+                if peak is not None:
+                    parent = self._open[-1]
+                    parent["_children_peak"] = max(parent["_children_peak"], peak)
+            _reset_peak_rss()
+        self._open.append(record)
+        return record
+
+    def finish(self, record):
+        wall0, cpu0, children0 = record.pop("_start")
+        record["wall_s"] = time.perf_counter() - wall0
+        record["cpu_s"] = (time.process_time() - cpu0) + (_children_cpu() - children0)
+
+        # resetting the high-water mark for a nested stage hides the outer
+        # stage's earlier peak, so the outer stage takes the max of its own
+        # reading, its children's and the readings taken before each child
+        # started (see start)
+        peak = _peak_rss_mb()
+        children_peak = record.pop("_children_peak")
+        if peak is not None:
+            record["peak_rss_mb"] = max(peak, children_peak) if self._can_reset else peak
+        if resource is not None:
+            record["children_peak_rss_mb"] = _rusage_mb(resource.RUSAGE_CHILDREN)
+
+        self._open.remove(record)
+        if self._open and record.get("peak_rss_mb") is not None:
+            parent = self._open[-1]
+            parent["_children_peak"] = max(parent["_children_peak"], record["peak_rss_mb"])
+        self.stages.append(record)
+
+    def note(self, **info):
+        if self._open:
+            self._open[-1].update(info)
+
+    def add_timings(self, kind, timings):
+        self.timings.setdefault(kind, []).extend(timings)
+
+    def report(self):
+        """ The report, as a json-serializable dict. """
+
+        report = {"stages": [_plain(record) for record in self.stages]}
+        for kind, timings in self.timings.items():
+            seconds = np.array([timing[2] for timing in timings], dtype=np.float64)
+            if not seconds.size:
+                continue
+            percentiles = np.percentile(seconds, [50, 90, 99])
+            report[kind] = {
+                "count": int(seconds.size),
+                "total_s": float(seconds.sum()),
+                "p50_s": float(percentiles[0]),
+                "p90_s": float(percentiles[1]),
+                "p99_s": float(percentiles[2]),
+                "max_s": float(seconds.max()),
+                "slowest": [
+                    {"SOURCEID": _plain(timings[i][0]), "band": timings[i][1],
+                     "seconds": float(timings[i][2]), "n_points": _plain(timings[i][3])}
+                    for i in np.argsort(seconds)[::-1][:self.slowest]
+                ],
+            }
+        return report
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+
+
+def _plain(value):
+    """ numpy scalars (and dicts of them) to plain python, for json. """
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+@contextmanager
+def recording(slowest=20):
+    """ Records every stage run inside the block; yields the Recorder. """
+
+    global _recorder
+    previous = _recorder
+    _recorder = Recorder(slowest=slowest)
+    try:
+        yield _recorder
+    finally:
+        _recorder = previous
+
+
+def active():
+    return _recorder is not None
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Records the block as a stage (if a recorder is active). Yields the
+    stage's record (or None), to which counts can be added; see also note.
+    """
+
+    recorder = _recorder
+    if recorder is None:
+        yield None
+        return
+
+    record = recorder.start(name, info)
+    try:
+        yield record
+    finally:
+        recorder.finish(record)
+
+
+def note(**info):
+    """ Adds counts (n_rows=..., n_sources=...) to the innermost open stage, if recording. """
+    if _recorder is not None:
+        _recorder.note(**info)
+
+
+def add_timings(kind, timings):
+    """ Adds per-source (SOURCEID, band, seconds, n_points) timings, if recording. """
+    if _recorder is not None:
+        _recorder.add_timings(kind, timings)
+
+
+def instrumented(name):
+    """ Decorator: runs the function as a stage called `name`. """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,260 @@
+"""
+A compact, array-backed collection of many sources' light curves.
+
+A LightCurveCollection holds the photometry as flat (ragged) arrays in
+SOURCEID order: float32 times and, per band, float32 magnitudes and errors,
+with a SOURCEID offset index into them, plus one row of metadata per source
+(RA, DEC) instead of a copy of it on every row. It has the same .ids,
+.offsets, .columns, .column(name), .star(sourceid) and .fingerprint as
+wserv_io.IndexedPhotometry, so the batch statistics and period search in
+stetson_2020, the quality cuts, the incremental updates, the stage cache and
+the plots in plots.py / render_atlas.py take it as they are. (It has no
+.data: code that needs the flat DataFrame calls to_dataframe.)
+
+With the default columns a collection takes 42 bytes per row, against 90 for
+the cleaned DataFrame read_wserv returns (float64 times, RA and DEC and an
+int64 SOURCEID on every row, and the colour columns).
+
+    collection = LightCurveCollection.from_dataframe(load_photometry(filename))
+    stetson = threeband_stetson_batch(collection)
+
+"""
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from wserv_io import default_columns, IndexedPhotometry
+
+# per-row columns kept besides the times, magnitudes and errors: the ones the
+# quality cuts need (see quality_cuts.tier_statistics)
+default_row_columns = ["JPPERRBITS", "HPPERRBITS", "KPPERRBITS", "MERGEDCLASS"]
+
+# the colour columns plots.plot_five_cmcc also needs
+color_columns = ["JMHPNT", "JMHPNTERR", "HMKPNT", "HMKPNTERR"]
+
+# per-source columns, taken from each source's first row
+default_metadata_columns = ["RA", "DEC"]
+
+
+def mag_column(band):
+    return f"{band.upper()}APERMAG3"
+
+
+def err_column(band):
+    return f"{band.upper()}APERMAG3ERR"
+
+
+class LightCurveCollection:
+    """
+    Light curves as flat arrays in SOURCEID order, with a CSR-style offset
+    index: source i is rows offsets[i]:offsets[i+1] of every array.
+
+    Times are stored as float32 days since `t0` (a whole MJD before the
+    first observation), which keeps them to ~20 s over a ten-year baseline;
+    column("MEANMJDOBS") gives them back as float64 MJDs.
+
+    Attributes
+    ----------
+    ids : np.ndarray
+        The unique SOURCEIDs, sorted.
+    offsets : np.ndarray
+        len(ids) + 1 row offsets.
+    t0 : float
+        MJD that `t` counts from.
+    t : np.ndarray
+        float32 days since t0, one per row.
+    mag, err : dict
+        band -> float32 array of magnitudes (errors), one per row; NaN where
+        the band has no measurement.
+    row_columns : dict
+        Column name -> array of any other per-row columns (flags,
+        MERGEDCLASS, ...), in their original dtypes.
+    metadata : pd.DataFrame
+        One row per source, indexed by SOURCEID.
+    fingerprint : str or None
+        A hash of the contents, if known (from_dataframe derives it from the
+        photometry's), for stage_cache.py.
+
+    """
+
+    def __init__(self, ids, offsets, t0, t, mag, err, row_columns=None, metadata=None,
+                 fingerprint=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.t0 = t0
+        self.t = t
+        self.mag = mag
+        self.err = err
+        self.row_columns = {} if row_columns is None else row_columns
+        if metadata is None:
+            metadata = pd.DataFrame(index=pd.Index(ids, name="SOURCEID"))
+        self.metadata = metadata
+        self.fingerprint = fingerprint
+        self._position = None
+
+    @classmethod
+    def from_dataframe(cls, data, bands="JHK", row_columns=None,
+                       metadata_columns=None, dtype=np.float32):
+        """
+        A collection from a photometry DataFrame or indexed photometry.
+
+        Magnitudes and errors that are already float32 in SOURCEID order (as
+        in the columnar cache) are used as they are, not copied, so a
+        collection made from memory-mapped photometry stays memory-mapped.
+
+        Parameters
+        ----------
+        data : pd.DataFrame or IndexedPhotometry
+        bands : str, optional
+        row_columns : list of str, optional
+            Other per-row columns to keep. Default: default_row_columns
+            (those of them `data` has). Add color_columns for plot_five_cmcc.
+        metadata_columns : list of str, optional
+            Columns that are constant per source, kept once per source.
+            Default: default_metadata_columns.
+        dtype : optional
+            Of the time, magnitude and error arrays.
+
+        Returns
+        -------
+        collection : LightCurveCollection
+
+        """
+
+        if not hasattr(data, "offsets"):
+            data = IndexedPhotometry.from_dataframe(data)
+        available = set(data.columns)
+        if row_columns is None:
+            row_columns = [name for name in default_row_columns if name in available]
+        if metadata_columns is None:
+            metadata_columns = [name for name in default_metadata_columns if name in available]
+
+        ids = np.asarray(data.ids)
+        offsets = np.asarray(data.offsets)
+
+        mjd = data.column("MEANMJDOBS")
+        t0 = float(np.floor(np.nanmin(mjd))) if mjd.size else 0.0
+        t = (mjd - t0).astype(dtype)
+
+        mag = {band: np.asarray(data.column(mag_column(band)), dtype=dtype) for band in bands}
+        err = {band: np.asarray(data.column(err_column(band)), dtype=dtype) for band in bands}
+
+        starts = offsets[:-1]
+        metadata = pd.DataFrame(
+            {name: data.column(name)[starts] for name in metadata_columns},
+            index=pd.Index(ids, name="SOURCEID"),
+        )
+
+        fingerprint = None
+        if getattr(data, "fingerprint", None) is not None:
+            # the same photometry kept the same way gives the same collection
+            fingerprint = hashlib.sha1(repr(
+                ["collection", data.fingerprint, bands, list(row_columns),
+                 list(metadata_columns), np.dtype(dtype).str]
+            ).encode()).hexdigest()
+
+        return cls(ids, offsets, t0, t, mag, err,
+                   {name: data.column(name) for name in row_columns}, metadata, fingerprint)
+
+    def to_dataframe(self):
+        """
+        The photometry as a flat DataFrame, in the column layout (and order)
+        of read_wserv. The magnitude, error and other per-row columns are
+        handed to pandas without a copy; MEANMJDOBS comes back at the
+        precision it was stored at.
+        """
+
+        names = sorted(self.columns, key=lambda name: default_columns.index(name)
+                       if name in default_columns else len(default_columns))
+        return pd.DataFrame({name: self.column(name) for name in names}, copy=False)
+
+    def to_photometry(self):
+        """ The photometry as wserv_io.IndexedPhotometry (see to_dataframe). """
+        return IndexedPhotometry(self.to_dataframe(), self.ids, self.offsets, self.fingerprint)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def bands(self):
+        return "".join(self.mag)
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def columns(self):
+        """ The names column() answers to, as in the DataFrame form. """
+        return (
+            ["SOURCEID", "MEANMJDOBS"]
+            + [mag_column(band) for band in self.mag]
+            + [err_column(band) for band in self.err]
+            + list(self.row_columns)
+            + list(self.metadata.columns)
+        )
+
+    def column(self, name):
+        """
+        One flat column by its WSERV name, in SOURCEID order: a view of the
+        stored array where there is one, else made on the fly (SOURCEID and
+        the metadata repeated per row, MEANMJDOBS as float64 MJDs).
+        """
+
+        for band in self.mag:
+            if name == mag_column(band):
+                return self.mag[band]
+            if name == err_column(band):
+                return self.err[band]
+        if name == "MEANMJDOBS":
+            return self.t.astype(np.float64) + self.t0
+        if name in self.row_columns:
+            return self.row_columns[name]
+        if name == "SOURCEID":
+            return np.repeat(self.ids, self.counts)
+        if name in self.metadata.columns:
+            return np.repeat(self.metadata[name].values, self.counts)
+        raise KeyError(f"{name} isn't in this collection (see from_dataframe's row_columns)")
+
+    def rows(self, sourceid):
+        """ The slice of the flat arrays holding this star's rows (O(1)). """
+
+        if self._position is None:
+            self._position = {sid: i for i, sid in enumerate(self.ids.tolist())}
+        i = self._position[sourceid]
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def star(self, sourceid):
+        """ One star's light curve as a small DataFrame, with the DataFrame form's columns. """
+
+        rows = self.rows(sourceid)
+        i = self._position[sourceid]
+        n = rows.stop - rows.start
+
+        data = {
+            "SOURCEID": np.full(n, self.ids[i]),
+            "MEANMJDOBS": self.t[rows].astype(np.float64) + self.t0,
+        }
+        for band in self.mag:
+            data[mag_column(band)] = self.mag[band][rows]
+            data[err_column(band)] = self.err[band][rows]
+        for name, values in self.row_columns.items():
+            data[name] = values[rows]
+        for name in self.metadata.columns:
+            data[name] = np.full(n, self.metadata[name].values[i])
+        return pd.DataFrame(data)
+
+    @property
+    def nbytes(self):
+        """ Memory held by the arrays and the metadata, in bytes. """
+
+        arrays = [self.ids, self.offsets, self.t, *self.mag.values(), *self.err.values(),
+                  *self.row_columns.values()]
+        return int(sum(np.asarray(x).nbytes for x in arrays)
+                   + self.metadata.memory_usage(deep=True).sum())
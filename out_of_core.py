@@ -0,0 +1,310 @@
+"""
+Out-of-core execution, for fields whose photometry doesn't fit in memory.
+
+The fits table is streamed in row chunks and split by SOURCEID range into
+partitions on disk, each small enough to process within a memory budget.
+Each partition is then cleaned, sorted and stored in the columnar layout of
+the photometry cache (see wserv_io.save_columns), and the pipeline is run
+on one partition at a time. All the per-source steps only ever look at one
+source's rows, so the partitions' results just concatenate into the
+results of the whole field.
+
+    python pipeline.py fields.json --memory-budget 8GB
+
+"""
+
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+import instrument
+from instrument import instrumented
+from pipeline import field_config, process_field
+from stetson_2020 import field_frequency_grid
+from wserv_io import (
+    default_columns,
+    clean_column,
+    IndexedPhotometry,
+    save_columns,
+    load_columns,
+    _source_stamp,
+)
+
+partitions_version = 1
+
+# processing a partition takes roughly this many times its in-memory size
+# (float64 copies of the columns and the per-row temporaries of the
+# segmented reductions)
+working_factor = 8
+
+
+def parse_memory_budget(budget):
+    """ A memory budget in bytes, from a number of bytes or a string like "8GB" / "512 MB". """
+
+    if budget is None or isinstance(budget, (int, float)):
+        return None if budget is None else int(budget)
+
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)B?\s*", str(budget).upper())
+    if match is None:
+        raise ValueError(f"Can't read a memory budget from {budget!r}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** "_KMGT".index(unit or "_"))
+
+
+def default_partition_dir(filename):
+    return str(filename) + ".partitions"
+
+
+class Partitions:
+    """
+    A field's photometry, split by SOURCEID range into separately stored
+    partitions.
+
+    Attributes
+    ----------
+    directory : str
+    manifest : dict
+        Including "partitions": a list of dicts with each partition's
+        subdirectory name, first SOURCEID, and numbers of rows and sources.
+
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.manifest["partitions"])
+
+    def load(self, i, columns=None, mmap_mode="r"):
+        """ Partition `i` as (memory-mapped) indexed photometry. """
+        partition = self.manifest["partitions"][i]
+        if columns is None:
+            columns = self.manifest["columns"]
+        return load_columns(
+            os.path.join(self.directory, partition["name"]), columns, partition["hashes"], mmap_mode
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.load(i)
+
+
+def _count_sources(table, chunk_rows):
+    """ The sorted unique SOURCEIDs of a fits table and their row counts, one chunk at a time. """
+
+    sourceid = table.field("SOURCEID")
+    ids = np.array([], dtype=np.int64)
+    counts = np.array([], dtype=np.int64)
+    for start in range(0, len(sourceid), chunk_rows):
+        chunk_ids, chunk_counts = np.unique(
+            np.asarray(sourceid[start:start + chunk_rows], dtype=np.int64), return_counts=True
+        )
+        ids, inverse = np.unique(np.concatenate([ids, chunk_ids]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([counts, chunk_counts]),
+                             minlength=len(ids)).astype(np.int64)
+    return ids, counts
+
+
+def partitions_are_current(filename, directory, columns, memory_budget):
+    try:
+        with open(os.path.join(directory, "partitions.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    current = (
+        manifest.get("version") == partitions_version
+        and set(columns) <= set(manifest.get("columns", []))
+        and manifest.get("memory_budget") == memory_budget
+        and all(manifest.get(key) == value for key, value in _source_stamp(filename).items())
+    )
+    return manifest if current else None
+
+
+@instrumented("partition_wserv")
+def partition_wserv(filename, memory_budget, directory=None, columns=default_columns, hdu=1):
+    """
+    Splits a WSERV fits file into SOURCEID-range partitions that can each
+    be processed within `memory_budget`, without ever holding the whole
+    table in memory. Reuses the partitions already in `directory` if they
+    were made from the same file with the same budget.
+
+    Three passes: count the rows of each SOURCEID (streaming just that
+    column), stream the table in chunks of the budget, cleaning each chunk
+    (wserv_io.clean_column) and appending its rows to their partitions'
+    files, and finally sort and index each partition on its own.
+
+    Parameters
+    ----------
+    filename : str
+    memory_budget : int or str
+        Bytes, or e.g. "8GB" (see parse_memory_budget).
+    directory : str, optional
+        Default: `filename` + ".partitions".
+    columns : list of str, optional
+    hdu : int, optional
+
+    Returns
+    -------
+    partitions : Partitions
+
+    """
+
+    memory_budget = parse_memory_budget(memory_budget)
+    if directory is None:
+        directory = default_partition_dir(filename)
+
+    manifest = partitions_are_current(filename, directory, columns, memory_budget)
+    if manifest is not None:
+        return Partitions(directory, manifest)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    with fits.open(filename, memmap=True) as hdulist:
+        table = hdulist[hdu].data
+        dtypes = {name: table.field(name).dtype.newbyteorder("=") for name in columns}
+        row_bytes = sum(dtype.itemsize for dtype in dtypes.values())
+
+        chunk_rows = max(1, memory_budget // (4 * row_bytes))
+        partition_rows = max(1, memory_budget // (working_factor * row_bytes))
+
+        ids, counts = _count_sources(table, chunk_rows)
+        first_row = np.cumsum(counts) - counts
+        # a source goes in the partition its first row falls in, so a
+        # partition never splits a source and holds at most one source
+        # more than partition_rows
+        source_partition = first_row // partition_rows
+        starts = np.flatnonzero(np.diff(source_partition, prepend=-1))
+        first_ids = ids[starts]
+        names = [f"part{i:05d}" for i in range(len(first_ids))]
+        for name in names:
+            os.makedirs(os.path.join(directory, name))
+
+        with instrument.stage("partition_rows", n_rows=len(table), n_partitions=len(names)):
+            for start in range(0, len(table), chunk_rows):
+                chunk = {}
+                for name in columns:
+                    column = table.field(name)[start:start + chunk_rows]
+                    values = np.empty(column.shape, dtype=dtypes[name])
+                    values[...] = column
+                    chunk[name] = clean_column(name, values)
+
+                part = np.searchsorted(first_ids, chunk["SOURCEID"], side="right") - 1
+                order = np.argsort(part, kind="stable")
+                present, bounds = np.unique(part[order], return_index=True)
+                bounds = np.append(bounds, len(order))
+                for p, lo, hi in zip(present, bounds[:-1], bounds[1:]):
+                    rows = order[lo:hi]
+                    for name in columns:
+                        with open(os.path.join(directory, names[p], name + ".bin"), "ab") as f:
+                            chunk[name][rows].tofile(f)
+
+    partitions = []
+    for i, name in enumerate(names):
+        part_dir = os.path.join(directory, name)
+        data = {}
+        for column in columns:
+            path = os.path.join(part_dir, column + ".bin")
+            data[column] = np.fromfile(path, dtype=dtypes[column])
+            os.remove(path)
+
+        photometry = IndexedPhotometry.from_dataframe(pd.DataFrame(data, copy=False))
+        hashes = save_columns(photometry, part_dir, columns)
+        partitions.append({
+            "name": name,
+            "first_id": int(first_ids[i]),
+            "n_rows": len(photometry.data),
+            "n_sources": len(photometry),
+            "hashes": hashes,
+        })
+        del data, photometry
+
+    # the manifest goes last, so half-written partitions are never "valid"
+    manifest = {
+        "version": partitions_version,
+        "source": os.path.abspath(filename),
+        "columns": list(columns),
+        "memory_budget": memory_budget,
+        "partitions": partitions,
+        **_source_stamp(filename),
+    }
+    with open(os.path.join(directory, "partitions.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    return Partitions(directory, manifest)
+
+
+def merge_results(parts):
+    """
+    The process_field results of the whole field, from those of its
+    partitions (which hold disjoint, increasing SOURCEID ranges).
+    """
+
+    def concat(key):
+        return pd.concat([part[key] for part in parts])
+
+    def index(key):
+        return pd.Index(np.concatenate([np.asarray(part[key]) for part in parts]),
+                        name=parts[0][key].name)
+
+    tiers = concat("tiers")
+    tiers.attrs = parts[0]["tiers"].attrs
+
+    q1_variables = [sid for part in parts for sid in part["q1_variables"]]
+    q2_variables = index("q2_variables")
+
+    return {
+        "tiers": tiers,
+        "stetson": concat("stetson"),
+        "q2_means": concat("q2_means"),
+        "chisq_red": concat("chisq_red"),
+        "chisq_eligible": concat("chisq_eligible"),
+        "q2_constants": index("q2_constants"),
+        "q2_variables": q2_variables,
+        "band_variables": {
+            band: pd.Index(np.concatenate([np.asarray(part["band_variables"][band]) for part in parts]))
+            for band in "JHK"
+        },
+        "q1_variables": q1_variables,
+        "q1and2_variables": q1_variables + list(q2_variables),
+        "periods": pd.concat([part["periods"] for part in parts], ignore_index=True),
+        "variable_means": concat("variable_means"),
+    }
+
+
+@instrumented("process_partitioned")
+def process_partitioned(partitions, config, cache=None):
+    """
+    pipeline.process_field over a field's partitions, one at a time, with
+    the per-source results merged (merge_results).
+
+    A shared-grid period search gets one frequency grid made from the
+    whole field's epochs, as process_field would use, unless the config
+    sets its own.
+    """
+
+    config = field_config(config)
+    search = config["period_search"]
+    if search.get("mode") == "shared_grid" and search.get("frequency") is None:
+        epoch_tol = search.get("epoch_tol", 0.01)
+        t = np.unique(np.concatenate([
+            np.unique(np.asarray(partitions.load(i, ["MEANMJDOBS"]).data["MEANMJDOBS"]))
+            for i in range(len(partitions))
+        ]))
+        frequency = field_frequency_grid(t, epoch_tol=epoch_tol)
+        config = {**config, "period_search": {**search, "frequency": frequency}}
+
+    parts = []
+    for i in range(len(partitions)):
+        with instrument.stage("partition", partition=i):
+            parts.append(process_field(partitions.load(i), config, cache))
+
+    return merge_results(parts)
@@ -0,0 +1,519 @@
+"""
+The data-prep pipeline (data_prep.py, data_prep_WSERV8.py) as a function of
+a field config, and a runner that processes many fields at once, one field
+per process, writing each field's variable_means table to disk.
+
+    python pipeline.py fields.json --output-dir prepped
+
+With --incremental, each field's per-source statistics are saved alongside
+its output and later runs only process the newly added nights. With
+--cache-dir, each step's results are cached by their inputs, parameters and
+code (see stage_cache.py), so that changing one threshold only reruns the
+steps after it. With --report, each field's per-step timings and memory use
+are written next to its output as <name>_report.json (see instrument.py).
+With --memory-budget (or a field's "memory_budget"), fields are split by
+SOURCEID range and processed a partition at a time (see out_of_core.py).
+With --period-engine pdm, the period search uses phase dispersion
+minimization instead of Lomb-Scargle (see stetson_2020.period_engines); the
+output table has the same layout, and with a shared --cache-dir a second run
+with the other engine only redoes the period search.
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import quality_cuts
+import stetson_2020
+from stetson_2020 import (
+    source_means,
+    threeband_stetson_batch,
+    threeband_chisq_red_batch,
+    period_search_batch,
+    band_period_fap,
+)
+from wserv_io import load_photometry
+from stage_cache import StageCache
+import instrument
+from quality_cuts import select_tiers
+
+# everything a field config can set; a config only needs "filename"
+default_config = {
+    "filename": None,
+    # default: the fits file's name up to the first "_", e.g. "WSERV11"
+    "name": None,
+    # select_tiers keyword arguments; anything missing comes from
+    # quality_cuts.default_cuts
+    "cuts": {},
+    # Q2 variables: Stetson S above this
+    "stetson_variable": 2.5,
+    # incremental runs: sources with S within this of stetson_variable get
+    # their S recomputed exactly (see incremental.update_field); None never
+    "stetson_exact_margin": 0.1,
+    # Q1 variables: reduced chi^2 above this in any band they pass
+    "chisq_variable": 3,
+    # Q2 constants: S below this, with mean J, H and K all strictly inside
+    # constant_mag_range
+    "stetson_constant": 0.5,
+    "constant_mag_range": (12, 14),
+    # period_search_batch keyword arguments (mode, adaptive, n_workers, ...)
+    "period_search": {},
+    # if set (bytes, or e.g. "8GB"), process the field out of core, in
+    # SOURCEID-range partitions that each fit in this much memory
+    "memory_budget": None,
+}
+
+
+def field_config(config):
+    """
+    A complete field config: `config` (a dict, or just a fits filename)
+    filled in from default_config. Unknown keys are an error, so that a
+    typo'd threshold can't be silently ignored.
+    """
+
+    if isinstance(config, str):
+        config = {"filename": config}
+
+    unknown = set(config) - set(default_config)
+    if unknown:
+        raise ValueError(f"Unknown field config keys: {sorted(unknown)}")
+
+    config = {**default_config, **config}
+    if config["filename"] is None:
+        raise ValueError("A field config needs a 'filename'.")
+    if config["name"] is None:
+        config["name"] = os.path.splitext(os.path.basename(config["filename"]))[0].split("_")[0]
+
+    return config
+
+
+# the code each cached step depends on (see stage_cache.py)
+_common_code = (
+    stetson_2020.source_columns,
+    stetson_2020.group_segments,
+    stetson_2020.segment_rows,
+)
+stage_code = {
+    "tiers": _common_code + (
+        quality_cuts.select_tiers,
+        quality_cuts.tier_statistics,
+        quality_cuts.apply_cuts,
+        stetson_2020.segment_count,
+        stetson_2020.segment_nanmin,
+        stetson_2020.segment_nanmax,
+        stetson_2020.segment_nanmedian,
+    ),
+    "stetson": _common_code + (
+        stetson_2020.threeband_stetson_batch,
+        stetson_2020.S_segments,
+        stetson_2020.segment_nanmean,
+        stetson_2020.segment_nansum,
+        stetson_2020.segment_count,
+    ),
+    "source_means": _common_code + (
+        stetson_2020.source_means,
+        stetson_2020.segment_nanmean,
+        stetson_2020.segment_nansum,
+        stetson_2020.segment_count,
+    ),
+    "chisq_red": _common_code + (
+        stetson_2020.threeband_chisq_red_batch,
+        stetson_2020.chisq_red_segments,
+    ),
+    "periods": _common_code + (
+        stetson_2020.period_search_batch,
+        stetson_2020._period_search_chunk,
+        stetson_2020.lombscargle_period,
+        stetson_2020.adaptive_frequency_search,
+        stetson_2020.pdm_period,
+        stetson_2020.pdm_theta,
+        stetson_2020.period_engine,
+        stetson_2020.multiband_period,
+        stetson_2020.shared_grid_period_search,
+        stetson_2020.field_frequency_grid,
+        stetson_2020.field_epochs,
+        stetson_2020.nearest_epoch,
+        stetson_2020.shared_grid_basis,
+        stetson_2020.shared_grid_sums,
+        stetson_2020.shared_grid_power,
+    ),
+}
+
+# period_search settings that change how fast, not what, it computes
+_period_search_runtime = ("n_workers", "chunksize", "mp_context")
+
+
+@instrument.instrumented("process_field")
+def process_field(photometry, config, cache=None):
+    """
+    Runs the data-prep steps on one field's photometry: the Q0/Q1/Q2 cuts,
+    Stetson S for the Q2 sources, reduced chi^2 for each band's Q1 sources,
+    the variable selection, and the period search of the variables.
+
+    Parameters
+    ----------
+    photometry : IndexedPhotometry or pd.DataFrame
+        One row per SOURCEID per epoch (see wserv_io.load_photometry).
+    config : dict
+        A field config (see default_config).
+    cache : stage_cache.StageCache, optional
+        If given, each step's result is looked up there (and stored) by
+        its input data, parameters and code.
+
+    Returns
+    -------
+    results : dict
+        tiers, stetson, q2_means, q2_constants, q2_variables, chisq_red,
+        chisq_eligible, band_variables (band -> SOURCEIDs), q1_variables,
+        q1and2_variables, periods and variable_means.
+
+    """
+
+    config = field_config(config)
+
+    def stage(name, compute, inputs):
+        with instrument.stage(f"process_field.{name}", cached=cache is not None):
+            if cache is None:
+                return compute()
+            value, hit = cache.lookup(name, compute, inputs, stage_code[name])
+            instrument.note(cache_hit=hit)
+            return value
+
+    tiers = stage(
+        "tiers",
+        lambda: select_tiers(photometry, **config["cuts"]),
+        [photometry, config["cuts"]],
+    )
+    q2_sourceids = tiers.index[tiers["q2"]]
+
+    stetson = stage(
+        "stetson",
+        lambda: threeband_stetson_batch(photometry, q2_sourceids),
+        [photometry, q2_sourceids],
+    )
+
+    mag_names = ["JAPERMAG3", "HAPERMAG3", "KAPERMAG3"]
+    q2_means = stage(
+        "source_means",
+        lambda: source_means(photometry, mag_names, q2_sourceids),
+        [photometry, mag_names, q2_sourceids],
+    )
+
+    eligible = {band: tiers[f"q{band.lower()}"] for band in "JHK"}
+    chisq_red, chisq_eligible = stage(
+        "chisq_red",
+        lambda: threeband_chisq_red_batch(photometry, eligible),
+        [photometry, eligible],
+    )
+
+    variables = select_variables(config, stetson, q2_means, chisq_red, chisq_eligible)
+    q1and2_variables = variables["q1and2_variables"]
+    variable_ids = np.sort(np.asarray(q1and2_variables, dtype=np.int64))
+
+    search_params = {
+        key: value for key, value in config["period_search"].items()
+        if key not in _period_search_runtime
+    }
+    periods = stage(
+        "periods",
+        lambda: period_search_batch(
+            photometry, q1and2_variables, bands="JHK", **config["period_search"]
+        ),
+        [photometry, variable_ids, search_params],
+    )
+
+    variable_means = stage(
+        "source_means",
+        lambda: source_means(photometry, sourceids=q1and2_variables),
+        [photometry, None, variable_ids],
+    )
+    for band in "JHK":
+        variable_means[f"{band}_periods"] = band_period_fap(periods, band)
+
+    return {
+        "tiers": tiers,
+        "stetson": stetson,
+        "q2_means": q2_means,
+        "chisq_red": chisq_red,
+        "chisq_eligible": chisq_eligible,
+        **variables,
+        "periods": periods,
+        "variable_means": variable_means,
+    }
+
+
+def select_variables(config, stetson, q2_means, chisq_red, chisq_eligible):
+    """
+    The variable selection step of process_field, on its already computed
+    statistics: the Q2 constants and variables from Stetson S (and the Q2
+    means), and each band's Q1 variables from the reduced chi^2.
+
+    Returns
+    -------
+    variables : dict
+        q2_constants, q2_variables, band_variables (band -> SOURCEIDs),
+        q1_variables and q1and2_variables.
+
+    """
+
+    bright, faint = config["constant_mag_range"]
+    in_range = ((q2_means > bright) & (q2_means < faint)).all(axis=1)
+    q2_constants = stetson.index[(stetson < config["stetson_constant"]) & in_range]
+    q2_variables = stetson.index[stetson > config["stetson_variable"]]
+
+    band_variables = {}
+    for band in "JHK":
+        band_chisq_red = chisq_red[band][chisq_eligible[band]]
+        band_variables[band] = band_chisq_red.index[band_chisq_red > config["chisq_variable"]]
+
+    q1_variables = list(
+        set().union(*band_variables.values()) - set(q2_variables)
+    )
+    q1and2_variables = list(q1_variables) + list(q2_variables)
+
+    return {
+        "q2_constants": q2_constants,
+        "q2_variables": q2_variables,
+        "band_variables": band_variables,
+        "q1_variables": q1_variables,
+        "q1and2_variables": q1and2_variables,
+    }
+
+
+def output_path(config, output_dir="."):
+    return os.path.join(output_dir, f"{config['name']}_variable_means.pkl")
+
+
+def run_field(config, output_dir=".", incremental=False, cache=None, report=False):
+    """
+    Loads one field (via the columnar cache, see wserv_io.load_photometry),
+    processes it, and pickles its variable_means table to `output_dir`.
+    Pickle rather than csv, since the *_periods columns hold
+    (best_period, fap) tuples.
+
+    With incremental=True, the field's per-source statistics are kept in
+    `output_dir` too (<name>_state.pkl), and each run only adds the rows
+    from nights after the last run to them (see incremental.py). Otherwise
+    `cache` (a stage_cache.StageCache) is passed on to process_field.
+
+    With report=True, the run's per-step timings and memory use are
+    written to <name>_report.json in `output_dir` (see instrument.py).
+
+    Returns the path written.
+    """
+
+    config = field_config(config)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if report:
+        with instrument.recording() as recorder:
+            with instrument.stage("run_field", field=config["name"]):
+                path = run_field(config, output_dir, incremental, cache)
+        recorder.write(os.path.join(output_dir, f"{config['name']}_report.json"))
+        return path
+
+    if config["memory_budget"] is not None:
+        if incremental:
+            raise ValueError("Incremental runs can't be combined with a memory_budget.")
+        from out_of_core import partition_wserv, process_partitioned
+
+        partitions = partition_wserv(config["filename"], config["memory_budget"])
+        results = process_partitioned(partitions, config, cache)
+        return write_output(results, config, output_dir)
+
+    photometry = load_photometry(config["filename"])
+    if incremental:
+        from incremental import FieldState, update_field
+
+        state_path = os.path.join(output_dir, f"{config['name']}_state.pkl")
+        state = FieldState.load(state_path) if os.path.exists(state_path) else FieldState()
+        state, results = update_field(state, state.new_rows(photometry), config, photometry)
+        state.save(state_path)
+    else:
+        results = process_field(photometry, config, cache)
+
+    return write_output(results, config, output_dir)
+
+
+def write_output(results, config, output_dir="."):
+    path = output_path(config, output_dir)
+    with instrument.stage("write_output", n_sources=len(results["variable_means"])):
+        results["variable_means"].to_pickle(path)
+    return path
+
+
+def run_fields(configs, output_dir=".", n_workers=None, mp_context=None,
+               progress=True, incremental=False, cache=None, report=False):
+    """
+    Runs run_field on every field config, one field per worker process.
+
+    Unless a config sets its own period_search n_workers, each field's
+    period search gets an equal share of the cores, so that the fields
+    running side by side don't oversubscribe the machine.
+
+    Parameters
+    ----------
+    configs : list of dict or str
+        Field configs (see default_config) or fits filenames.
+    output_dir : str, optional
+    n_workers : int, optional
+        Number of fields processed at once. Default: one per field, up to
+        os.cpu_count(). 1 processes the fields serially in this process.
+    mp_context : optional
+        As in stetson_2020.period_search_batch ("fork" where available).
+    progress : bool, optional
+        Print each field's output path (or failure) to stderr as it finishes.
+    incremental : bool, optional
+        Update each field's saved statistics with its new nights only (see
+        run_field).
+    cache : stage_cache.StageCache, optional
+        Cache of step results shared by all the fields (see process_field).
+    report : bool, optional
+        Write each field's timing and memory report (see run_field).
+
+    Returns
+    -------
+    written : dict
+        Field name -> path of its variable_means table.
+
+    Raises
+    ------
+    RuntimeError
+        If any field failed; the other fields are still run and written.
+
+    """
+
+    configs = [field_config(config) for config in configs]
+    names = [config["name"] for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Field names must be unique, got {names}")
+
+    n_cpus = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = min(len(configs), n_cpus)
+    n_workers = max(1, n_workers)
+
+    for config in configs:
+        if "n_workers" not in config["period_search"]:
+            config["period_search"] = {
+                **config["period_search"], "n_workers": max(1, n_cpus // n_workers)
+            }
+
+    written = {}
+    failed = {}
+
+    def finished(name, path=None, error=None):
+        if path is not None:
+            written[name] = path
+        else:
+            failed[name] = error
+        if progress:
+            message = path if error is None else f"FAILED: {error!r}"
+            print(f"{name}: {message}", file=sys.stderr)
+
+    if n_workers == 1 or len(configs) <= 1:
+        for config in configs:
+            try:
+                finished(config["name"], run_field(config, output_dir, incremental, cache, report))
+            except Exception as error:
+                finished(config["name"], error=error)
+    else:
+        if mp_context is None and "fork" in multiprocessing.get_all_start_methods():
+            mp_context = "fork"
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as pool:
+            futures = {
+                pool.submit(run_field, config, output_dir, incremental, cache, report): config["name"]
+                for config in configs
+            }
+            for future in as_completed(futures):
+                try:
+                    finished(futures[future], future.result())
+                except Exception as error:
+                    finished(futures[future], error=error)
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} field(s) failed: {failed}")
+
+    return {name: written[name] for name in names}
+
+
+def load_configs(path):
+    """
+    Field configs from a json file: a list of configs, or {"fields": [...]}.
+    Relative fits filenames are taken relative to the json file.
+    """
+
+    with open(path) as f:
+        configs = json.load(f)
+    if isinstance(configs, dict):
+        configs = configs["fields"]
+
+    base = os.path.dirname(os.path.abspath(path))
+    configs = [field_config(config) for config in configs]
+    for config in configs:
+        config["filename"] = os.path.join(base, config["filename"])
+
+    return configs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the WSERV data-prep pipeline over one or more fields."
+    )
+    parser.add_argument("config", help="json file of field configs (see pipeline.default_config)")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="where to write <name>_variable_means.pkl (default: .)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="fields processed at once (default: one per field, up to the core count)")
+    parser.add_argument("--fields", nargs="+", default=None, metavar="NAME",
+                        help="only run these fields")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process nights added since the last --incremental run")
+    parser.add_argument("--cache-dir", default=None,
+                        help="cache each step's results here, keyed by inputs, parameters and code")
+    parser.add_argument("--cache-size", type=float, default=2.0,
+                        help="size limit of --cache-dir in GB (default: 2)")
+    parser.add_argument("--memory-budget", default=None, metavar="SIZE",
+                        help="process each field out of core within this much memory, e.g. 8GB")
+    parser.add_argument("--period-engine", default=None, metavar="ENGINE",
+                        help="per-source period search: lombscargle (default) or pdm")
+    parser.add_argument("--report", action="store_true",
+                        help="write each field's timings and memory use to <name>_report.json")
+    args = parser.parse_args(argv)
+
+    configs = load_configs(args.config)
+    if args.fields is not None:
+        unknown = set(args.fields) - {config["name"] for config in configs}
+        if unknown:
+            parser.error(f"no such field(s) in {args.config}: {sorted(unknown)}")
+        configs = [config for config in configs if config["name"] in args.fields]
+    if args.memory_budget is not None:
+        for config in configs:
+            config["memory_budget"] = args.memory_budget
+    if args.period_engine is not None:
+        for config in configs:
+            config["period_search"] = {**config["period_search"], "engine": args.period_engine}
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = StageCache(args.cache_dir, max_bytes=int(args.cache_size * 1024 ** 3))
+
+    try:
+        run_fields(configs, args.output_dir, n_workers=args.workers,
+                   incremental=args.incremental, cache=cache, report=args.report)
+    except RuntimeError as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,32 @@ This is a quick module to grab data and plot a three-band light curve.
 import numpy as np
 import matplotlib.pyplot as plt
 
+from wserv_io import IndexedPhotometry
+
+
+def index_dataset(dataset):
+    """
+    Sorts and indexes a dataset by SOURCEID once, so that the plotting 
+    functions below can pull out each star's rows as an O(1) slice instead
+    of scanning the whole table.
+    """
+
+    if hasattr(dataset, "star"):
+        return dataset
+    return IndexedPhotometry.from_dataframe(dataset)
+
+
+def get_stardata(dataset, sourceid):
+    """
+    One star's rows of `dataset`, which can be a plain DataFrame (boolean 
+    scan, for ad-hoc use), an indexed one (see index_dataset) or a 
+    lightcurves.LightCurveCollection.
+    """
+
+    if hasattr(dataset, "star"):
+        return dataset.star(sourceid)
+    return dataset[dataset["SOURCEID"] == sourceid]
+
 
 def quickplot(dataset, sourceid, set_title=True):
     """
@@ -13,7 +39,7 @@ def quickplot(dataset, sourceid, set_title=True):
     """
 
     fig, ax = plt.subplots(1, figsize=(9, 4))
-    stardata = dataset[dataset["SOURCEID"] == sourceid]
+    stardata = get_stardata(dataset, sourceid)
 
     times = stardata["MEANMJDOBS"]
     j_mags = stardata["JAPERMAG3"]
@@ -40,7 +66,7 @@ def three_plot(dataset, sourceid, set_title=True):
     """
 
     fig, axes = plt.subplots(nrows=3, figsize=(9, 4))
-    stardata = dataset[dataset["SOURCEID"] == sourceid]
+    stardata = get_stardata(dataset, sourceid)
 
     times = stardata["MEANMJDOBS"]
     j_mags = stardata["JAPERMAG3"]
@@ -76,7 +102,7 @@ def phase_plot(df, sid, period, offset, set_title=True):
     """
 
     fig, axes = plt.subplots(nrows=3)
-    stardata = df[df["SOURCEID"] == sid]
+    stardata = get_stardata(df, sid)
 
     times = stardata["MEANMJDOBS"]
     phase = ((times % period) / period + offset) % 1.0
@@ -187,7 +213,7 @@ def plot_five_cmcc(df, sid, set_title=True):
     ax_jhk = fig.add_axes((0.65, bottom, 0.23, 0.375))
     ax_khk = fig.add_axes((0.65, bottom + 0.475, 0.23, 0.375))
 
-    stardata = df[df["SOURCEID"] == sid]
+    stardata = get_stardata(df, sid)
 
     times = stardata["MEANMJDOBS"]
     j_mags = stardata["JAPERMAG3"]
@@ -230,3 +256,49 @@ def plot_five_cmcc(df, sid, set_title=True):
 
     return fig
 
+
+
+def plot_many(dataset, sourceids, plot_function=three_plot, filename=None, 
+              star_kwargs=None, **kwargs):
+    """
+    Plots a list of stars with one of the functions above, indexing the 
+    dataset only once.
+
+    Parameters
+    ----------
+    dataset : pd.DataFrame, IndexedPhotometry or LightCurveCollection
+    sourceids : iterable
+    plot_function : callable, optional
+        Default three_plot. Any of quickplot, three_plot, phase_plot, 
+        plot_five_cmcc.
+    filename : str, optional
+        If given, each figure is saved to filename.format(i=i, sourceid=sid)
+        and closed, and the filenames are returned instead of the figures.
+    star_kwargs : dict, optional
+        sourceid -> dict of extra keyword arguments for that star only
+        (e.g. the period and offset for phase_plot); these override any
+        of the same name in **kwargs.
+    **kwargs
+        Passed to every call of `plot_function`.
+
+    Returns
+    -------
+    list of figures (or of filenames)
+
+    """
+
+    dataset = index_dataset(dataset)
+    star_kwargs = {} if star_kwargs is None else star_kwargs
+
+    outputs = []
+    for i, sid in enumerate(sourceids):
+        fig = plot_function(dataset, sid, **{**kwargs, **star_kwargs.get(sid, {})})
+
+        if filename is None:
+            outputs.append(fig)
+        else:
+            outputs.append(filename.format(i=i, sourceid=sid))
+            fig.savefig(outputs[-1])
+            plt.close(fig)
+
+    return outputs
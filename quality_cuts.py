@@ -0,0 +1,160 @@
+"""
+The Q0 / Q1 / Q2 quality-tier selection from the data-prep scripts, as one
+grouped pass over just the columns the cuts need.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from instrument import instrumented
+
+from stetson_2020 import (
+    source_columns,
+    segment_count,
+    segment_nanmin,
+    segment_nanmax,
+    segment_nanmedian,
+)
+
+# the thresholds used for WSERV8 and WSERV11
+default_cuts = {
+    "count_window": (60, 130),
+    "mag_limits": {"J": (10, 19), "H": (10, 18), "K": (10, 18)},
+    "mergedclass": (-1, -2),
+    "max_errbits": 0,
+    "q0_min_count": 60,
+}
+
+
+@instrumented("tier_statistics")
+def tier_statistics(data, bands="JHK"):
+    """
+    The per-source numbers the quality cuts look at, all from one grouped
+    pass over just the columns they need: per band the number of good
+    magnitudes, their min and max, and the max of the PPERRBITS flags; plus
+    the median MERGEDCLASS.
+
+    Parameters
+    ----------
+    data : pd.DataFrame or IndexedPhotometry
+        Photometry, one row per SOURCEID per epoch.
+    bands : str, optional
+
+    Returns
+    -------
+    stats : pd.DataFrame
+        Indexed by SOURCEID.
+
+    """
+
+    names = [f"{band}{suffix}" for band in bands for suffix in ("APERMAG3", "PPERRBITS")]
+    ids, starts, counts, columns = source_columns(data, names + ["MERGEDCLASS"])
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids))
+
+    stats = {}
+    for band in bands:
+        mag = columns[f"{band}APERMAG3"]
+        stats[f"{band}_count"] = segment_count(mag, starts)
+        stats[f"{band}_min"] = segment_nanmin(mag, starts)
+        stats[f"{band}_max"] = segment_nanmax(mag, starts)
+        stats[f"{band}_errbits"] = segment_nanmax(columns[f"{band}PPERRBITS"], starts)
+    stats["MERGEDCLASS_median"] = segment_nanmedian(columns["MERGEDCLASS"], starts, counts)
+
+    return pd.DataFrame(stats, index=pd.Index(ids, name="SOURCEID"))
+
+
+@instrumented("select_tiers")
+def select_tiers(df, count_window=None, mag_limits=None, mergedclass=None,
+                 max_errbits=None, q0_min_count=None, bands="JHK"):
+    """
+    Applies the quality cuts to every source.
+
+    A source passes in a band if its PPERRBITS never exceed `max_errbits`,
+    its number of good magnitudes is strictly inside `count_window`, its
+    magnitudes stay strictly inside that band's `mag_limits`, and its median
+    MERGEDCLASS is one of `mergedclass`. Q2 sources pass in every band, Q1
+    sources in some but not all, and Q0 sources have more than `q0_min_count`
+    good magnitudes in at least one band. Any threshold left as None takes
+    its value from `default_cuts`.
+
+    Parameters
+    ----------
+    df : pd.DataFrame or IndexedPhotometry
+        Photometry, one row per SOURCEID per epoch.
+    count_window : (int, int), optional
+    mag_limits : dict, optional
+        band -> (bright limit, faint limit)
+    mergedclass : sequence, optional
+    max_errbits : int, optional
+    q0_min_count : int, optional
+    bands : str, optional
+
+    Returns
+    -------
+    tiers : pd.DataFrame
+        Indexed by SOURCEID: the statistics from tier_statistics, the
+        boolean cut columns (qj, qh, qk, q0, q1, q2) and a `tier` label
+        ("Q2", "Q1", "Q0" or ""). The thresholds that were applied are in
+        tiers.attrs["cuts"].
+
+    """
+
+    return apply_cuts(
+        tier_statistics(df, bands),
+        count_window=count_window,
+        mag_limits=mag_limits,
+        mergedclass=mergedclass,
+        max_errbits=max_errbits,
+        q0_min_count=q0_min_count,
+        bands=bands,
+    )
+
+
+def apply_cuts(stats, count_window=None, mag_limits=None, mergedclass=None,
+               max_errbits=None, q0_min_count=None, bands="JHK"):
+    """
+    The cut half of select_tiers, for statistics that are already in hand
+    (from tier_statistics, or kept up to date some other way, e.g. by
+    incremental.py). Takes the same thresholds and returns the same table.
+    """
+
+    cuts = {
+        "count_window": count_window,
+        "mag_limits": mag_limits,
+        "mergedclass": mergedclass,
+        "max_errbits": max_errbits,
+        "q0_min_count": q0_min_count,
+    }
+    cuts = {key: default_cuts[key] if value is None else value for key, value in cuts.items()}
+
+    tiers = stats.copy()
+
+    lo_count, hi_count = cuts["count_window"]
+    good_class = np.isin(tiers["MERGEDCLASS_median"], cuts["mergedclass"])
+
+    for band in bands:
+        bright, faint = cuts["mag_limits"][band]
+        tiers[f"q{band.lower()}"] = (
+            (tiers[f"{band}_errbits"] <= cuts["max_errbits"])
+            & (tiers[f"{band}_count"] > lo_count)
+            & (tiers[f"{band}_count"] < hi_count)
+            & (tiers[f"{band}_min"] > bright)
+            & (tiers[f"{band}_max"] < faint)
+            & good_class
+        )
+
+    band_cuts = tiers[[f"q{band.lower()}" for band in bands]]
+    # anyone who is all 3 is a Q2 source!
+    tiers["q2"] = band_cuts.all(axis=1)
+    # anyone who is any of the 3 (but not all!) is a Q1 source!
+    tiers["q1"] = band_cuts.any(axis=1) & ~tiers["q2"]
+    tiers["q0"] = (tiers[[f"{band}_count" for band in bands]] > cuts["q0_min_count"]).any(axis=1)
+
+    tiers["tier"] = np.select(
+        [tiers["q2"], tiers["q1"], tiers["q0"]], ["Q2", "Q1", "Q0"], default=""
+    )
+    tiers.attrs["cuts"] = cuts
+
+    return tiers
@@ -0,0 +1,323 @@
+"""
+Batch rendering of light-curve atlases: the three_plot, phase_plot and
+plot_five_cmcc layouts from plots.py, drawn headless (Agg) in a process pool.
+
+Each worker builds its figure and artists once, then for every star just
+swaps the data into them and saves, instead of making a new pyplot figure
+per star.
+
+"""
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+from plots import index_dataset
+
+band_colors = {"J": "b", "H": "g", "K": "r"}
+
+layout_columns = {
+    "three": ["MEANMJDOBS", "JAPERMAG3", "HAPERMAG3", "KAPERMAG3",
+              "JAPERMAG3ERR", "HAPERMAG3ERR", "KAPERMAG3ERR"],
+    "phase": ["MEANMJDOBS", "JAPERMAG3", "HAPERMAG3", "KAPERMAG3",
+              "JAPERMAG3ERR", "HAPERMAG3ERR", "KAPERMAG3ERR"],
+    "five_cmcc": ["MEANMJDOBS", "JAPERMAG3", "HAPERMAG3", "KAPERMAG3",
+                  "JAPERMAG3ERR", "HAPERMAG3ERR", "KAPERMAG3ERR",
+                  "JMHPNT", "HMKPNT", "JMHPNTERR", "HMKPNTERR"],
+}
+
+
+class _Panel:
+    """ Points plus error bars on one axes, whose data can be swapped out. """
+
+    def __init__(self, ax, fmt, color, ms=None, xerr=False, lw=None):
+        self.ax = ax
+        self.points, = ax.plot([], [], fmt, color=color, ms=ms)
+        self.yerr = LineCollection([], colors=color, linewidths=lw)
+        ax.add_collection(self.yerr)
+        self.xerr = None
+        if xerr:
+            self.xerr = LineCollection([], colors=color, linewidths=lw)
+            ax.add_collection(self.xerr)
+
+    def update(self, x, y, yerr, xerr=None):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        yerr = np.asarray(yerr, dtype=float)
+
+        self.points.set_data(x, y)
+        self.yerr.set_segments(np.stack([np.c_[x, y - yerr], np.c_[x, y + yerr]], axis=1))
+        if self.xerr is not None:
+            xerr = np.asarray(xerr, dtype=float)
+            self.xerr.set_segments(np.stack([np.c_[x - xerr, y], np.c_[x + xerr, y]], axis=1))
+
+
+def _limits(lo, hi, pad=0.05):
+    lo = np.nanmin(lo) if np.size(lo) else np.nan
+    hi = np.nanmax(hi) if np.size(hi) else np.nan
+    if not np.isfinite(lo) or not np.isfinite(hi):
+        return None
+    margin = pad * (hi - lo) if hi > lo else 0.1
+    return lo - margin, hi + margin
+
+
+def _set_ylim_inverted(ax, y, yerr):
+    limits = _limits(np.asarray(y) - yerr, np.asarray(y) + yerr)
+    if limits is not None:
+        ax.set_ylim(limits[1], limits[0])
+
+
+def _set_xlim(ax, x, xerr=0):
+    limits = _limits(np.asarray(x) - xerr, np.asarray(x) + xerr)
+    if limits is not None:
+        ax.set_xlim(*limits)
+
+
+def _build_three():
+    fig = Figure(figsize=(9, 4))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows=3)
+    panels = [_Panel(ax, ".", band_colors[band]) for ax, band in zip(axes, "JHK")]
+
+    for ax, band in zip(axes, "JHK"):
+        ax.set_ylabel(f"{band} mag")
+    axes[2].set_xlabel("Modified Julian Date (JD - 2400000.5)")
+    title = axes[0].set_title("")
+
+    def update(star, sourceid, set_title=True, **kwargs):
+        for panel, band in zip(panels, "JHK"):
+            y, yerr = star[f"{band}APERMAG3"], star[f"{band}APERMAG3ERR"]
+            panel.update(star["MEANMJDOBS"], y, yerr)
+            _set_xlim(panel.ax, star["MEANMJDOBS"])
+            _set_ylim_inverted(panel.ax, y, yerr)
+        title.set_text(f"Source ID: {sourceid}" if set_title else "")
+
+    return fig, update
+
+
+def _build_phase():
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows=3)
+    ms = 5
+
+    panels = []
+    for ax, band in zip(axes, "JHK"):
+        ghost = _Panel(ax, ".", "0.7", ms=ms)
+        panels.append((_Panel(ax, ".", band_colors[band]), ghost))
+
+        ax.set_xticks([0, 0.5, 1])
+        ax.set_xticks(np.arange(-0.5, 1.5, 0.1), minor=True)
+        ax.set_xlim(-0.25, 1.25)
+        ax.set_ylabel(f"{band} mag")
+    xlabel = axes[2].set_xlabel("")
+    title = axes[0].set_title("")
+
+    def update(star, sourceid, period, offset=0, set_title=True, **kwargs):
+        times = np.asarray(star["MEANMJDOBS"], dtype=float)
+        phase = ((times % period) / period + offset) % 1.0
+
+        for (panel, ghost), band in zip(panels, "JHK"):
+            y = np.asarray(star[f"{band}APERMAG3"], dtype=float)
+            yerr = np.asarray(star[f"{band}APERMAG3ERR"], dtype=float)
+            panel.update(phase, y, yerr)
+            ghost.update(np.r_[phase - 1, phase + 1], np.r_[y, y], np.r_[yerr, yerr])
+            _set_ylim_inverted(panel.ax, y, yerr)
+
+        xlabel.set_text(f"Phase, Period={period:.2f}d")
+        title.set_text(f"Source ID: {sourceid}" if set_title else "")
+
+    return fig, update
+
+
+def _build_five_cmcc():
+    fig = Figure(figsize=(10, 6), dpi=80, facecolor="w", edgecolor="k")
+    FigureCanvasAgg(fig)
+
+    bottom = 0.1
+    height = 0.25
+    left = 0.075
+    width = 0.5
+
+    ax_k = fig.add_axes((left, bottom, width, height))
+    ax_h = fig.add_axes((left, bottom + 0.3, width, height), sharex=ax_k)
+    ax_j = fig.add_axes((left, bottom + 0.6, width, height), sharex=ax_k)
+
+    ax_jhk = fig.add_axes((0.65, bottom, 0.23, 0.375))
+    ax_khk = fig.add_axes((0.65, bottom + 0.475, 0.23, 0.375))
+
+    panels = {band: _Panel(ax, ".", band_colors[band])
+              for ax, band in zip((ax_j, ax_h, ax_k), "JHK")}
+    jhk = _Panel(ax_jhk, ".", "k", ms=2, xerr=True, lw=0.3)
+    khk = _Panel(ax_khk, ".", "k", ms=2, xerr=True, lw=0.3)
+
+    ax_j.set_ylabel("J mag")
+    ax_h.set_ylabel("H mag")
+    ax_k.set_ylabel("K mag")
+    ax_k.set_xlabel("Modified Julian Date (JD - 2400000.5)")
+    ax_jhk.set_xlabel("H-K")
+    ax_jhk.set_ylabel("J-H")
+    ax_khk.set_xlabel("H-K")
+    ax_khk.set_ylabel("K")
+    title = ax_j.set_title("")
+
+    def update(star, sourceid, set_title=True, **kwargs):
+        for band, panel in panels.items():
+            y, yerr = star[f"{band}APERMAG3"], star[f"{band}APERMAG3ERR"]
+            panel.update(star["MEANMJDOBS"], y, yerr)
+            _set_ylim_inverted(panel.ax, y, yerr)
+        _set_xlim(ax_k, star["MEANMJDOBS"])
+
+        hmk, hmk_errs = star["HMKPNT"], star["HMKPNTERR"]
+        jhk.update(hmk, star["JMHPNT"], star["JMHPNTERR"], hmk_errs)
+        khk.update(hmk, star["KAPERMAG3"], star["KAPERMAG3ERR"], hmk_errs)
+
+        _set_xlim(ax_jhk, hmk, hmk_errs)
+        _set_xlim(ax_khk, hmk, hmk_errs)
+        limits = _limits(np.asarray(star["JMHPNT"]) - star["JMHPNTERR"],
+                         np.asarray(star["JMHPNT"]) + star["JMHPNTERR"])
+        if limits is not None:
+            ax_jhk.set_ylim(*limits)
+        _set_ylim_inverted(ax_khk, star["KAPERMAG3"], star["KAPERMAG3ERR"])
+
+        title.set_text(f"Source ID: {sourceid}" if set_title else "")
+
+    return fig, update
+
+
+layouts = {
+    "three": _build_three,
+    "phase": _build_phase,
+    "five_cmcc": _build_five_cmcc,
+}
+
+# one figure per layout per process, reused for every star it renders
+_figures = {}
+
+
+def _render_chunk(args):
+    """ Worker: draws and saves every star in one chunk. """
+
+    layout, stars, outputs, formats, dpi, options = args
+
+    if layout not in _figures:
+        _figures[layout] = layouts[layout]()
+    fig, update = _figures[layout]
+
+    written = []
+    for (sourceid, star), output, star_options in zip(stars, outputs, options):
+        update(star, sourceid, **star_options)
+        for fmt in formats:
+            filename = f"{output}.{fmt}"
+            fig.savefig(filename, dpi=dpi)
+            written.append(filename)
+
+    return written
+
+
+def render_atlas(dataset, sourceids, layout="three", output_dir=".",
+                 filename="{layout}_{sourceid}", formats=("png",), periods=None,
+                 offsets=None, set_title=True, dpi=None, n_workers=None,
+                 chunksize=20, progress=True, mp_context=None):
+    """
+    Renders one light-curve figure per star, in parallel.
+
+    Parameters
+    ----------
+    dataset : pd.DataFrame, IndexedPhotometry or LightCurveCollection
+    sourceids : iterable
+    layout : str, optional
+        "three" (three_plot), "phase" (phase_plot) or "five_cmcc"
+        (plot_five_cmcc). Default "three".
+    output_dir : str, optional
+    filename : str, optional
+        Formatted with layout, sourceid and i (position in `sourceids`);
+        the extension comes from `formats`.
+    formats : sequence of str, optional
+        E.g. ("png", "pdf"). Every star is written in each format.
+    periods, offsets : dict, optional
+        sourceid -> period (and phase offset) for the "phase" layout.
+    set_title : bool, optional
+    dpi : float, optional
+    n_workers : int, optional
+        Default os.cpu_count(). 1 renders in this process.
+    chunksize : int, optional
+        Stars handed to a worker at a time.
+    progress : bool or callable, optional
+        True prints "rendered n/N" to stderr as chunks finish; a callable
+        is called as progress(n_done, n_total) instead.
+    mp_context : optional
+        As in stetson_2020.period_search_batch ("fork" where available).
+
+    Returns
+    -------
+    written : list of str
+        The files written, in the order of `sourceids`.
+
+    """
+
+    import multiprocessing
+
+    if layout not in layouts:
+        raise ValueError(f"Unknown layout {layout!r}; choose from {sorted(layouts)}")
+    if layout == "phase" and periods is None:
+        raise ValueError("The phase layout needs `periods`.")
+
+    dataset = index_dataset(dataset)
+    columns = layout_columns[layout]
+    sourceids = list(sourceids)
+    os.makedirs(output_dir, exist_ok=True)
+
+    tasks = []
+    for i in range(0, len(sourceids), chunksize):
+        chunk = sourceids[i:i + chunksize]
+        stars, outputs, options = [], [], []
+        for j, sid in enumerate(chunk, start=i):
+            star = dataset.star(sid)
+            stars.append((sid, {name: np.asarray(star[name]) for name in columns}))
+            outputs.append(os.path.join(
+                output_dir, filename.format(layout=layout, sourceid=sid, i=j)
+            ))
+            star_options = {"set_title": set_title}
+            if layout == "phase":
+                star_options["period"] = periods[sid]
+                star_options["offset"] = 0 if offsets is None else offsets.get(sid, 0)
+            options.append(star_options)
+        tasks.append((layout, stars, outputs, tuple(formats), dpi, options))
+
+    if progress is True:
+        def progress(done, total):
+            print(f"rendered {done}/{total}", file=sys.stderr)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    results = [None] * len(tasks)
+    done = 0
+
+    if n_workers == 1 or len(tasks) <= 1:
+        for k, task in enumerate(tasks):
+            results[k] = _render_chunk(task)
+            done += len(task[1])
+            if progress:
+                progress(done, len(sourceids))
+    else:
+        if mp_context is None and "fork" in multiprocessing.get_all_start_methods():
+            mp_context = "fork"
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as pool:
+            futures = {pool.submit(_render_chunk, task): k for k, task in enumerate(tasks)}
+            for future in as_completed(futures):
+                k = futures[future]
+                results[k] = future.result()
+                done += len(tasks[k][1])
+                if progress:
+                    progress(done, len(sourceids))
+
+    return [name for chunk in results for name in chunk]
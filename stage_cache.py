@@ -0,0 +1,229 @@
+"""
+A content-addressed, on-disk cache for the results of pipeline stages.
+
+Each stage's result is stored under a hash of the stage's name, its input
+data and parameters, and the source code of the functions it runs, so
+changing a downstream threshold (say the Stetson cut) reuses everything
+upstream of it, while editing e.g. S_segments invalidates just the stages
+that use it. The cache directory is bounded in size: the least recently
+used results are evicted first.
+
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+default_max_bytes = 2 * 1024 ** 3
+
+# what StageCache.get returns for a miss, since None is a valid result
+missing = object()
+
+
+def _update_hash(h, value):
+    """ Feeds `value` into the hash object `h`, type-tagged so that e.g. 1 and "1" differ. """
+
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, np.generic):
+        _update_hash(h, value.item())
+    elif isinstance(value, dict):
+        h.update(b"dict{")
+        for key in sorted(value, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, value[key])
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        # lists and tuples hash alike, so json and python configs agree
+        h.update(b"seq[")
+        for item in value:
+            _update_hash(h, item)
+        h.update(b"]")
+    elif isinstance(value, np.ndarray):
+        h.update(f"ndarray:{value.dtype.str}{value.shape};".encode())
+        if value.dtype.kind == "O":
+            _update_hash(h, value.tolist())
+        else:
+            h.update(memoryview(np.ascontiguousarray(value)).cast("B"))
+    elif isinstance(value, pd.Index):
+        h.update(f"index:{value.name!r};".encode())
+        _update_hash(h, np.asarray(value))
+    elif isinstance(value, pd.Series):
+        h.update(f"series:{value.name!r};".encode())
+        _update_hash(h, value.index)
+        _update_hash(h, value.values)
+    elif isinstance(value, pd.DataFrame):
+        h.update(b"frame;")
+        _update_hash(h, value.index)
+        for name in value.columns:
+            _update_hash(h, name)
+            _update_hash(h, value[name].values)
+    elif hasattr(value, "offsets"):
+        # indexed photometry or a LightCurveCollection: its content hash if
+        # it has one, else its columns
+        if getattr(value, "fingerprint", None) is not None:
+            h.update(f"photometry:{value.fingerprint};".encode())
+        else:
+            h.update(b"photometry;")
+            for name in value.columns:
+                _update_hash(h, name)
+                _update_hash(h, np.asarray(value.column(name)))
+            _update_hash(h, np.asarray(value.offsets))
+    elif isinstance(value, functools.partial):
+        h.update(b"partial;")
+        _update_hash(h, [value.func, value.args, value.keywords])
+    elif inspect.isroutine(value):
+        # e.g. a period engine passed as a function: by name, and by source
+        # where there is one, so two lambdas of one scope still differ
+        h.update(f"function:{value.__module__}.{value.__qualname__};".encode())
+        try:
+            h.update(inspect.getsource(value).encode())
+        except (OSError, TypeError):
+            pass
+    elif hasattr(value, "__dict__"):
+        # e.g. fap_tables.FAPTables: hash what's in it
+        h.update(f"object:{type(value).__qualname__};".encode())
+        _update_hash(h, vars(value))
+    else:
+        raise TypeError(f"Don't know how to hash a {type(value).__name__}")
+
+
+def data_hash(value):
+    """ A content hash of (nested containers of) arrays, pandas objects, photometry and plain values. """
+    h = hashlib.sha1()
+    _update_hash(h, value)
+    return h.hexdigest()
+
+
+def code_version(*functions):
+    """ A hash of the source code of the given functions. """
+    h = hashlib.sha1()
+    for function in functions:
+        h.update(f"{function.__module__}.{function.__qualname__}\n".encode())
+        h.update(inspect.getsource(function).encode())
+    return h.hexdigest()
+
+
+class StageCache:
+    """
+    Pickled stage results in a directory, keyed by content hash, holding
+    at most `max_bytes` (least recently used results are evicted first).
+
+    Safe to share between processes: results are written to a temporary
+    file and renamed into place.
+    """
+
+    def __init__(self, directory, max_bytes=default_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, inputs, code=()):
+        """
+        The cache key of a stage: its name, a hash of `inputs` (data and
+        parameters; see data_hash) and the code_version of `code`.
+        """
+        return hashlib.sha1(
+            json.dumps([stage, data_hash(inputs), code_version(*code)]).encode()
+        ).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key, default=missing):
+        """
+        The result stored under `key`, or `default` (the `missing` sentinel)
+        if there is none. A hit counts as a use, for eviction.
+        """
+
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used results until the cache fits in max_bytes. """
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".pkl"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def cached(self, stage, compute, inputs, code=()):
+        """
+        compute()'s result, from the cache if this stage has already been
+        run on the same inputs with the same code, otherwise computed and
+        stored. See lookup for whether it was a hit.
+
+        Parameters
+        ----------
+        stage : str
+            The stage's name.
+        compute : callable
+            Computes the result; called with no arguments.
+        inputs : object
+            Everything the result depends on besides code: input data and
+            parameters (see data_hash for what can be hashed).
+        code : sequence of functions, optional
+            The functions the result depends on.
+
+        """
+
+        return self.lookup(stage, compute, inputs, code)[0]
+
+    def lookup(self, stage, compute, inputs, code=()):
+        """ As cached, but returns (result, hit): hit is True if the result came from the cache. """
+
+        key = self.key(stage, inputs, code)
+        value = self.get(key)
+        if value is not missing:
+            return value, True
+        value = compute()
+        self.put(key, value)
+        return value, False
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pkl"):
+                os.remove(entry.path)
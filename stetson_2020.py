@@ -4,9 +4,16 @@ specifically with pandas compatibility in mind.
 
 """
 
+import os
+import time
+
 import numpy as np
+import pandas as pd
 from astropy.timeseries import LombScargle
 
+import instrument
+from instrument import instrumented
+
 # From c. 2012.
 def delta (m, sigma_m, mean_m, n):
     """ Normalized residual / "relative error" for one observation. 
@@ -84,6 +91,259 @@ def threeband_stetson_pandas(group):
     return S (j, sigma_j, h, sigma_h, k, sigma_k) 
 
 
+def group_segments(sourceid):
+    """
+    Works out the contiguous per-source row ranges ("segments") of a flat
+    SOURCEID column, so that per-source statistics can be done as segmented
+    reductions (np.add.reduceat and friends) rather than a groupby.apply.
+
+    INPUTS:
+        sourceid: an array of SOURCEIDs, one per row (need not be sorted)
+
+    OUTPUTS:
+        order: the (stable) permutation that sorts the rows by SOURCEID,
+               or None if the rows were already sorted
+        ids: the unique SOURCEIDs, in sorted order
+        starts: the index of each source's first row in the sorted data
+        counts: the number of rows belonging to each source
+    """
+
+    sourceid = np.asarray(sourceid)
+
+    if sourceid.size and np.all(sourceid[1:] >= sourceid[:-1]):
+        order = None
+        sorted_ids = sourceid
+    else:
+        order = np.argsort(sourceid, kind="stable")
+        sorted_ids = sourceid[order]
+
+    ids, starts, counts = np.unique(sorted_ids, return_index=True, return_counts=True)
+
+    return order, ids, starts, counts
+
+
+def segment_rows(starts, counts):
+    """ The flat row indices of the given segments, in order. """
+    starts = np.asarray(starts, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    first = np.cumsum(counts) - counts
+    return np.repeat(starts - first, counts) + np.arange(counts.sum())
+
+
+def source_columns(data, names, sourceids=None):
+    """
+    Flat, SOURCEID-sorted columns for (some of) the stars in `data`, plus
+    their segments, so the *_segments functions can run on them.
+
+    `data` is either a DataFrame or an already sorted and indexed one (e.g.
+    wserv_io.IndexedPhotometry or lightcurves.LightCurveCollection: anything
+    with .column(name), .ids and .offsets). In the indexed case nothing is
+    regrouped, and if all stars are wanted the 
+    columns are handed over as-is (views, not copies). Otherwise only the
+    requested columns of the requested stars' rows are pulled out, using the
+    per-star row ranges rather than a np.in1d over every row.
+
+    INPUTS:
+        data: DataFrame or indexed photometry
+        names: which columns to return
+        sourceids: which stars (default: all of them)
+
+    OUTPUTS:
+        ids, starts, counts: the stars' SOURCEIDs and segments
+        columns: dict of name -> flat array
+    """
+
+    if hasattr(data, 'offsets'):
+        column = data.column
+        order = None
+        ids = np.asarray(data.ids)
+        offsets = np.asarray(data.offsets)
+        starts, counts = offsets[:-1], np.diff(offsets)
+    else:
+        def column(name):
+            return data[name].values
+        order, ids, starts, counts = group_segments(data['SOURCEID'].values)
+
+    rows = None
+    if sourceids is not None:
+        keep = np.isin(ids, np.asarray(sourceids))
+        if not keep.all():
+            ids, starts, counts = ids[keep], starts[keep], counts[keep]
+            rows = segment_rows(starts, counts)
+            starts = np.cumsum(counts) - counts
+
+    if order is not None:
+        rows = order if rows is None else order[rows]
+
+    columns = {}
+    for name in names:
+        x = column(name)
+        columns[name] = x if rows is None else x[rows]
+
+    return ids, starts, counts, columns
+
+
+@instrumented("source_means")
+def source_means(data, names=None, sourceids=None):
+    """
+    Per-star nanmeans of the given columns (default: all but SOURCEID), 
+    like df.groupby("SOURCEID").aggregate(np.nanmean) but for just the 
+    stars and columns asked for.
+    """
+
+    if names is None:
+        names = [name for name in data.columns if name != 'SOURCEID']
+
+    ids, starts, counts, columns = source_columns(data, names, sourceids)
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids))
+
+    return pd.DataFrame(
+        {name: segment_nanmean(columns[name], starts) for name in names},
+        index=pd.Index(ids, name='SOURCEID'),
+    )
+
+
+def segment_nansum(x, starts):
+    """ Per-segment sum that skips NaNs (empty / all-NaN segments give 0). """
+    x = np.asarray(x, dtype=np.float64)
+    return np.add.reduceat(np.where(np.isnan(x), 0, x), starts)
+
+
+def segment_count(x, starts):
+    """ Per-segment number of non-NaN values. """
+    return np.add.reduceat((~np.isnan(np.asarray(x, dtype=np.float64))).astype(np.int64), starts)
+
+
+def segment_nanmean(x, starts):
+    """ Per-segment mean that skips NaNs (all-NaN segments give NaN). """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return segment_nansum(x, starts) / segment_count(x, starts)
+
+
+def segment_nanmin(x, starts):
+    """ Per-segment minimum that skips NaNs (all-NaN segments give NaN). """
+    x = np.asarray(x)
+    if x.dtype.kind == 'f':
+        return np.fmin.reduceat(x, starts)
+    return np.minimum.reduceat(x, starts)
+
+
+def segment_nanmax(x, starts):
+    """ Per-segment maximum that skips NaNs (all-NaN segments give NaN). """
+    x = np.asarray(x)
+    if x.dtype.kind == 'f':
+        return np.fmax.reduceat(x, starts)
+    return np.maximum.reduceat(x, starts)
+
+
+def segment_nanmedian(x, starts, counts):
+    """ Per-segment median that skips NaNs (all-NaN segments give NaN). """
+
+    x = np.asarray(x, dtype=np.float64)
+    segment = np.repeat(np.arange(len(starts)), counts)
+
+    # sort within each segment; NaNs go to the end of their segment
+    x_sorted = x[np.lexsort((x, segment))]
+    n = segment_count(x, starts)
+
+    lo = starts + np.maximum(n - 1, 0) // 2
+    hi = starts + n // 2
+
+    median = (x_sorted[lo] + x_sorted[hi]) / 2
+    median[n == 0] = np.nan
+    return median
+
+
+def S_segments(starts, counts, j, sigma_j, h, sigma_h, k, sigma_k):
+    """
+    Vectorized version of S() for many stars at once. The photometry must
+    already be sorted so that each star's rows are contiguous; see
+    group_segments().
+
+    INPUTS:
+        starts: index of each star's first row
+        counts: number of rows per star (this is the `n` of S, i.e. it 
+                includes rows where a magnitude is NaN)
+        j, sigma_j, h, sigma_h, k, sigma_k: flat arrays of magnitudes and 
+                uncertainties, as in S()
+
+    OUTPUTS:
+        s: an array of Stetson variability indices, one per star
+    """
+
+    starts = np.asarray(starts)
+    counts = np.asarray(counts)
+
+    # stars with a single row still get a (meaningless) delta below; their
+    # S is overwritten by the n < 2 rule at the end.
+    n = np.repeat(counts, counts).astype(np.float64)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        norm = np.sqrt(n / (n - 1))
+
+        d = []
+        for m, sigma_m in ((j, sigma_j), (h, sigma_h), (k, sigma_k)):
+            m = np.asarray(m, dtype=np.float64)
+            sigma_m = np.asarray(sigma_m, dtype=np.float64)
+            mean_m = np.repeat(segment_nanmean(m, starts), counts)
+            d.append(norm * (m - mean_m) / sigma_m)
+        d_j, d_h, d_k = d
+
+        terms = np.zeros_like(d_j)
+        for P_i in (d_j * d_h, d_h * d_k, d_j * d_k):
+            terms += np.nan_to_num(np.sign(P_i) * np.sqrt(np.abs(P_i)), nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+        s = np.add.reduceat(terms, starts) / counts
+
+    # Perhaps hackish (but consistent with S)
+    s[counts < 2] = 0
+
+    return s
+
+
+def S_batch(sourceid, j, sigma_j, h, sigma_h, k, sigma_k):
+    """
+    Computes the Stetson variability index S for every star in a flat
+    table in one vectorized pass. Gives the same values as calling S() on 
+    each star's rows. Everything is done in float64, so with float32 FITS
+    columns the two agree to float32 precision rather than bit-for-bit.
+
+    INPUTS:
+        sourceid: an array of SOURCEIDs, one per row
+        j, sigma_j, h, sigma_h, k, sigma_k: flat arrays of magnitudes and
+                uncertainties, as in S()
+
+    OUTPUTS:
+        ids: the unique SOURCEIDs, sorted
+        s: the Stetson variability index of each of those stars
+    """
+
+    order, ids, starts, counts = group_segments(sourceid)
+
+    columns = [np.asarray(x) for x in (j, sigma_j, h, sigma_h, k, sigma_k)]
+    if order is not None:
+        columns = [x[order] for x in columns]
+
+    return ids, S_segments(starts, counts, *columns)
+
+
+@instrumented("stetson")
+def threeband_stetson_batch(df, sourceids=None):
+    """
+    Drop-in replacement for df.groupby("SOURCEID").apply(threeband_stetson_pandas)
+    that does all the stars at once. `df` can also be indexed photometry 
+    (see source_columns), and `sourceids` restricts it to some stars.
+    """
+
+    names = ['JAPERMAG3', 'JAPERMAG3ERR', 'HAPERMAG3', 'HAPERMAG3ERR', 'KAPERMAG3', 'KAPERMAG3ERR']
+    ids, starts, counts, columns = source_columns(df, names, sourceids)
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids))
+
+    s = S_segments(starts, counts, *[columns[name] for name in names])
+
+    return pd.Series(s, index=pd.Index(ids, name='SOURCEID'))
+
+
 def chisq(group):
     d = group['JAPERMAG3']
     err = group['JAPERMAG3ERR']
@@ -111,6 +371,128 @@ def k_chisq_red(group):
     
     return ((d - d.mean())**2 / err**2).sum() / d.size
 
+
+def chisq_red_segments(starts, counts, mags, errs):
+    """
+    Vectorized version of j/h/k_chisq_red for many stars and several bands
+    at once. The photometry must already be sorted so that each star's rows
+    are contiguous; see group_segments().
+
+    Like the per-group functions, NaN terms are skipped in the sum but the
+    sum is divided by the total number of rows (d.size), not the number of
+    non-NaN measurements.
+
+    INPUTS:
+        starts: index of each star's first row
+        counts: number of rows per star
+        mags: a sequence of flat magnitude arrays, one per band
+        errs: a sequence of the corresponding flat uncertainty arrays
+
+    OUTPUTS:
+        chisq_red: an array of shape (n_bands, n_stars)
+    """
+
+    d = np.atleast_2d(np.asarray(mags, dtype=np.float64))
+    err = np.atleast_2d(np.asarray(errs, dtype=np.float64))
+    counts = np.asarray(counts)
+
+    valid = ~np.isnan(d)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(np.where(valid, d, 0), starts, axis=1) / np.add.reduceat(
+            valid, starts, axis=1
+        )
+        terms = (d - np.repeat(mean, counts, axis=1)) ** 2 / err ** 2
+        chisq = np.add.reduceat(np.where(np.isnan(terms), 0, terms), starts, axis=1)
+
+    return chisq / counts
+
+
+def chisq_red_batch(sourceid, mags, errs):
+    """
+    Reduced chi-square (as in j/h/k_chisq_red) for every star and every
+    band in one pass over a flat table.
+
+    INPUTS:
+        sourceid: an array of SOURCEIDs, one per row
+        mags: a sequence of flat magnitude arrays, one per band
+        errs: a sequence of the corresponding flat uncertainty arrays
+
+    OUTPUTS:
+        ids: the unique SOURCEIDs, sorted
+        chisq_red: an array of shape (n_bands, n_stars)
+    """
+
+    order, ids, starts, counts = group_segments(sourceid)
+
+    mags = [np.asarray(x) for x in mags]
+    errs = [np.asarray(x) for x in errs]
+    if order is not None:
+        mags = [x[order] for x in mags]
+        errs = [x[order] for x in errs]
+
+    return ids, chisq_red_segments(starts, counts, mags, errs)
+
+
+@instrumented("chisq_red")
+def threeband_chisq_red_batch(df, eligible=None, bands="JHK"):
+    """
+    Computes j_chisq_red, h_chisq_red and k_chisq_red for every star in df
+    in a single pass, instead of one groupby.apply per band on a filtered
+    copy of df.
+
+    INPUTS:
+        df: a photometry DataFrame (one row per SOURCEID per epoch), or
+            indexed photometry / a LightCurveCollection (see source_columns)
+        eligible: optional dict of band -> boolean Series indexed by SOURCEID
+                  (e.g. {'J': qj, 'H': qh, 'K': qk}). Stars that are not 
+                  eligible in a band get NaN in that band.
+        bands: which bands to do
+
+    OUTPUTS:
+        chisq_red: DataFrame indexed by SOURCEID, one column per band
+        mask: boolean DataFrame of the same shape; True where the star is 
+              eligible in that band
+    
+    If `eligible` is given, only stars eligible in some band are computed
+    and returned.
+    """
+
+    sourceids = None
+    if eligible is not None:
+        sourceids = np.unique(np.concatenate(
+            [np.asarray(eligible[band].index[eligible[band].values.astype(bool)]) 
+             for band in bands if band in eligible] + [np.array([], dtype=np.int64)]
+        ))
+
+    mag_names = [band.upper()+'APERMAG3' for band in bands]
+    err_names = [band.upper()+'APERMAG3ERR' for band in bands]
+    ids, starts, counts, columns = source_columns(df, mag_names + err_names, sourceids)
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids))
+
+    chisq = chisq_red_segments(
+        starts, counts, 
+        [columns[name] for name in mag_names], 
+        [columns[name] for name in err_names],
+    )
+
+    index = pd.Index(ids, name='SOURCEID')
+    chisq_red = pd.DataFrame(chisq.T, index=index, columns=list(bands))
+
+    if eligible is None:
+        mask = pd.DataFrame(True, index=index, columns=list(bands))
+    else:
+        mask = pd.DataFrame(
+            {
+                band: eligible[band].reindex(index, fill_value=False).astype(bool)
+                if band in eligible
+                else False
+                for band in bands
+            },
+            index=index,
+        )
+
+    return chisq_red.where(mask), mask
+
 # q2_chisq = q2_groupby.apply(chisq)
 # q2_stetson = q2_groupby.apply(threeband_stetson_pandas)
 
@@ -135,25 +517,280 @@ def k_chisq_red(group):
 #         return np.nan, np.nan
 
 
-def period_fap(group, band):
-    _t = group['MEANMJDOBS']
-    _y = group[band.upper()+'APERMAG3']
-    _dy = group[band.upper()+'APERMAG3ERR']
+def adaptive_frequency_search(ls, minimum_frequency, maximum_frequency, baseline,
+                              n_peaks=5, coarse_samples_per_peak=1, accuracy=0.2):
+    """
+    Coarse-to-fine peak search: a coarse scan of the whole frequency range,
+    then a fine scan around each of the `n_peaks` highest coarse peaks.
 
-    t = _t[~np.isnan(_y)]
-    y = _y[~np.isnan(_y)]
-    dy = _dy[~np.isnan(_y)]
+    A periodogram peak is ~1/baseline wide, so the coarse scan only needs
+    about one sample per peak width to land on every strong peak. Each of
+    the top peaks is then refined to a step of `accuracy`/baseline, so the
+    best frequency matches a dense grid with samples_per_peak = 1/accuracy
+    (autopower's default is 5, i.e. accuracy=0.2) to within that step, as
+    long as the dense grid's peak is among the top `n_peaks` coarse peaks.
+
+    INPUTS:
+        ls: a LombScargle object
+        minimum_frequency, maximum_frequency: the search range
+        baseline: the time baseline of the data, in days
+        n_peaks: number of coarse peaks to refine
+        coarse_samples_per_peak: sampling of the coarse scan
+        accuracy: fine step, as a fraction of the peak width 1/baseline
+
+    OUTPUTS:
+        best_frequency, peak power, number of frequencies evaluated
+    """
+
+    coarse_step = 1 / (coarse_samples_per_peak * baseline)
+    fine_step = accuracy / baseline
+
+    coarse = np.arange(minimum_frequency, maximum_frequency + coarse_step, coarse_step)
+    coarse = coarse[coarse <= maximum_frequency]
+    coarse_power = ls.power(coarse)
+    n_evaluated = coarse.size
+
+    # local maxima of the coarse scan (ends included)
+    padded = np.concatenate([[-np.inf], coarse_power, [-np.inf]])
+    is_peak = (padded[1:-1] >= padded[:-2]) & (padded[1:-1] >= padded[2:])
+    peaks = np.flatnonzero(is_peak)
+    peaks = peaks[np.argsort(coarse_power[peaks])[::-1][:n_peaks]]
+
+    best_frequency = coarse[peaks[0]]
+    best_power = coarse_power[peaks[0]]
+
+    for i in peaks:
+        fine = np.arange(coarse[i] - coarse_step, coarse[i] + coarse_step + fine_step, fine_step)
+        fine = fine[(fine >= minimum_frequency) & (fine <= maximum_frequency)]
+        fine_power = ls.power(fine)
+        n_evaluated += fine.size
+
+        j = np.argmax(fine_power)
+        if fine_power[j] > best_power:
+            best_frequency = fine[j]
+            best_power = fine_power[j]
+
+    return best_frequency, best_power, n_evaluated
+
+
+def lombscargle_period(t, y, dy, frequency=None, adaptive=False, **adaptive_kwargs):
+    """
+    The Lomb-Scargle search at the heart of period_fap, on plain arrays.
+
+    INPUTS:
+        t, y, dy: times, magnitudes and uncertainties (NaN magnitudes are
+                  dropped here)
+        frequency: optional fixed frequency grid; by default the grid comes
+                   from ls.autopower()
+        adaptive: if True (and no fixed grid is given), search autopower()'s
+                  frequency range coarse-to-fine with
+                  adaptive_frequency_search instead of evaluating the whole
+                  dense grid
+        adaptive_kwargs: n_peaks, coarse_samples_per_peak, accuracy; passed
+                  on to adaptive_frequency_search
+
+    OUTPUTS:
+        best_period, peak power, false alarm probability
+        (all NaN if the periodogram can't be computed)
+    """
+
+    t = np.asarray(t)
+    y = np.asarray(y)
+    dy = np.asarray(dy)
+
+    good = ~np.isnan(y)
+    t = t[good]
+    y = y[good]
+    dy = dy[good]
 
     ls = LombScargle(t, y, dy)
     try:
-        frequency, power = ls.autopower()
+        if frequency is None and adaptive:
+            grid = ls.autofrequency()
+            best_frequency, max_power, _ = adaptive_frequency_search(
+                ls, grid.min(), grid.max(), np.ptp(t), **adaptive_kwargs
+            )
+            # same FAP as the dense search: it only depends on the range
+            fap = ls.false_alarm_probability(max_power)
+
+            return 1/best_frequency, max_power, fap
+
+        if frequency is None:
+            frequency, power = ls.autopower()
+            fap_kwargs = {}
+        else:
+            power = ls.power(frequency)
+            fap_kwargs = dict(minimum_frequency=frequency.min(),
+                              maximum_frequency=frequency.max())
 
         best_period = 1/frequency[power==power.max()][0]
-        fap = ls.false_alarm_probability(power.max())
+        fap = ls.false_alarm_probability(power.max(), **fap_kwargs)
 
-        return best_period, fap
-    except ValueError:
-        return np.nan, np.nan
+        return best_period, power.max(), fap
+    except (ValueError, IndexError):
+        return np.nan, np.nan, np.nan
+
+
+def pdm_theta(t, y, dy, frequency, n_bins=10, covers=1, max_cells=2**22):
+    """
+    The phase dispersion minimization statistic (Stellingwerf 1978) of one
+    light curve at every trial frequency, as batched binned sums: the
+    phases at all frequencies are one (n_frequencies, n_points) array, and
+    the per-bin weighted sums for all of them come out of single bincounts,
+    so there is no loop over trial periods (only over blocks of them, to 
+    keep each block under `max_cells` array elements).
+
+    theta is the pooled within-bin variance over the total variance, both
+    weighted by 1/dy**2; ~1 for no signal, small at the true period.
+
+    INPUTS:
+        t, y, dy: times, magnitudes and uncertainties, all good (no NaNs)
+        frequency: the trial frequencies
+        n_bins: phase bins per cover
+        covers: number of bin sets, each shifted by 1/(n_bins*covers) in
+                phase (Stellingwerf's (n_bins, covers) scheme)
+        max_cells: block size limit
+
+    OUTPUTS:
+        theta: an array with one value per frequency
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    w = 1 / np.asarray(dy, dtype=np.float64) ** 2
+    frequency = np.asarray(frequency, dtype=np.float64)
+
+    # the phases don't care about a time offset, and taking one out keeps
+    # them accurate at MJD ~ 55000
+    t = t - t.min()
+    y = y - np.average(y, weights=w)
+    total = np.sum(w * y * y)
+
+    n_cells = n_bins * covers
+    shift = np.arange(covers) / n_cells
+    wy = np.tile(w * y, covers)
+    wyy = np.tile(w * y * y, covers)
+    ww = np.tile(w, covers)
+
+    theta = np.empty(frequency.size)
+    block = max(1, max_cells // (t.size * covers))
+    for i in range(0, frequency.size, block):
+        f = frequency[i:i + block]
+        phase = np.outer(f, t) % 1.0
+        # (frequency, cover, point) -> index of its bin among all the
+        # block's bins
+        bins = np.floor(((phase[:, None, :] + shift[None, :, None]) % 1.0) * n_bins).astype(np.int64)
+        np.minimum(bins, n_bins - 1, out=bins)
+        bins += (np.arange(f.size)[:, None, None] * covers + np.arange(covers)[None, :, None]) * n_bins
+        bins = bins.reshape(f.size, -1)
+
+        size = f.size * n_cells
+        sw = np.bincount(bins.ravel(), weights=np.broadcast_to(ww, bins.shape).ravel(), minlength=size)
+        swy = np.bincount(bins.ravel(), weights=np.broadcast_to(wy, bins.shape).ravel(), minlength=size)
+        swyy = np.bincount(bins.ravel(), weights=np.broadcast_to(wyy, bins.shape).ravel(), minlength=size)
+        n = np.bincount(bins.ravel(), minlength=size)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            within = np.where(sw > 0, swyy - swy ** 2 / sw, 0).reshape(f.size, n_cells)
+        occupied = (n > 0).reshape(f.size, n_cells).sum(axis=1)
+
+        # pooled within-bin variance (over all covers) / total variance
+        dof = covers * t.size - occupied
+        with np.errstate(invalid="ignore", divide="ignore"):
+            theta[i:i + block] = (within.sum(axis=1) / dof) / (total / (t.size - 1))
+
+    return theta
+
+
+def pdm_period(t, y, dy, frequency=None, n_bins=10, covers=1, max_cells=2**22):
+    """
+    Phase dispersion minimization period search, with the same inputs and
+    outputs as lombscargle_period, for light curves that aren't sinusoidal
+    (dippers, eclipsing binaries).
+
+    The trial frequencies default to the same autofrequency() grid the
+    Lomb-Scargle search uses. The "power" is 1 - theta (so that, as for
+    Lomb-Scargle, higher is better). The false alarm probability is that of
+    theta under pure noise, a beta distribution (Schwarzenberg-Czerny 1997),
+    for ~(frequency range x baseline) independent trials.
+
+    INPUTS:
+        t, y, dy: times, magnitudes and uncertainties (NaN magnitudes are
+                  dropped here)
+        frequency: optional fixed frequency grid
+        n_bins, covers, max_cells: as in pdm_theta
+
+    OUTPUTS:
+        best_period, power (1 - theta), false alarm probability
+        (all NaN if there are too few points)
+    """
+
+    from scipy.special import betainc
+
+    t = np.asarray(t, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    dy = np.asarray(dy, dtype=np.float64)
+
+    good = ~np.isnan(y) & ~np.isnan(dy)
+    t, y, dy = t[good], y[good], dy[good]
+    if t.size <= n_bins or np.ptp(t) == 0:
+        return np.nan, np.nan, np.nan
+
+    if frequency is None:
+        frequency = LombScargle(t, y, dy).autofrequency()
+    frequency = np.asarray(frequency, dtype=np.float64)
+
+    theta = pdm_theta(t, y, dy, frequency, n_bins=n_bins, covers=covers, max_cells=max_cells)
+    if not np.isfinite(theta).any():
+        return np.nan, np.nan, np.nan
+    best = np.nanargmin(theta)
+
+    # single-trial probability of a theta this low, then over the trials
+    p = betainc((t.size - n_bins) / 2, (n_bins - 1) / 2, min(theta[best], 1.0))
+    n_trials = max(1.0, np.ptp(frequency) * np.ptp(t))
+    fap = -np.expm1(n_trials * np.log1p(-min(p, 1 - 1e-16)))
+
+    return 1 / frequency[best], 1 - theta[best], fap
+
+
+# the per-source period engines: name -> function(t, y, dy, frequency, 
+# **options) returning (best_period, power, fap), as lombscargle_period
+period_engines = {
+    "lombscargle": lombscargle_period,
+    "pdm": pdm_period,
+}
+
+
+def register_period_engine(name, function):
+    """
+    Adds a per-source period search to the engines period_search_batch and
+    period_fap can use. Worker processes see it if they are forked after
+    this (the default), or if it is registered at import time.
+    """
+    period_engines[name] = function
+
+
+def period_engine(engine):
+    """ The function of a period engine, by name (or the function itself). """
+
+    if callable(engine):
+        return engine
+    try:
+        return period_engines[engine]
+    except KeyError:
+        raise ValueError(f"Unknown period engine {engine!r}; choose from {sorted(period_engines)}") from None
+
+
+def period_fap(group, band, adaptive=False, engine="lombscargle", **engine_options):
+    _t = group['MEANMJDOBS']
+    _y = group[band.upper()+'APERMAG3']
+    _dy = group[band.upper()+'APERMAG3ERR']
+
+    if adaptive:
+        engine_options['adaptive'] = adaptive
+    best_period, power, fap = period_engine(engine)(_t, _y, _dy, **engine_options)
+
+    return best_period, fap
 
 def j_period_fap(group):
     return period_fap(group, 'J')
@@ -162,6 +799,555 @@ def h_period_fap(group):
 def k_period_fap(group):
     return period_fap(group, 'K')
 
+
+def _period_search_chunk(args):
+    """
+    Worker for period_search_batch: runs the serial search on one chunk.
+    Returns the result rows, and if `timing` is set, the time each search 
+    took as (SOURCEID, band, seconds, number of good points) tuples.
+    """
+
+    ids, starts, counts, t, mags, errs, bands, frequency, engine, options, mode, timing = args
+    search = period_engine(engine)
+
+    rows = []
+    timings = []
+    for sid, start, count in zip(ids, starts, counts):
+        sl = slice(start, start + count)
+        if mode == "multiband":
+            tic = time.perf_counter()
+            best_period, power, fap, amplitudes = multiband_period(
+                t[sl], [y[sl] for y in mags], [dy[sl] for dy in errs], frequency
+            )
+            if timing:
+                n_points = int(sum((~np.isnan(y[sl])).sum() for y in mags))
+                timings.append((sid, "".join(bands), time.perf_counter() - tic, n_points))
+            for band, amplitude in zip(bands, amplitudes):
+                rows.append((sid, band, best_period, power, fap, amplitude))
+            continue
+        for band, y, dy in zip(bands, mags, errs):
+            tic = time.perf_counter()
+            best_period, power, fap = search(t[sl], y[sl], dy[sl], frequency, **options)
+            if timing:
+                timings.append((sid, band, time.perf_counter() - tic, int((~np.isnan(y[sl])).sum())))
+            rows.append((sid, band, best_period, power, fap))
+
+    return rows, timings
+
+
+@instrumented("period_search")
+def period_search_batch(df, sourceids=None, bands="JHK", n_workers=None, 
+                        frequency=None, chunksize=50, mp_context=None,
+                        mode="per_source", epoch_tol=0.01, fap_tables=None,
+                        adaptive=False, engine="lombscargle", engine_options=None):
+    """
+    Runs the period_fap search for many stars and bands, spread over a 
+    process pool.
+
+    Each (star, band) goes through exactly the same code as period_fap, 
+    so the results are identical to the serial groupby.apply path.
+
+    INPUTS:
+        df: a photometry DataFrame (one row per SOURCEID per epoch), or
+            indexed photometry / a LightCurveCollection (see source_columns)
+        sourceids: which stars to search (default: all of them)
+        bands: which bands to search
+        n_workers: number of worker processes (default: os.cpu_count();
+                   1 means run serially in this process)
+        frequency: optional fixed frequency grid shared by all searches
+        chunksize: number of stars handed to a worker at a time
+        mp_context: multiprocessing context for the pool. Defaults to "fork"
+                    where available, so that scripts without a __main__ 
+                    guard (like data_prep.py) aren't re-run by the workers.
+        mode: "per_source" (the default, one autopower() grid per star) or
+              "shared_grid", which hands off to shared_grid_period_search 
+              (one grid and sin/cos basis for the whole field; n_workers, 
+              chunksize and mp_context are then unused), or "multiband", 
+              which runs one joint J/H/K search per star (multiband_period).
+              In multiband mode every band's row carries the joint 
+              best_period, power and fap, plus that band's `amplitude`.
+        epoch_tol: epoch merging tolerance for mode="shared_grid"
+        fap_tables: cached FAP calibration for mode="shared_grid" 
+                    (see fap_tables.py)
+        adaptive: use the coarse-to-fine search for mode="per_source" 
+                  (see lombscargle_period)
+        engine: the per-source search for mode="per_source": a name in
+                period_engines ("lombscargle", the default, or "pdm" for 
+                phase dispersion minimization, see pdm_period) or a 
+                function with the same signature
+        engine_options: extra keyword arguments for the engine (e.g. 
+                n_bins and covers for "pdm")
+
+    OUTPUTS:
+        a tidy DataFrame with columns SOURCEID, band, best_period, power, fap
+    """
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    if mode == "shared_grid":
+        return shared_grid_period_search(df, sourceids=sourceids, bands=bands, 
+                                         frequency=frequency, epoch_tol=epoch_tol,
+                                         fap_tables=fap_tables)
+    elif mode not in ("per_source", "multiband"):
+        raise ValueError(f"Unknown period search mode: {mode!r}")
+    if engine != "lombscargle" and mode != "per_source":
+        raise ValueError(f"The {mode} period search only uses Lomb-Scargle, not {engine!r}")
+    period_engine(engine)
+
+    options = dict(engine_options or {})
+    if adaptive:
+        if engine != "lombscargle":
+            raise ValueError("The adaptive search is only for the lombscargle engine.")
+        options['adaptive'] = adaptive
+
+    mag_names = [band.upper()+'APERMAG3' for band in bands]
+    err_names = [band.upper()+'APERMAG3ERR' for band in bands]
+    ids, starts, counts, columns = source_columns(
+        df, ['MEANMJDOBS'] + mag_names + err_names, sourceids
+    )
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids), mode=mode,
+                    engine=engine if isinstance(engine, str) else engine.__name__)
+    timing = instrument.active()
+
+    t = columns['MEANMJDOBS']
+    mags = [columns[name] for name in mag_names]
+    errs = [columns[name] for name in err_names]
+
+    tasks = []
+    for i in range(0, len(ids), chunksize):
+        c_ids = ids[i:i+chunksize]
+        c_starts = starts[i:i+chunksize]
+        c_counts = counts[i:i+chunksize]
+        # only ship this chunk's rows to the worker
+        rows = np.concatenate([np.arange(a, a + n) for a, n in zip(c_starts, c_counts)])
+        c_offsets = np.concatenate([[0], np.cumsum(c_counts)[:-1]])
+        tasks.append((c_ids, c_offsets, c_counts, t[rows], 
+                      [y[rows] for y in mags], [dy[rows] for dy in errs], 
+                      list(bands), frequency, engine, options, mode, timing))
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_workers == 1 or len(tasks) <= 1:
+        results = [_period_search_chunk(task) for task in tasks]
+    else:
+        if mp_context is None and "fork" in multiprocessing.get_all_start_methods():
+            mp_context = "fork"
+        if isinstance(mp_context, str):
+            mp_context = multiprocessing.get_context(mp_context)
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as pool:
+            results = list(pool.map(_period_search_chunk, tasks))
+
+    instrument.add_timings("periodogram", [item for _, timings in results for item in timings])
+
+    columns = ['SOURCEID', 'band', 'best_period', 'power', 'fap']
+    if mode == "multiband":
+        columns.append('amplitude')
+
+    return pd.DataFrame([row for rows, _ in results for row in rows], columns=columns)
+
+
+def field_frequency_grid(t, samples_per_peak=5, nyquist_factor=5,
+                         minimum_frequency=None, maximum_frequency=None,
+                         epoch_tol=0.01):
+    """
+    One frequency grid for a whole field, built the same way autopower() 
+    builds one for each star, but from the field's common epochs.
+
+    INPUTS:
+        t: the MEANMJDOBS values of the field (repeats are fine)
+        samples_per_peak, nyquist_factor, minimum_frequency, 
+        maximum_frequency: as in LombScargle.autofrequency
+        epoch_tol: epoch merging tolerance in days (see field_epochs)
+
+    OUTPUTS:
+        frequency: the shared frequency grid, in 1/day
+    """
+
+    epochs, _ = field_epochs(t, epoch_tol)
+    return LombScargle(epochs, np.zeros_like(epochs)).autofrequency(
+        samples_per_peak=samples_per_peak,
+        nyquist_factor=nyquist_factor,
+        minimum_frequency=minimum_frequency,
+        maximum_frequency=maximum_frequency,
+    )
+
+
+def field_epochs(t, epoch_tol=0.01):
+    """
+    Groups the field's observation times into common epochs.
+
+    Stars in one field are observed on (nearly) the same MEANMJDOBS, so 
+    times within `epoch_tol` days of each other are treated as one epoch,
+    whose time is the mean of its members. epoch_tol=0 uses the exact 
+    times.
+
+    INPUTS:
+        t: flat array of observation times
+        epoch_tol: merging tolerance in days
+
+    OUTPUTS:
+        epochs: the common epoch times
+        epoch_index: for each element of t, the index of its epoch
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    unique_t, inverse = np.unique(t, return_inverse=True)
+
+    new_epoch = np.concatenate([[True], np.diff(unique_t) > epoch_tol])
+    cluster = np.cumsum(new_epoch) - 1
+    epochs = np.bincount(cluster, weights=unique_t) / np.bincount(cluster)
+
+    return epochs, cluster[inverse]
+
+
+def nearest_epoch(epochs, t):
+    """ Index of the closest of the (sorted) `epochs` to each time in `t`. """
+
+    if epochs.size == 1:
+        return np.zeros(np.shape(t), dtype=np.int64)
+
+    i = np.clip(np.searchsorted(epochs, t), 1, epochs.size - 1)
+    return i - ((t - epochs[i - 1]) < (epochs[i] - t))
+
+
+def shared_grid_basis(epochs, frequency):
+    """
+    The per-epoch trigonometric basis for a shared frequency grid, computed 
+    once per field and reused for every star.
+
+    INPUTS:
+        epochs: the common epoch times (see field_epochs)
+        frequency: the shared frequency grid (see field_frequency_grid)
+
+    OUTPUTS:
+        basis: dict with the epochs, the frequency grid, and the 
+               (n_epochs, n_frequencies) arrays cos(wt), sin(wt), 
+               cos(2wt), sin(2wt)
+    """
+
+    epochs = np.asarray(epochs, dtype=np.float64)
+    frequency = np.asarray(frequency, dtype=np.float64)
+
+    # the periodogram doesn't care about a time offset, and taking one out
+    # keeps the phases accurate at MJD ~ 55000
+    omega_t = 2 * np.pi * np.outer(epochs - epochs.min(), frequency)
+
+    return {
+        'epochs': epochs,
+        'frequency': frequency,
+        'cos': np.cos(omega_t),
+        'sin': np.sin(omega_t),
+        'cos2': np.cos(2 * omega_t),
+        'sin2': np.sin(2 * omega_t),
+    }
+
+
+def shared_grid_sums(basis, w, wy):
+    """
+    Weighted trigonometric sums for many stars at once, as matrix products
+    against the cached basis.
+
+    INPUTS:
+        basis: from shared_grid_basis
+        w: (n_stars, n_epochs) weights 1/dy**2, zero at missing epochs
+        wy: (n_stars, n_epochs) weights times magnitudes
+
+    OUTPUTS:
+        dict of (n_stars, n_frequencies) arrays of sums over epochs:
+        'C' = sum w cos, 'S' = sum w sin, 'YC' = sum wy cos, 
+        'YS' = sum wy sin, 'CC' = sum w cos^2, 'SS' = sum w sin^2,
+        'CS' = sum w cos sin
+    """
+
+    W = w.sum(axis=1)[:, None]
+    w_cos2 = w @ basis['cos2']
+
+    return {
+        'C': w @ basis['cos'],
+        'S': w @ basis['sin'],
+        'YC': wy @ basis['cos'],
+        'YS': wy @ basis['sin'],
+        'CC': (W + w_cos2) / 2,
+        'SS': (W - w_cos2) / 2,
+        'CS': (w @ basis['sin2']) / 2,
+    }
+
+
+def shared_grid_power(basis, w, wy, wyy):
+    """
+    Floating-mean Lomb-Scargle power ("standard" normalization, as astropy
+    uses by default) for many stars on the shared grid.
+
+    INPUTS:
+        basis: from shared_grid_basis
+        w, wy: as in shared_grid_sums
+        wyy: (n_stars, n_epochs) weights times magnitudes squared
+
+    OUTPUTS:
+        power: an (n_stars, n_frequencies) array
+    """
+
+    sums = shared_grid_sums(basis, w, wy)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        W = w.sum(axis=1)[:, None]
+        Y = wy.sum(axis=1)[:, None] / W
+        YY = wyy.sum(axis=1)[:, None] / W - Y * Y
+
+        C = sums['C'] / W
+        S = sums['S'] / W
+        YC = sums['YC'] / W - Y * C
+        YS = sums['YS'] / W - Y * S
+        CC = sums['CC'] / W - C * C
+        SS = sums['SS'] / W - S * S
+        CS = sums['CS'] / W - C * S
+
+        D = CC * SS - CS * CS
+        power = (SS * YC * YC + CC * YS * YS - 2 * CS * YC * YS) / (YY * D)
+
+    return power
+
+
+@instrumented("shared_grid_period_search")
+def shared_grid_period_search(df, sourceids=None, bands="JHK", frequency=None,
+                              epoch_tol=0.01, chunksize=256, fap_tables=None):
+    """
+    Period search for stars sharing a common cadence: one frequency grid
+    and one cached sin/cos basis for the whole field, with the periodograms
+    of `chunksize` stars at a time evaluated as matrix products. Each star 
+    only contributes at the epochs where it has a measurement.
+
+    The power is the exact floating-mean Lomb-Scargle power on the shared
+    grid (what astropy's "slow"/"cython" methods give), with each 
+    observation placed at its common epoch (see field_epochs).
+
+    INPUTS:
+        df: a photometry DataFrame (one row per SOURCEID per epoch), or
+            indexed photometry / a LightCurveCollection (see source_columns)
+        sourceids: which stars to search (default: all of them)
+        bands: which bands to search
+        frequency: the shared grid (default: field_frequency_grid of df)
+        epoch_tol: epoch merging tolerance in days
+        chunksize: number of stars per matrix product
+        fap_tables: optional fap_tables.FAPTables calibrated on this grid; 
+                    if given, FAPs are looked up there instead of computed
+                    analytically star by star
+
+    OUTPUTS:
+        a tidy DataFrame with columns SOURCEID, band, best_period, power, fap
+        (the same layout as period_search_batch)
+    """
+
+    # the epochs and grid come from the whole field, whichever stars are searched
+    if hasattr(df, 'offsets'):
+        field_t = df.column('MEANMJDOBS')
+    else:
+        field_t = df['MEANMJDOBS'].values
+    epochs, _ = field_epochs(field_t, epoch_tol)
+
+    mag_names = [band.upper()+'APERMAG3' for band in bands]
+    err_names = [band.upper()+'APERMAG3ERR' for band in bands]
+    ids, starts, counts, columns = source_columns(
+        df, ['MEANMJDOBS'] + mag_names + err_names, sourceids
+    )
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids))
+
+    t = columns['MEANMJDOBS'].astype(np.float64)
+    epoch_index = nearest_epoch(epochs, t)
+
+    if frequency is None:
+        frequency = field_frequency_grid(field_t, epoch_tol=epoch_tol)
+    basis = shared_grid_basis(epochs, frequency)
+    instrument.note(n_frequencies=len(frequency))
+    fmin, fmax = frequency.min(), frequency.max()
+    if fap_tables is not None:
+        fap_tables.check_grid(frequency)
+
+    n_epochs = epochs.size
+    rows = []
+    for i in range(0, len(ids), chunksize):
+        c_ids = ids[i:i+chunksize]
+        c_starts = starts[i:i+chunksize]
+        c_counts = counts[i:i+chunksize]
+        c_rows = np.concatenate([np.arange(a, a + n) for a, n in zip(c_starts, c_counts)])
+        c_t = t[c_rows]
+        star = np.repeat(np.arange(len(c_ids)), c_counts)
+        cell = star * n_epochs + epoch_index[c_rows]
+        shape = (len(c_ids), n_epochs)
+
+        chunk_results = []
+        for band in bands:
+            y = columns[band.upper()+'APERMAG3'][c_rows].astype(np.float64)
+            dy = columns[band.upper()+'APERMAG3ERR'][c_rows].astype(np.float64)
+            good = ~np.isnan(y) & ~np.isnan(dy)
+
+            wt = np.where(good, 1 / np.where(good, dy, 1) ** 2, 0)
+            y0 = np.where(good, y, 0)
+
+            w = np.bincount(cell, weights=wt, minlength=shape[0] * shape[1]).reshape(shape)
+            wy = np.bincount(cell, weights=wt * y0, minlength=shape[0] * shape[1]).reshape(shape)
+            wyy = np.bincount(cell, weights=wt * y0 * y0, minlength=shape[0] * shape[1]).reshape(shape)
+
+            power = shared_grid_power(basis, w, wy, wyy)
+
+            band_results = []
+            for j in range(len(c_ids)):
+                p = power[j]
+                if not np.isfinite(p).any():
+                    band_results.append((np.nan, np.nan, np.nan))
+                    continue
+                best = np.nanargmax(p)
+                sel = (star == j) & good
+                if fap_tables is not None:
+                    fap = fap_tables.fap(band, sel.sum(), np.ptp(c_t[sel]), p[best])
+                else:
+                    try:
+                        fap = LombScargle(c_t[sel], y[sel], dy[sel]).false_alarm_probability(
+                            p[best], minimum_frequency=fmin, maximum_frequency=fmax
+                        )
+                    except ValueError:
+                        fap = np.nan
+                band_results.append((1 / frequency[best], p[best], fap))
+            chunk_results.append(band_results)
+
+        for j, sid in enumerate(c_ids):
+            for band, band_results in zip(bands, chunk_results):
+                rows.append((sid, band) + band_results[j])
+
+    return pd.DataFrame(rows, columns=['SOURCEID', 'band', 'best_period', 'power', 'fap'])
+
+
+def multiband_period(t, mags, errs, frequency=None, samples_per_peak=5, nyquist_factor=5):
+    """
+    Joint period search over several bands: a shared-period Lomb-Scargle
+    fit (one sinusoid for all bands) with a separate mean for each band.
+
+    Subtracting each band's own weighted mean and adding up the bands'
+    trigonometric sums gives the power of the joint fit directly, so all
+    bands are searched in one pass instead of one periodogram per band.
+
+    INPUTS:
+        t: array of observation times (shared by the bands)
+        mags: a sequence of magnitude arrays, one per band (NaN = missing)
+        errs: a sequence of the corresponding uncertainty arrays
+        frequency: optional fixed frequency grid; by default one is made
+                   with autofrequency() from the times with any good data
+        samples_per_peak, nyquist_factor: as in LombScargle.autofrequency
+
+    OUTPUTS:
+        best_period, peak power, false alarm probability, and a list of
+        per-band semi-amplitudes of a sinusoid fit at the best period
+        (NaN everywhere if the periodogram can't be computed)
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    mags = [np.asarray(y, dtype=np.float64) for y in mags]
+    errs = [np.asarray(dy, dtype=np.float64) for dy in errs]
+    goods = [~np.isnan(y) & ~np.isnan(dy) for y, dy in zip(mags, errs)]
+
+    failed = (np.nan, np.nan, np.nan, [np.nan] * len(mags))
+
+    any_good = np.any(goods, axis=0)
+    if any_good.sum() < 3:
+        return failed
+
+    epochs, epoch_index = np.unique(t[any_good], return_inverse=True)
+    if frequency is None:
+        frequency = LombScargle(epochs, np.zeros_like(epochs)).autofrequency(
+            samples_per_peak=samples_per_peak, nyquist_factor=nyquist_factor
+        )
+    frequency = np.asarray(frequency, dtype=np.float64)
+    basis = shared_grid_basis(epochs, frequency)
+
+    # one row per band in the weight matrices
+    w = np.zeros((len(mags), epochs.size))
+    wy = np.zeros_like(w)
+    wyy = np.zeros_like(w)
+    for i, (y, dy, good) in enumerate(zip(mags, errs, goods)):
+        idx = epoch_index[good[any_good]]
+        wt = 1 / dy[good] ** 2
+        np.add.at(w[i], idx, wt)
+        np.add.at(wy[i], idx, wt * y[good])
+        np.add.at(wyy[i], idx, wt * y[good] ** 2)
+
+    sums = shared_grid_sums(basis, w, wy)
+
+    # take out each band's own weighted mean, then add the bands up
+    W = w.sum(axis=1)[:, None]
+    use = W[:, 0] > 0
+    Wy = wy.sum(axis=1)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        YY = np.sum((wyy.sum(axis=1)[:, None] - Wy ** 2 / W)[use])
+        YC = np.sum((sums['YC'] - Wy * sums['C'] / W)[use], axis=0)
+        YS = np.sum((sums['YS'] - Wy * sums['S'] / W)[use], axis=0)
+        CC = np.sum((sums['CC'] - sums['C'] ** 2 / W)[use], axis=0)
+        SS = np.sum((sums['SS'] - sums['S'] ** 2 / W)[use], axis=0)
+        CS = np.sum((sums['CS'] - sums['C'] * sums['S'] / W)[use], axis=0)
+
+        D = CC * SS - CS * CS
+        power = (SS * YC * YC + CC * YS * YS - 2 * CS * YC * YS) / (YY * D)
+
+    if not np.isfinite(power).any():
+        return failed
+
+    best = np.nanargmax(power)
+    best_frequency = frequency[best]
+
+    # FAP: treat the band-centered data as one light curve (the joint fit 
+    # has the same two free parameters per frequency as a single-band one)
+    t_all = np.concatenate([t[good] for good in goods])
+    y_all = np.concatenate([y[good] - np.average(y[good], weights=1 / dy[good] ** 2)
+                            for y, dy, good in zip(mags, errs, goods) if good.any()])
+    dy_all = np.concatenate([dy[good] for dy, good in zip(errs, goods)])
+    try:
+        fap = LombScargle(t_all, y_all, dy_all).false_alarm_probability(
+            power[best], minimum_frequency=frequency.min(), 
+            maximum_frequency=frequency.max()
+        )
+    except ValueError:
+        fap = np.nan
+
+    amplitudes = []
+    for y, dy, good in zip(mags, errs, goods):
+        if good.sum() < 3:
+            amplitudes.append(np.nan)
+            continue
+        theta = LombScargle(t[good], y[good], dy[good]).model_parameters(best_frequency)
+        amplitudes.append(np.hypot(theta[1], theta[2]))
+
+    return 1 / best_frequency, power[best], fap, amplitudes
+
+
+def multiband_period_fap(group, bands="JHK"):
+    """
+    Joint J/H/K counterpart of period_fap: returns (best_period, fap) of the
+    shared-period fit, followed by each band's amplitude at that period.
+    """
+
+    best_period, power, fap, amplitudes = multiband_period(
+        group['MEANMJDOBS'],
+        [group[band.upper()+'APERMAG3'] for band in bands],
+        [group[band.upper()+'APERMAG3ERR'] for band in bands],
+    )
+
+    return (best_period, fap) + tuple(amplitudes)
+
+
+def band_period_fap(periods, band):
+    """
+    Pulls one band out of a period_search_batch table, in the same form as
+    groupby.apply(j_period_fap): a Series of (best_period, fap) tuples 
+    indexed by SOURCEID.
+    """
+
+    sub = periods[periods['band'] == band]
+    return pd.Series(
+        list(zip(sub['best_period'], sub['fap'])),
+        index=pd.Index(sub['SOURCEID'].values, name='SOURCEID'),
+    )
+
 """
 def wavg(group):
     d = group['data']
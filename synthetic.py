@@ -0,0 +1,259 @@
+"""
+Synthetic WSERV-like photometry, for benchmarking and checking the pipeline
+without the (private) WSERV*_results*.fits files.
+
+A synthetic field has the columns read_wserv reads, with the same dtypes,
+null sentinels and *uncorrected* error bars (read_wserv applies the Hodgkin
+correction, and the noise here is drawn from the corrected errors). Stars
+are observed on common nights spread over a few seasons, and a fraction of
+them are injected periodic or aperiodic variables; the truth table says
+which, with their periods and amplitudes.
+
+    python synthetic.py WSERV0_synthetic.fits --sources 5000 --epochs 100
+
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from wserv_io import null
+
+# fits column formats, as in the WSERV tables
+column_formats = {
+    "SOURCEID": "K",
+    "MEANMJDOBS": "D",
+    "RA": "D",
+    "DEC": "D",
+    "JAPERMAG3": "E",
+    "JAPERMAG3ERR": "E",
+    "HAPERMAG3": "E",
+    "HAPERMAG3ERR": "E",
+    "KAPERMAG3": "E",
+    "KAPERMAG3ERR": "E",
+    "JPPERRBITS": "J",
+    "HPPERRBITS": "J",
+    "KPPERRBITS": "J",
+    "MERGEDCLASS": "I",
+    "PSTAR": "E",
+    "JMHPNT": "E",
+    "JMHPNTERR": "E",
+    "HMKPNT": "E",
+    "HMKPNTERR": "E",
+}
+
+# relative amplitudes of the variability in J, H, K
+amplitude_ratios = {"J": 1.2, "H": 1.0, "K": 0.8}
+
+
+def raw_error(mag):
+    """ A WFCAM-like pipeline error bar (before the Hodgkin correction) at magnitude `mag`. """
+    return 0.003 + 0.02 * 10 ** (0.4 * (mag - 17))
+
+
+def corrected_error(raw):
+    """ The Hodgkin 2009 correction, as wserv_io.hodgkin_correction applies it. """
+    return np.sqrt(1.082 * raw ** 2 + 0.021 ** 2)
+
+
+def observing_nights(n_epochs, n_seasons=3, season_length=120.0, season_gap=245.0,
+                     start=56000.0, rng=None):
+    """ `n_epochs` sorted nights (MJD) spread at random over `n_seasons` observing seasons. """
+
+    rng = np.random.default_rng(rng)
+    season = rng.integers(0, n_seasons, n_epochs)
+    nights = start + season * (season_length + season_gap) + rng.uniform(0, season_length, n_epochs)
+    return np.sort(np.floor(nights) + 0.3 + rng.uniform(0, 0.3, n_epochs))
+
+
+def synthetic_field(n_sources=1000, n_epochs=100, periodic_fraction=0.05,
+                    aperiodic_fraction=0.05, galaxy_fraction=0.05,
+                    flagged_fraction=0.02, missing_fraction=0.02,
+                    period_range=(4.0, 40.0), n_seasons=3,
+                    first_sourceid=44199508400000, random_seed=None):
+    """
+    Makes a synthetic field.
+
+    Parameters
+    ----------
+    n_sources, n_epochs : int, optional
+    periodic_fraction, aperiodic_fraction : float, optional
+        Fractions of the (non-galaxy) sources made periodic (a sinusoid
+        with a log-uniform period in `period_range`) or aperiodic (a
+        smoothed random walk) variables. The rest are constant.
+    galaxy_fraction : float, optional
+        Fraction of sources with MERGEDCLASS 1 (galaxies), which fail the
+        quality cuts.
+    flagged_fraction : float, optional
+        Fraction of sources with a few PPERRBITS-flagged detections.
+    missing_fraction : float, optional
+        Fraction of detections that are null in a band.
+    period_range : (float, float), optional
+        In days. The default stays inside what autopower()'s default grid
+        searches at ~100 nights over three seasons (periods above ~3.5 d).
+    n_seasons : int, optional
+    first_sourceid : int, optional
+    random_seed : int, optional
+
+    Returns
+    -------
+    table : dict
+        Column name -> array, as it would be stored in the fits file (nulls
+        as the null sentinel, errors uncorrected), one row per source per
+        epoch, sorted by epoch.
+    truth : pd.DataFrame
+        Indexed by SOURCEID: `kind` ("constant", "periodic", "aperiodic" or
+        "galaxy"), `period` (days, NaN unless periodic), `amplitude` (the K
+        semi-amplitude, or rms for aperiodic variables), the mean J, H and K
+        magnitudes, and `flagged`.
+
+    """
+
+    rng = np.random.default_rng(random_seed)
+
+    sourceids = first_sourceid + np.arange(n_sources, dtype=np.int64)
+    nights = observing_nights(n_epochs, n_seasons=n_seasons, rng=rng)
+
+    kind = np.full(n_sources, "constant", dtype=object)
+    u = rng.uniform(size=n_sources)
+    kind[u < galaxy_fraction] = "galaxy"
+    stars = u >= galaxy_fraction
+    v = rng.uniform(size=n_sources)
+    kind[stars & (v < periodic_fraction)] = "periodic"
+    kind[stars & (v >= periodic_fraction) & (v < periodic_fraction + aperiodic_fraction)] = "aperiodic"
+
+    k_mean = rng.uniform(11, 16, n_sources)
+    h_mean = k_mean + rng.uniform(0.1, 0.8, n_sources)
+    j_mean = h_mean + rng.uniform(0.5, 1.2, n_sources)
+    means = {"J": j_mean, "H": h_mean, "K": k_mean}
+
+    period = np.where(kind == "periodic", np.exp(rng.uniform(*np.log(period_range), n_sources)), np.nan)
+    amplitude = np.where(np.isin(kind, ["periodic", "aperiodic"]), rng.uniform(0.1, 0.4, n_sources), 0.0)
+    phase0 = rng.uniform(0, 2 * np.pi, n_sources)
+
+    # (source, epoch) grid; each source's MEANMJDOBS is a little off the night's
+    shape = (n_sources, n_epochs)
+    t = nights[None, :] + rng.uniform(-0.004, 0.004, shape)
+
+    signal = np.zeros(shape)
+    periodic = kind == "periodic"
+    signal[periodic] = np.sin(2 * np.pi * t[periodic] / period[periodic, None] + phase0[periodic, None])
+    aperiodic = kind == "aperiodic"
+    if aperiodic.any():
+        walk = np.cumsum(rng.normal(size=(aperiodic.sum(), n_epochs)), axis=1)
+        kernel = np.ones(5) / 5
+        walk = np.array([np.convolve(w, kernel, mode="same") for w in walk])
+        walk -= walk.mean(axis=1, keepdims=True)
+        signal[aperiodic] = walk / walk.std(axis=1, keepdims=True)
+
+    table = {
+        "SOURCEID": np.repeat(sourceids, n_epochs),
+        "MEANMJDOBS": t.ravel(),
+    }
+    ra0, dec0 = np.radians(56.1), np.radians(32.1)
+    ra = ra0 + rng.uniform(-0.005, 0.005, n_sources)
+    dec = dec0 + rng.uniform(-0.005, 0.005, n_sources)
+    table["RA"] = np.repeat(ra, n_epochs)
+    table["DEC"] = np.repeat(dec, n_epochs)
+
+    mags = {}
+    errs = {}
+    for band in "JHK":
+        true_mag = means[band][:, None] + amplitude_ratios[band] * amplitude[:, None] * signal
+        raw = raw_error(true_mag)
+        mags[band] = true_mag + rng.normal(size=shape) * corrected_error(raw)
+        errs[band] = raw
+
+        missing = rng.uniform(size=shape) < missing_fraction
+        mag_column = mags[band].astype(np.float32)
+        err_column = errs[band].astype(np.float32)
+        mag_column[missing] = null
+        err_column[missing] = null
+        table[f"{band}APERMAG3"] = mag_column.ravel()
+        table[f"{band}APERMAG3ERR"] = err_column.ravel()
+
+    flagged = rng.uniform(size=n_sources) < flagged_fraction
+    for band in "JHK":
+        bits = np.zeros(shape, dtype=np.int32)
+        flag_rows = flagged[:, None] & (rng.uniform(size=shape) < 0.05)
+        bits[flag_rows] = rng.choice([16, 64, 65536], flag_rows.sum())
+        table[f"{band}PPERRBITS"] = bits.ravel()
+
+    table["MERGEDCLASS"] = np.repeat(np.where(kind == "galaxy", 1, -1), n_epochs).astype(np.int16)
+    table["PSTAR"] = np.repeat(np.where(kind == "galaxy", 0.05, 0.95), n_epochs).astype(np.float32)
+
+    for name, (a, b) in (("JMHPNT", ("J", "H")), ("HMKPNT", ("H", "K"))):
+        color = (mags[a] - mags[b]).astype(np.float32)
+        color_err = np.hypot(errs[a], errs[b]).astype(np.float32)
+        missing = (table[f"{a}APERMAG3"] == null) | (table[f"{b}APERMAG3"] == null)
+        color = color.ravel()
+        color_err = color_err.ravel()
+        color[missing] = null
+        color_err[missing] = null
+        table[name] = color
+        table[name + "ERR"] = color_err
+
+    # the real tables come sorted by epoch rather than by source
+    order = np.argsort(table["MEANMJDOBS"], kind="stable")
+    table = {name: values[order] for name, values in table.items()}
+
+    truth = pd.DataFrame(
+        {
+            "kind": kind,
+            "period": period,
+            "amplitude": amplitude * amplitude_ratios["K"],
+            "J_mean": j_mean,
+            "H_mean": h_mean,
+            "K_mean": k_mean,
+            "flagged": flagged,
+        },
+        index=pd.Index(sourceids, name="SOURCEID"),
+    )
+
+    return table, truth
+
+
+def truth_path(filename):
+    return str(filename) + ".truth.pkl"
+
+
+def write_synthetic_field(filename, overwrite=True, **kwargs):
+    """
+    Writes a synthetic field (see synthetic_field) to `filename` as a WSERV-
+    style fits table, and its truth table next to it (truth_path).
+
+    Returns the truth table.
+    """
+
+    table, truth = synthetic_field(**kwargs)
+
+    columns = [
+        fits.Column(name=name, format=column_formats[name], array=table[name])
+        for name in column_formats
+    ]
+    hdu = fits.BinTableHDU.from_columns(columns)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=overwrite)
+    truth.to_pickle(truth_path(filename))
+
+    return truth
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic WSERV-like field.")
+    parser.add_argument("filename")
+    parser.add_argument("--sources", type=int, default=1000)
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    truth = write_synthetic_field(args.filename, n_sources=args.sources,
+                                  n_epochs=args.epochs, random_seed=args.seed)
+    print(truth["kind"].value_counts().to_string(), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Time-resolved variability indices: Stetson S, reduced chi^2 and amplitude
+per source in sliding MJD windows or in observing seasons, for spotting
+stars whose variability switches on or off between seasons.
+
+Every window of every source is a contiguous range of that source's rows
+(found for all of them at once with one searchsorted), so:
+
+- the counts, means and reduced chi^2 come from cumulative sums over the
+  rows, taken once: O(rows + windows);
+- S and the amplitude, which need each window's own mean and extremes, are
+  one segmented reduction (S_segments, segment_nanmax/min) over the
+  windows' row ranges: O(rows x width/step), i.e. O(rows) for seasons or
+  any fixed overlap.
+
+    python time_resolved.py WSERV8_results.fits --seasons \\
+        --sources prepped/WSERV8_variable_means.pkl -o WSERV8_seasons.pkl
+
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from instrument import instrumented
+from stetson_2020 import (
+    source_columns,
+    segment_rows,
+    segment_nanmean,
+    segment_nanmax,
+    segment_nanmin,
+    S_segments,
+)
+from wserv_io import load_photometry
+
+
+def season_windows(t, min_gap=60.0):
+    """
+    One window per observing season: the field's observation times split
+    wherever there is a gap of more than `min_gap` days.
+
+    Returns the windows' (start, end) MJDs; each covers [start, end), and
+    ends halfway across the gap after it (the last, min_gap / 2 after its
+    last observation), so that the edges are well clear of any row's time.
+    """
+
+    t = np.unique(np.asarray(t, dtype=np.float64))
+    t = t[np.isfinite(t)]
+    if not t.size:
+        return np.array([]), np.array([])
+    breaks = np.flatnonzero(np.diff(t) > min_gap)
+    starts = t[np.concatenate([[0], breaks + 1])]
+    ends = np.append((t[breaks] + t[breaks + 1]) / 2, t[-1] + min_gap / 2)
+    return starts, ends
+
+
+def sliding_windows(t, width, step=None):
+    """
+    Windows `width` days wide every `step` days (default width / 2) across
+    the field's observation times.
+
+    Returns the windows' (start, end) MJDs; each covers [start, end).
+    """
+
+    if step is None:
+        step = width / 2
+    t = np.asarray(t, dtype=np.float64)
+    tmin, tmax = np.nanmin(t), np.nanmax(t)
+    n = max(1, int(np.ceil((tmax - tmin - width) / step)) + 1)
+    starts = tmin + step * np.arange(n)
+    return starts, starts + width
+
+
+def _cumsum0(x):
+    """ Cumulative sum with a leading zero, so sums over rows lo:hi are c[hi] - c[lo]. """
+    out = np.empty(len(x) + 1)
+    out[0] = 0
+    np.cumsum(x, out=out[1:])
+    return out
+
+
+@instrumented("windowed_statistics")
+def windowed_statistics(data, windows, sourceids=None, bands="JHK", min_rows=2, chunk_rows=2**24):
+    """
+    S, reduced chi^2 and amplitude of every source in every window.
+
+    The statistics are those of the whole-baseline versions (S_segments,
+    chisq_red_segments) on the window's rows: S over the J/H/K rows,
+    reduced chi^2 skipping NaN terms but divided by the window's number of
+    rows, and the amplitude is the range (max - min) of the good magnitudes.
+
+    Parameters
+    ----------
+    data : pd.DataFrame, IndexedPhotometry or LightCurveCollection
+    windows : (array, array)
+        The windows' start and end MJDs, e.g. from season_windows or
+        sliding_windows.
+    sourceids : array_like, optional
+        Default: all sources.
+    bands : str, optional
+        S needs J, H and K.
+    min_rows : int, optional
+        Windows where a source has fewer rows than this are left out.
+    chunk_rows : int, optional
+        Limit on the window rows gathered at once for S and the amplitude.
+
+    Returns
+    -------
+    windowed : pd.DataFrame
+        Indexed by (SOURCEID, window): start, end, n_rows, stetson, and per
+        band <band>_n (good measurements), <band>_mean, <band>_chisq_red and
+        <band>_amplitude.
+
+    """
+
+    window_start = np.asarray(windows[0], dtype=np.float64)
+    window_end = np.asarray(windows[1], dtype=np.float64)
+
+    mag_names = [band.upper() + "APERMAG3" for band in bands]
+    err_names = [band.upper() + "APERMAG3ERR" for band in bands]
+    ids, starts, counts, columns = source_columns(data, ["MEANMJDOBS"] + mag_names + err_names, sourceids)
+    t = np.asarray(columns["MEANMJDOBS"], dtype=np.float64)
+    segment = np.repeat(np.arange(len(ids)), counts)
+
+    # each source's rows in time order
+    if t.size and not np.all((np.diff(t) >= 0) | (np.diff(segment) > 0)):
+        order = np.lexsort((t, segment))
+        t = t[order]
+        columns = {name: np.asarray(values)[order] for name, values in columns.items()}
+
+    # one sorted integer key for all the rows, so that every (source,
+    # window) edge is found by a single searchsorted: a row's time is
+    # replaced by its rank among the field's distinct times, and an edge by
+    # the number of distinct times before it, so "t >= edge" is compared
+    # exactly rather than on a float composite key
+    if t.size:
+        times = np.unique(t[np.isfinite(t)])
+        span = times.size + 1
+        # NaN times rank last, after every window
+        key = segment * span + np.searchsorted(times, t)
+
+        def edge(bounds):
+            rank = np.searchsorted(times, bounds)
+            return np.searchsorted(key, np.arange(len(ids))[:, None] * span + rank[None, :]).ravel()
+
+        lo, hi = edge(window_start), edge(window_end)
+    else:
+        lo = hi = np.zeros(len(ids) * len(window_start), dtype=np.int64)
+
+    source = np.repeat(np.arange(len(ids)), len(window_start))
+    window = np.tile(np.arange(len(window_start)), len(ids))
+    n_rows = hi - lo
+    keep = n_rows >= max(min_rows, 1)
+    source, window, lo, hi, n_rows = source[keep], window[keep], lo[keep], hi[keep], n_rows[keep]
+    instrument.note(n_rows=int(counts.sum()), n_sources=len(ids), n_windows=int(keep.sum()))
+
+    out = {
+        "start": window_start[window],
+        "end": window_end[window],
+        "n_rows": n_rows,
+    }
+
+    # counts, means and chi^2 from cumulative sums, about each source's own
+    # mean so that the sums stay small
+    for band, mag_name, err_name in zip(bands, mag_names, err_names):
+        y = np.asarray(columns[mag_name], dtype=np.float64)
+        dy = np.asarray(columns[err_name], dtype=np.float64)
+        valid = ~np.isnan(y)
+        good = valid & ~np.isnan(dy)
+        center = np.repeat(segment_nanmean(y, starts), counts) if y.size else y
+        yc = np.where(valid, y - center, 0)
+        w = np.where(good, 1 / np.where(good, dy, 1) ** 2, 0)
+
+        n_valid = _cumsum0(valid)
+        sum_y = _cumsum0(yc)
+        sum_w = _cumsum0(w)
+        sum_wy = _cumsum0(w * yc)
+        sum_wyy = _cumsum0(w * yc * yc)
+
+        n = n_valid[hi] - n_valid[lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (sum_y[hi] - sum_y[lo]) / n
+            chisq = ((sum_wyy[hi] - sum_wyy[lo]) - 2 * mean * (sum_wy[hi] - sum_wy[lo])
+                     + mean ** 2 * (sum_w[hi] - sum_w[lo]))
+        out[f"{band}_n"] = n.astype(np.int64)
+        out[f"{band}_mean"] = mean + center[lo] if y.size else mean
+        out[f"{band}_chisq_red"] = np.where(n > 0, np.maximum(chisq, 0), 0) / n_rows
+
+    # S and the amplitude, over the windows' own rows, a chunk of windows at a time
+    stetson = np.full(len(lo), np.nan)
+    amplitude = {band: np.full(len(lo), np.nan) for band in bands}
+    ends = np.cumsum(n_rows)
+    first = 0
+    while first < len(lo):
+        last = max(first + 1, int(np.searchsorted(ends, ends[first] - n_rows[first] + chunk_rows, "right")))
+        c_counts = n_rows[first:last]
+        rows = segment_rows(lo[first:last], c_counts)
+        c_starts = np.cumsum(c_counts) - c_counts
+
+        c_mags = {band: np.asarray(columns[name])[rows] for band, name in zip(bands, mag_names)}
+        if set("JHK") <= set(bands):
+            stetson[first:last] = S_segments(
+                c_starts, c_counts,
+                *[x for band in "JHK"
+                  for x in (c_mags[band], np.asarray(columns[band + "APERMAG3ERR"])[rows])]
+            )
+        for band in bands:
+            with np.errstate(invalid="ignore"):
+                amplitude[band][first:last] = (segment_nanmax(c_mags[band], c_starts)
+                                               - segment_nanmin(c_mags[band], c_starts))
+        first = last
+
+    out["stetson"] = stetson
+    for band in bands:
+        out[f"{band}_amplitude"] = amplitude[band]
+
+    names = ["start", "end", "n_rows", "stetson"] + [
+        f"{band}_{stat}" for band in bands for stat in ("n", "mean", "chisq_red", "amplitude")
+    ]
+    return pd.DataFrame(
+        {name: out[name] for name in names},
+        index=pd.MultiIndex.from_arrays([ids[source], window], names=["SOURCEID", "window"]),
+    )
+
+
+def switching_sources(windowed, stetson_variable=2.5, stetson_constant=0.5):
+    """
+    The sources that are variable (S above `stetson_variable`) in some
+    windows and constant (S below `stetson_constant`) in others, with their
+    numbers of each.
+    """
+
+    stetson = windowed["stetson"]
+    counts = pd.DataFrame({
+        "variable_windows": (stetson > stetson_variable).groupby(level="SOURCEID").sum(),
+        "constant_windows": (stetson < stetson_constant).groupby(level="SOURCEID").sum(),
+    })
+    return counts[(counts["variable_windows"] > 0) & (counts["constant_windows"] > 0)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Variability indices per source per time window.")
+    parser.add_argument("filename", help="WSERV fits file")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--seasons", action="store_true", help="one window per observing season")
+    group.add_argument("--width", type=float, help="sliding window width, days")
+    parser.add_argument("--step", type=float, default=None, help="sliding window step, days (default width/2)")
+    parser.add_argument("--season-gap", type=float, default=60.0,
+                        help="gap (days) that separates seasons")
+    parser.add_argument("--sources", default=None,
+                        help="a pickled per-source table (e.g. variable_means) whose sources to do")
+    parser.add_argument("--min-rows", type=int, default=2)
+    parser.add_argument("-o", "--output", required=True, help="write the table here as a pickle")
+    args = parser.parse_args(argv)
+
+    photometry = load_photometry(args.filename)
+    t = photometry.column("MEANMJDOBS")
+    if args.seasons:
+        windows = season_windows(t, args.season_gap)
+    else:
+        windows = sliding_windows(t, args.width, args.step)
+
+    sourceids = None if args.sources is None else pd.read_pickle(args.sources).index
+    windowed = windowed_statistics(photometry, windows, sourceids, min_rows=args.min_rows)
+    windowed.to_pickle(args.output)
+
+    switching = switching_sources(windowed)
+    print(f"{len(windows[0])} windows, {len(windowed)} source-windows, "
+          f"{len(switching)} sources switching between variable and constant", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
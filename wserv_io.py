@@ -0,0 +1,344 @@
+"""
+Reading the WSERV photometry tables (.fits) into pandas, cleaned.
+
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+import instrument
+from instrument import instrumented
+
+null = -999999488.0
+
+# the columns the data-prep scripts, plots and notebooks actually use
+default_columns = [
+    "SOURCEID",
+    "MEANMJDOBS",
+    "RA",
+    "DEC",
+    "JAPERMAG3",
+    "JAPERMAG3ERR",
+    "HAPERMAG3",
+    "HAPERMAG3ERR",
+    "KAPERMAG3",
+    "KAPERMAG3ERR",
+    "JPPERRBITS",
+    "HPPERRBITS",
+    "KPPERRBITS",
+    "MERGEDCLASS",
+    "PSTAR",
+    "JMHPNT",
+    "JMHPNTERR",
+    "HMKPNT",
+    "HMKPNTERR",
+]
+
+error_columns = ["JAPERMAG3ERR", "HAPERMAG3ERR", "KAPERMAG3ERR"]
+
+null_columns = [
+    "JAPERMAG3",
+    "HAPERMAG3",
+    "KAPERMAG3",
+    "JAPERMAG3ERR",
+    "HAPERMAG3ERR",
+    "KAPERMAG3ERR",
+    "JMHPNT",
+    "JMHPNTERR",
+    "HMKPNT",
+    "HMKPNTERR",
+]
+
+
+def hodgkin_correction(err, out=None):
+    """
+    The so-called error correction of Hodgkin 2009, which makes the
+    error bar estimates more grounded in reality (they are otherwise
+    unrealistically low for bright stars) — there's a 2% (0.02 mag) noise
+    floor in practice that is not captured in the pipeline-produced error
+    estimates.
+
+    Works in place if `out` is `err`.
+    """
+
+    out = np.square(err, out=out)
+    out *= 1.082
+    out += 0.021 ** 2
+    return np.sqrt(out, out=out)
+
+
+def clean_column(name, values):
+    """
+    Nulls to NaNs (and the Hodgkin correction for the error columns),
+    done in place on `values`.
+    """
+
+    if name in null_columns:
+        values[values == null] = np.nan
+    if name in error_columns:
+        hodgkin_correction(values, out=values)
+    return values
+
+
+@instrumented("read_wserv")
+def read_wserv(filename, columns=default_columns, hdu=1):
+    """
+    Reads a WSERV*_results*.fits file into a cleaned DataFrame.
+
+    The file is memory-mapped and only `columns` are read out of it, each
+    straight into one native-byte-order array that is then cleaned in place
+    (see clean_column) and handed to pandas without another copy. This
+    replaces Table.read + per-column masking + dat.to_pandas(), which held
+    several full copies of the table at once.
+
+    Note that nulls are turned into NaNs *before* the error correction, so
+    null error bars come out as NaN (correcting first turned them into
+    ~1e9 values that no longer matched the null sentinel).
+
+    Parameters
+    ----------
+    filename : str
+    columns : list of str, optional
+        Which columns to read. Default: the ones the pipeline uses.
+    hdu : int, optional
+        The table extension. Default 1.
+
+    Returns
+    -------
+    df : pd.DataFrame
+
+    """
+
+    data = {}
+    with fits.open(filename, memmap=True) as hdulist:
+        table = hdulist[hdu].data
+        for name in columns:
+            column = table.field(name)
+            values = np.empty(column.shape, dtype=column.dtype.newbyteorder("="))
+            values[...] = column
+            data[name] = clean_column(name, values)
+            del column
+    instrument.note(n_rows=len(data[columns[0]]) if columns else 0)
+
+    return pd.DataFrame(data, copy=False)
+
+
+cache_version = 2
+
+
+class IndexedPhotometry:
+    """
+    Photometry sorted by SOURCEID, with a CSR-style offset index so that any
+    one star's rows are a contiguous slice.
+
+    Attributes
+    ----------
+    data : pd.DataFrame
+        The photometry, sorted by SOURCEID (stable, so each star keeps its
+        original row order).
+    ids : np.ndarray
+        The unique SOURCEIDs, sorted.
+    offsets : np.ndarray
+        len(ids) + 1 row offsets: star i is rows offsets[i]:offsets[i+1].
+    fingerprint : str or None
+        A hash of the contents, if known (load_photometry takes it from the
+        cache manifest), so that results can be cached by their input data
+        without rehashing the whole table (see stage_cache.py).
+
+    """
+
+    def __init__(self, data, ids, offsets, fingerprint=None):
+        self.data = data
+        self.ids = ids
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+        self._position = None
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """ Sorts `df` by SOURCEID (if it isn't already) and indexes it. """
+
+        sourceid = df["SOURCEID"].values
+        if sourceid.size and not np.all(sourceid[1:] >= sourceid[:-1]):
+            df = df.iloc[np.argsort(sourceid, kind="stable")].reset_index(drop=True)
+            sourceid = df["SOURCEID"].values
+
+        ids, starts = np.unique(sourceid, return_index=True)
+        offsets = np.append(starts, sourceid.size)
+
+        return cls(df, ids, offsets)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def columns(self):
+        return list(self.data.columns)
+
+    def column(self, name):
+        """ One flat column, in SOURCEID order (a view, not a copy). """
+        return self.data[name].values
+
+    def rows(self, sourceid):
+        """ The slice of `data` holding this star's rows (O(1)). """
+
+        if self._position is None:
+            self._position = {sid: i for i, sid in enumerate(self.ids.tolist())}
+        i = self._position[sourceid]
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def star(self, sourceid):
+        """ One star's light curve, as a slice (not a copy) of `data`. """
+
+        return self.data.iloc[self.rows(sourceid)]
+
+
+def default_cache_dir(filename):
+    return str(filename) + ".cache"
+
+
+def column_hash(values):
+    values = np.ascontiguousarray(values)
+    h = hashlib.sha1(f"{values.dtype.str}{values.shape}".encode())
+    h.update(memoryview(values).cast("B"))
+    return h.hexdigest()
+
+
+def columns_fingerprint(hashes, columns):
+    """ One hash for a set of columns, from their column_hash values. """
+    return hashlib.sha1(
+        json.dumps([[name, hashes[name]] for name in columns]).encode()
+    ).hexdigest()
+
+
+def _source_stamp(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def save_columns(photometry, directory, columns):
+    """
+    Writes indexed photometry to `directory` as one .npy file per column
+    plus the SOURCEID offset index (the layout load_columns reads), sets its
+    fingerprint, and returns the content hash of each column.
+    """
+
+    for name in columns:
+        np.save(os.path.join(directory, name + ".npy"), photometry.data[name].values)
+    np.save(os.path.join(directory, "_ids.npy"), photometry.ids)
+    np.save(os.path.join(directory, "_offsets.npy"), photometry.offsets)
+
+    hashes = {name: column_hash(photometry.data[name].values) for name in columns}
+    photometry.fingerprint = columns_fingerprint(hashes, columns)
+    return hashes
+
+
+def load_columns(directory, columns, hashes=None, mmap_mode="r"):
+    """ Indexed photometry from a directory written by save_columns. """
+
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+
+    fingerprint = None if hashes is None else columns_fingerprint(hashes, columns)
+    data = pd.DataFrame({name: load(name) for name in columns}, copy=False)
+    return IndexedPhotometry(data, load("_ids"), load("_offsets"), fingerprint)
+
+
+@instrumented("build_cache")
+def build_cache(filename, cache_dir=None, columns=default_columns):
+    """
+    Reads and cleans a WSERV fits file (read_wserv), sorts it by SOURCEID,
+    and writes it to `cache_dir` as one .npy file per column plus the 
+    SOURCEID offset index and a manifest recording which fits file (size 
+    and modification time) it was made from, and a content hash of each
+    column.
+    """
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir(filename)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    photometry = IndexedPhotometry.from_dataframe(read_wserv(filename, columns))
+    hashes = save_columns(photometry, cache_dir, columns)
+
+    # the manifest goes last, so a half-written cache is never "valid"
+    manifest = {
+        "version": cache_version,
+        "source": os.path.abspath(filename),
+        "columns": list(columns),
+        "hashes": hashes,
+        **_source_stamp(filename),
+    }
+    with open(os.path.join(cache_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    return photometry
+
+
+def cache_is_current(filename, cache_dir=None, columns=default_columns):
+    if cache_dir is None:
+        cache_dir = default_cache_dir(filename)
+    try:
+        with open(os.path.join(cache_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return (
+        manifest.get("version") == cache_version
+        and set(columns) <= set(manifest.get("columns", []))
+        and all(manifest.get(key) == value for key, value in _source_stamp(filename).items())
+    )
+
+
+@instrumented("load_photometry")
+def load_photometry(filename, cache_dir=None, columns=default_columns, mmap_mode="r"):
+    """
+    The cleaned, SOURCEID-sorted photometry of a WSERV fits file, from the
+    columnar cache next to it (rebuilt first if missing, or if the fits file
+    has changed since).
+
+    The columns are memory-mapped, so loading is nearly instant and any one
+    star's light curve is an O(1) slice: photometry.star(sourceid).
+
+    Parameters
+    ----------
+    filename : str
+        The WSERV*_results*.fits file.
+    cache_dir : str, optional
+        Default: `filename` + ".cache".
+    columns : list of str, optional
+    mmap_mode : str or None, optional
+        Passed to np.load. None reads the columns into memory.
+
+    Returns
+    -------
+    photometry : IndexedPhotometry
+
+    """
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir(filename)
+
+    if not cache_is_current(filename, cache_dir, columns):
+        build_cache(filename, cache_dir, columns)
+
+    with open(os.path.join(cache_dir, "manifest.json")) as f:
+        hashes = json.load(f)["hashes"]
+
+    photometry = load_columns(cache_dir, columns, hashes, mmap_mode)
+    instrument.note(n_rows=len(photometry.data), n_sources=len(photometry))
+    return photometry